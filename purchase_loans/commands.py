@@ -0,0 +1,75 @@
+import click
+from frappe.commands import get_site, pass_context
+
+
+@click.command("rebuild-purchase-loan-balances")
+@click.option("--loan", "loans", multiple=True, help="Purchase Loan Request to rebuild (repeatable)")
+@click.option("--company", help="Only rebuild loans of this company")
+@click.option("--employee", help="Only rebuild loans of this employee")
+@click.option("--chunk-size", default=500, type=int, help="Loans written and committed per UPDATE")
+@click.option("--dry-run", is_flag=True, default=False, help="Print the differences without writing them")
+@pass_context
+def rebuild_purchase_loan_balances(context, loans, company, employee, chunk_size, dry_run):
+	"""Recompute Purchase Loan Request balances from the Purchase Loan Ledger"""
+	import frappe
+
+	from purchase_loans.purchase_loans.tasks import rebuild_purchase_loan_balances as rebuild
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		result = rebuild(
+			purchase_loan_requests=list(loans) or None,
+			company=company,
+			employee=employee,
+			chunk_size=chunk_size,
+			dry_run=dry_run,
+		)
+	finally:
+		frappe.destroy()
+
+	for name, diff in result.get("diff", {}).items():
+		for fieldname, (stored, ledger) in diff.items():
+			click.echo(f"{name}\t{fieldname}\t{stored} -> {ledger}")
+
+	click.echo(f"Examined: {result['examined']}, changed: {result['changed']}, updated: {result['updated']}")
+
+
+@click.command("backfill-purchase-loan-attachments")
+@click.option("--doctype", "doctypes", multiple=True, help="Target doctype to backfill (repeatable, default all)")
+@click.option("--chunk-size", default=500, type=int, help="Documents scanned and committed per chunk")
+@click.option("--reset", is_flag=True, default=False, help="Start over instead of resuming from the checkpoint")
+@click.option("--enqueue", is_flag=True, default=False, help="Run one background job per doctype instead of in this process")
+@pass_context
+def backfill_purchase_loan_attachments(context, doctypes, chunk_size, reset, enqueue):
+	"""Copy the missing source attachments to existing invoices, receipts, delivery notes, payments and loan journals"""
+	import frappe
+
+	from purchase_loans.purchase_loans.attachments import (
+		backfill_attachments,
+		enqueue_attachment_backfill,
+		get_attachment_target_doctypes,
+	)
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		if enqueue:
+			for doctype in enqueue_attachment_backfill(list(doctypes) or None, chunk_size=chunk_size, reset=reset):
+				click.echo(f"Enqueued {doctype}")
+			frappe.db.commit()
+			return
+
+		for doctype in list(doctypes) or get_attachment_target_doctypes():
+			result = backfill_attachments(doctype, chunk_size=chunk_size, reset=reset)
+			click.echo(
+				f"{doctype}: documents {result['documents']}, examined {result['rows_examined']}, "
+				f"inserted {result['rows_inserted']}, last {result['last_name'] or '-'}"
+			)
+	finally:
+		frappe.destroy()
+
+
+commands = [rebuild_purchase_loan_balances, backfill_purchase_loan_attachments]
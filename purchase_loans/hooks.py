@@ -24,7 +24,12 @@ fixtures = [
 scheduler_events = {
     "daily": [
         "purchase_loans.purchase_loans.tasks.transfer_expired_batches",
-        "purchase_loans.purchase_loans.tasks.notify_purchase_orders_without_receipts"
+        "purchase_loans.purchase_loans.tasks.notify_purchase_orders_without_receipts",
+        "purchase_loans.purchase_loans.doctype.purchase_loan_balance_snapshot.purchase_loan_balance_snapshot.create_purchase_loan_balance_snapshots",
+        "purchase_loans.purchase_loans.doctype.purchase_loan_idempotency_key.purchase_loan_idempotency_key.purge_expired_idempotency_keys"
+    ],
+    "monthly": [
+        "purchase_loans.purchase_loans.revaluation.revalue_purchase_loans_monthly"
     ]
 }
 
@@ -33,13 +38,37 @@ doc_events = {
      "*": {
         "validate": "purchase_loans.purchase_loans.tasks.validate_transaction_date"
     },
+    "Company": {
+        "on_update": "purchase_loans.purchase_loans.company_settings.clear_loan_company_settings",
+        "on_trash": [
+            "purchase_loans.purchase_loans.company_settings.clear_loan_company_settings",
+            "purchase_loans.purchase_loans.doctype.purchase_loan_ledger.purchase_loan_ledger.delete_purchase_loan_ledger"
+        ]
+    },
+    "Mode of Payment": {
+        "on_update": "purchase_loans.purchase_loans.company_settings.clear_all_loan_company_settings"
+    },
+    "Account": {
+        "on_update": "purchase_loans.purchase_loans.company_settings.clear_all_loan_company_settings"
+    },
+    "Currency Exchange": {
+        "on_update": "purchase_loans.purchase_loans.exchange_rate.invalidate_exchange_rate_cache",
+        "on_trash": "purchase_loans.purchase_loans.exchange_rate.invalidate_exchange_rate_cache"
+    },
     "Journal Entry": {
         "validate": "purchase_loans.task.journal_entry.validate_journal_entry",
+        "onload": "purchase_loans.purchase_loans.attachments.load_attachment_references",
+        "on_trash": [
+            "purchase_loans.purchase_loans.attachments.delete_attachment_references",
+            "purchase_loans.purchase_loans.doctype.purchase_loan_ledger.purchase_loan_ledger.delete_purchase_loan_ledger"
+        ],
         "on_cancel": "purchase_loans.task.journal_entry.update_purchase_loan_request_on_cancel",
         "on_submit": "purchase_loans.task.journal_entry.update_purchase_loan_request_on_submit"
     },
     "Payment Entry": {
-        "validate": "purchase_loans.task.payment_entry.validate_payment_entry"
+        "validate": "purchase_loans.task.payment_entry.validate_payment_entry",
+        "onload": "purchase_loans.purchase_loans.attachments.load_attachment_references",
+        "on_trash": "purchase_loans.purchase_loans.attachments.delete_attachment_references"
     },
    
     "Batch": {
@@ -58,19 +87,34 @@ doc_events = {
         "validate": "purchase_loans.task.purchase_order.validate_purchase_order"
     },
     "Purchase Invoice": {
-        "validate": "purchase_loans.task.purchase_invoice.validate_purchase_invoice"
+        "validate": "purchase_loans.task.purchase_invoice.validate_purchase_invoice",
+        "onload": "purchase_loans.purchase_loans.attachments.load_attachment_references",
+        "on_trash": "purchase_loans.purchase_loans.attachments.delete_attachment_references"
     },
     "Sales Invoice": {
-        "validate": "purchase_loans.task.sales_invoice.validate_sales_invoice"
+        "validate": "purchase_loans.task.sales_invoice.validate_sales_invoice",
+        "onload": "purchase_loans.purchase_loans.attachments.load_attachment_references",
+        "on_trash": "purchase_loans.purchase_loans.attachments.delete_attachment_references"
     },
     "Purchase Receipt": {
-        "validate": "purchase_loans.task.stock_transaction.validate_purchase_receipt"
+        "validate": "purchase_loans.task.stock_transaction.validate_purchase_receipt",
+        "onload": "purchase_loans.purchase_loans.attachments.load_attachment_references",
+        "on_trash": "purchase_loans.purchase_loans.attachments.delete_attachment_references"
     },
     "Delivery Note": {
-        "validate": "purchase_loans.task.stock_transaction.validate_delivery_note"
+        "validate": "purchase_loans.task.stock_transaction.validate_delivery_note",
+        "onload": "purchase_loans.purchase_loans.attachments.load_attachment_references",
+        "on_trash": "purchase_loans.purchase_loans.attachments.delete_attachment_references"
     },
     "File": {
+        "after_insert": "purchase_loans.task.file.propagate_file_attachment",
         "on_trash": "purchase_loans.task.file.before_delete_file"
+    },
+    "Purchase Loan Request": {
+        "on_trash": "purchase_loans.purchase_loans.doctype.purchase_loan_ledger.purchase_loan_ledger.delete_purchase_loan_ledger"
+    },
+    "Employee": {
+        "on_trash": "purchase_loans.purchase_loans.doctype.purchase_loan_ledger.purchase_loan_ledger.delete_purchase_loan_ledger"
     }
 }
 
@@ -98,6 +142,7 @@ after_migrate = [
 # include js, css files in header of desk.html
 # app_include_css = "/assets/purchase_loans/css/purchase_loans.css"
 # app_include_js = "/assets/purchase_loans/js/purchase_loans.js"
+app_include_js = "/assets/purchase_loans/js/attachment_references.js"
 
 # include js, css files in header of web template
 # web_include_css = "/assets/purchase_loans/css/purchase_loans.css"
@@ -203,6 +248,9 @@ after_migrate = [
 # override_doctype_class = {
 # 	"ToDo": "custom_app.overrides.CustomToDo"
 # }
+override_doctype_class = {
+    "File": "purchase_loans.purchase_loans.attachments.ReferencedFile"
+}
 
 # Document Events
 # ---------------
@@ -248,6 +296,9 @@ after_migrate = [
 # override_whitelisted_methods = {
 # 	"frappe.desk.doctype.event.event.get_events": "purchase_loans.event.get_events"
 # }
+override_whitelisted_methods = {
+    "frappe.desk.form.utils.remove_attach": "purchase_loans.purchase_loans.attachments.remove_attach"
+}
 #
 # each overriding function accepts a `data` argument;
 # generated from the base implementation of the doctype dashboard,
@@ -264,6 +315,8 @@ after_migrate = [
 # -----------------------------------------------------------
 
 # ignore_links_on_delete = ["Communication", "ToDo"]
+# The ledger's cancelled rows are deleted with the linked document instead (see delete_purchase_loan_ledger)
+ignore_links_on_delete = ["Purchase Loan Ledger"]
 
 # Request Events
 # ----------------
@@ -0,0 +1,8 @@
+from purchase_loans.purchase_loans.doctype.purchase_loan_employee_exposure.purchase_loan_employee_exposure import (
+	rebuild_employee_exposure,
+)
+
+
+def execute():
+	"""Fills the exposure table from the Purchase Loan Requests that are already open."""
+	rebuild_employee_exposure()
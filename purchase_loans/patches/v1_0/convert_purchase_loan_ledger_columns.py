@@ -0,0 +1,36 @@
+import frappe
+
+
+def execute():
+	"""
+	Prepares existing Purchase Loan Ledger rows for the typed schema. posting_date used to be a
+	Data column, so blank or malformed values are cleared (and refilled from the Journal Entry)
+	before the column is altered to DATE.
+	"""
+	if not frappe.db.table_exists("Purchase Loan Ledger"):
+		return
+
+	frappe.db.sql(
+		"""
+		UPDATE `tabPurchase Loan Ledger`
+		SET posting_date = LEFT(TRIM(posting_date), 10)
+		WHERE posting_date IS NOT NULL AND LENGTH(TRIM(posting_date)) > 10
+		"""
+	)
+	frappe.db.sql(
+		"""
+		UPDATE `tabPurchase Loan Ledger`
+		SET posting_date = NULL
+		WHERE posting_date IS NOT NULL
+			AND (TRIM(posting_date) = '' OR STR_TO_DATE(posting_date, '%Y-%m-%d') IS NULL)
+		"""
+	)
+	frappe.db.sql(
+		"""
+		UPDATE `tabPurchase Loan Ledger` ledger
+		JOIN `tabJournal Entry` je ON je.name = ledger.reference_name
+		SET ledger.posting_date = je.posting_date
+		WHERE ledger.posting_date IS NULL
+		"""
+	)
+
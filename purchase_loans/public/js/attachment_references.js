@@ -0,0 +1,31 @@
+// Files propagated from a Purchase Order, Sales Order or Purchase Loan Request are stored as
+// Purchase Loan Attachment References; list them in the attachment sidebar with the document's own files.
+[
+    "Purchase Invoice",
+    "Purchase Receipt",
+    "Sales Invoice",
+    "Delivery Note",
+    "Payment Entry",
+    "Journal Entry"
+].forEach(function(doctype) {
+    frappe.ui.form.on(doctype, {
+        refresh: function(frm) {
+            const references = (frm.doc.__onload && frm.doc.__onload.attachment_references) || [];
+            const docinfo = frm.get_docinfo();
+            if (!references.length || !docinfo) {
+                return;
+            }
+
+            docinfo.attachments = docinfo.attachments || [];
+            const shown = new Set(docinfo.attachments.map(file => file.name));
+            references.forEach(function(reference) {
+                if (!shown.has(reference.name)) {
+                    docinfo.attachments.push(reference);
+                }
+            });
+            if (frm.attachments) {
+                frm.attachments.refresh();
+            }
+        }
+    });
+});
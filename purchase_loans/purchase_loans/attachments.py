@@ -0,0 +1,437 @@
+import frappe
+from frappe import _
+from frappe.core.doctype.file.file import File
+from frappe.utils import now
+
+_stats = {"calls": 0, "rows_examined": 0, "rows_inserted": 0}
+
+BACKFILL_CHECKPOINT_KEY = "purchase_loans_attachment_backfill:{}"
+
+# The documents a source's attachments are pushed to: (target doctype, field linking it to the source)
+ATTACHMENT_TARGETS = {
+    "Purchase Order": (
+        ("Purchase Invoice", "custom_transaction_unique_id"),
+        ("Purchase Receipt", "custom_transaction_unique_id"),
+        ("Payment Entry", "custom_transaction_unique_id"),
+    ),
+    "Sales Order": (
+        ("Sales Invoice", "custom_transaction_unique_id"),
+        ("Delivery Note", "custom_transaction_unique_id"),
+        ("Payment Entry", "custom_transaction_unique_id"),
+    ),
+    "Purchase Loan Request": (
+        ("Journal Entry", "custom_purchase_loan_request"),
+    ),
+}
+
+
+def copy_attachments(source_doctype, source_names, target_doctype, target_name):
+    """
+    Attaches the files of the `source_names` documents of `source_doctype` to one target document.
+
+    The files the target is still missing are found with a single anti-join against its existing
+    attachments and references (matched on content hash, or on file URL and name for files without
+    one, see `_same_file`), and are recorded as references to the source File in one statement. Returns the rows examined and inserted by this call; the
+    cumulative counters of the process are returned by `get_attachment_propagation_stats`.
+    """
+    if isinstance(source_names, str):
+        source_names = [source_names]
+    source_names = [name for name in source_names or [] if name]
+    if not source_names or not target_name:
+        return {"rows_examined": 0, "rows_inserted": 0}
+
+    files = frappe.db.sql(
+        f"""
+        SELECT src.name, src.file_url, src.file_name, src.is_private, src.content_hash,
+            IFNULL(dst.name, ref.name) AS existing
+        FROM `tabFile` src
+        LEFT JOIN `tabFile` dst
+            ON dst.attached_to_doctype = %(target_doctype)s AND dst.attached_to_name = %(target_name)s
+            AND {_same_file("dst", "dst", "src")}
+        LEFT JOIN (
+            `tabPurchase Loan Attachment Reference` ref JOIN `tabFile` ref_file ON ref_file.name = ref.file
+        )
+            ON ref.attached_to_doctype = %(target_doctype)s AND ref.attached_to_name = %(target_name)s
+            AND {_same_file("ref", "ref_file", "src")}
+        WHERE src.attached_to_doctype = %(source_doctype)s AND src.attached_to_name IN %(source_names)s
+            AND src.is_folder = 0 AND IFNULL(src.file_url, '') != ''
+        """,
+        {
+            "source_doctype": source_doctype,
+            "source_names": tuple(source_names),
+            "target_doctype": target_doctype,
+            "target_name": target_name,
+        },
+        as_dict=True,
+    )
+
+    missing = {}
+    for file in files:
+        # The same file attached to several sources is only added once
+        if not file.existing:
+            missing.setdefault(_file_key(file), file)
+
+    _insert_attachment_references([(file, target_doctype, target_name) for file in missing.values()])
+
+    examined = len({file.name for file in files})
+    _stats["calls"] += 1
+    _stats["rows_examined"] += examined
+    _stats["rows_inserted"] += len(missing)
+    return {"rows_examined": examined, "rows_inserted": len(missing)}
+
+
+def push_attachment(file):
+    """
+    Attaches a File just added to a source document (see ATTACHMENT_TARGETS) to every document
+    linked to that source, except those that already have it (same content hash, or same file URL
+    and name for files without one). The linked documents are found with
+    one query over the indexed link fields and the references are inserted in one statement.
+    """
+    targets = get_linked_documents(file.attached_to_doctype, file.attached_to_name)
+    if targets:
+        existing = set(frappe.db.sql(
+            f"""
+            SELECT dst.attached_to_doctype, dst.attached_to_name
+            FROM `tabFile` dst, (SELECT %(content_hash)s AS content_hash, %(file_url)s AS file_url, %(file_name)s AS file_name) src
+            WHERE {_same_file("dst", "dst", "src")}
+                AND (dst.attached_to_doctype, dst.attached_to_name) IN %(targets)s
+            UNION
+            SELECT ref.attached_to_doctype, ref.attached_to_name
+            FROM `tabPurchase Loan Attachment Reference` ref
+            JOIN `tabFile` ref_file ON ref_file.name = ref.file,
+                (SELECT %(content_hash)s AS content_hash, %(file_url)s AS file_url, %(file_name)s AS file_name) src
+            WHERE {_same_file("ref", "ref_file", "src")}
+                AND (ref.attached_to_doctype, ref.attached_to_name) IN %(targets)s
+            """,
+            {
+                "content_hash": file.content_hash,
+                "file_url": file.file_url,
+                "file_name": file.file_name,
+                "targets": tuple(targets),
+            },
+        ))
+        targets = [target for target in targets if target not in existing]
+        _insert_attachment_references([(file, target_doctype, target_name) for target_doctype, target_name in targets])
+
+    _stats["calls"] += 1
+    _stats["rows_examined"] += 1
+    _stats["rows_inserted"] += len(targets)
+    return {"rows_examined": 1, "rows_inserted": len(targets)}
+
+
+def get_linked_documents(source_doctype, source_name):
+    """Returns the (doctype, name) of the non-cancelled documents that receive the attachments of a source."""
+    targets = ATTACHMENT_TARGETS.get(source_doctype)
+    if not targets or not source_name:
+        return []
+
+    if source_doctype == "Purchase Loan Request":
+        link_value = source_name
+    else:
+        link_value = frappe.db.get_value(source_doctype, source_name, "custom_transaction_unique_id")
+        if not link_value:
+            return []
+
+    return [
+        tuple(row)
+        for row in frappe.db.sql(
+            " UNION ALL ".join(
+                f"SELECT %s, name FROM `tab{target_doctype}` WHERE `{link_field}` = %s AND docstatus < 2"
+                for target_doctype, link_field in targets
+            ),
+            tuple(value for target_doctype, _link_field in targets for value in (target_doctype, link_value)),
+        )
+    ]
+
+
+def get_attachment_target_doctypes():
+    return sorted({doctype for targets in ATTACHMENT_TARGETS.values() for doctype, _link_field in targets})
+
+
+def get_backfill_sources(target_doctype):
+    """Returns the (source doctype, field of the source, field of the target) pairs a target pulls from."""
+    return [
+        (source_doctype, "name" if source_doctype == "Purchase Loan Request" else link_field, link_field)
+        for source_doctype, targets in ATTACHMENT_TARGETS.items()
+        for doctype, link_field in targets
+        if doctype == target_doctype
+    ]
+
+
+def backfill_attachments(target_doctype, chunk_size=500, reset=False):
+    """
+    Copies the missing attachments of every linked `target_doctype` document from its sources.
+
+    Documents are walked by name in keyset-paginated chunks. Each chunk finds the missing files of
+    all its documents with one anti-join per source and bulk inserts them, then commits and stores
+    the last name reached, so an interrupted run resumes after it. `reset` starts from the
+    beginning. Different doctypes keep their own checkpoint and can run in parallel.
+    """
+    sources = get_backfill_sources(target_doctype)
+    if not sources:
+        frappe.throw(_("{0} does not receive propagated attachments.").format(target_doctype))
+
+    checkpoint_key = BACKFILL_CHECKPOINT_KEY.format(target_doctype)
+    last_name = "" if reset else frappe.db.get_global(checkpoint_key) or ""
+    link_fields = sorted({target_field for _source, _source_field, target_field in sources})
+    result = {"doctype": target_doctype, "documents": 0, "rows_examined": 0, "rows_inserted": 0, "chunks": 0}
+
+    while True:
+        names = frappe.db.sql(
+            f"""
+            SELECT name FROM `tab{target_doctype}`
+            WHERE name > %s AND docstatus < 2
+                AND ({" OR ".join(f"IFNULL(`{field}`, '') != ''" for field in link_fields)})
+            ORDER BY name
+            LIMIT %s
+            """,
+            (last_name, chunk_size),
+            pluck=True,
+        )
+        if not names:
+            break
+
+        missing = {}
+        for source_doctype, source_field, target_field in sources:
+            files = frappe.db.sql(
+                f"""
+                SELECT tgt.name AS target_name, src.name, src.file_url, src.file_name, src.is_private,
+                    src.content_hash, IFNULL(dst.name, ref.name) AS existing
+                FROM `tab{target_doctype}` tgt
+                JOIN `tab{source_doctype}` src_doc ON src_doc.`{source_field}` = tgt.`{target_field}`
+                JOIN `tabFile` src
+                    ON src.attached_to_doctype = %(source_doctype)s AND src.attached_to_name = src_doc.name
+                    AND src.is_folder = 0 AND IFNULL(src.file_url, '') != ''
+                LEFT JOIN `tabFile` dst
+                    ON dst.attached_to_doctype = %(target_doctype)s AND dst.attached_to_name = tgt.name
+                    AND {_same_file("dst", "dst", "src")}
+                LEFT JOIN (
+                    `tabPurchase Loan Attachment Reference` ref JOIN `tabFile` ref_file ON ref_file.name = ref.file
+                )
+                    ON ref.attached_to_doctype = %(target_doctype)s AND ref.attached_to_name = tgt.name
+                    AND {_same_file("ref", "ref_file", "src")}
+                WHERE tgt.name IN %(names)s
+                """,
+                {"source_doctype": source_doctype, "target_doctype": target_doctype, "names": tuple(names)},
+                as_dict=True,
+            )
+            result["rows_examined"] += len(files)
+            for file in files:
+                if not file.existing:
+                    missing.setdefault((file.target_name, _file_key(file)), file)
+
+        _insert_attachment_references([(file, target_doctype, file.target_name) for file in missing.values()])
+
+        last_name = names[-1]
+        frappe.db.set_global(checkpoint_key, last_name)
+        frappe.db.commit()
+
+        result["documents"] += len(names)
+        result["rows_inserted"] += len(missing)
+        result["chunks"] += 1
+
+    _stats["calls"] += 1
+    _stats["rows_examined"] += result["rows_examined"]
+    _stats["rows_inserted"] += result["rows_inserted"]
+    result["last_name"] = last_name
+    return result
+
+
+def enqueue_attachment_backfill(target_doctypes=None, chunk_size=500, reset=False):
+    """Starts one background backfill per target doctype; a doctype whose job is still queued or running is skipped."""
+    target_doctypes = target_doctypes or get_attachment_target_doctypes()
+    for target_doctype in target_doctypes:
+        frappe.enqueue(
+            backfill_attachments,
+            queue="long",
+            timeout=6 * 60 * 60,
+            job_id=f"purchase_loans_attachment_backfill::{target_doctype}",
+            deduplicate=True,
+            target_doctype=target_doctype,
+            chunk_size=chunk_size,
+            reset=reset,
+        )
+    return target_doctypes
+
+
+def _same_file(target, target_file, source):
+    """
+    SQL condition matching an attachment (`target`, whose File row is `target_file`) to a `source`
+    File: same content hash, or same file URL and name when either side has no hash (links and
+    files saved before hashing).
+    """
+    return (
+        f"({target_file}.content_hash = {source}.content_hash"
+        f" OR (({target_file}.content_hash IS NULL OR {source}.content_hash IS NULL)"
+        f" AND {target}.file_url = {source}.file_url AND {target}.file_name <=> {source}.file_name))"
+    )
+
+
+def _file_key(file):
+    return file.content_hash or (file.file_url, file.file_name)
+
+
+def _insert_attachment_references(references):
+    """
+    Records (source File, target doctype, target name) as references to the source File in one
+    statement, and raises the reference count of each File in one UPDATE.
+    """
+    if not references:
+        return
+
+    timestamp, user = now(), frappe.session.user
+    frappe.db.bulk_insert(
+        "Purchase Loan Attachment Reference",
+        fields=[
+            "name", "creation", "modified", "owner", "modified_by",
+            "file", "file_url", "file_name", "is_private", "attached_to_doctype", "attached_to_name",
+        ],
+        values=[
+            (
+                frappe.generate_hash(length=10), timestamp, timestamp, user, user,
+                file.name, file.file_url, file.file_name, file.is_private, target_doctype, target_name,
+            )
+            for file, target_doctype, target_name in references
+        ],
+    )
+
+    counts = {}
+    for file, _target_doctype, _target_name in references:
+        counts[file.name] = counts.get(file.name, 0) + 1
+    _update_reference_counts(counts)
+
+
+def _update_reference_counts(counts):
+    """
+    Adds the signed amounts of {file: amount} to the reference counts of many Files in one UPDATE.
+    The count is informational (shown on the File form); deletion always reads the references
+    themselves, so a drifted count is left visible instead of being clamped at zero.
+    """
+    if not counts:
+        return
+
+    files = list(counts)
+    frappe.db.sql(
+        f"""
+        UPDATE `tabFile`
+        SET custom_reference_count
+            = IFNULL(custom_reference_count, 0) + CASE name {" ".join(["WHEN %s THEN %s"] * len(files))} END
+        WHERE name IN %s
+        """,
+        (*(value for file in files for value in (file, counts[file])), tuple(files)),
+    )
+
+
+def get_attachment_references(doctype, name):
+    """Returns the references of a document, oldest first."""
+    return frappe.get_all(
+        "Purchase Loan Attachment Reference",
+        filters={"attached_to_doctype": doctype, "attached_to_name": name},
+        fields=["name", "file", "file_url", "file_name", "is_private"],
+        order_by="creation",
+    )
+
+
+def load_attachment_references(doc, method=None):
+    """onload hook of the target doctypes: sends the referenced files along for the attachment sidebar."""
+    doc.set_onload("attachment_references", get_attachment_references(doc.doctype, doc.name))
+
+
+def delete_attachment_references(doc, method=None):
+    """on_trash hook of the target doctypes: drops the document's references like Frappe drops its Files."""
+    references = get_attachment_references(doc.doctype, doc.name)
+    if not references:
+        return
+
+    frappe.db.delete("Purchase Loan Attachment Reference", {"name": ["in", [reference.name for reference in references]]})
+    counts = {}
+    for reference in references:
+        counts[reference.file] = counts.get(reference.file, 0) - 1
+    _update_reference_counts(counts)
+
+
+@frappe.whitelist()
+def remove_attach():
+    """
+    Replaces `frappe.desk.form.utils.remove_attach`: removing a referenced file from a document's
+    sidebar drops its reference; the shared File is left to its own document. The reference is
+    removed under the same rules as deleting a File (see `task/file.py:before_delete_file`).
+    """
+    from frappe.desk.form.utils import remove_attach as remove_file
+    from purchase_loans.task.file import check_attachment_delete_permission
+
+    reference = frappe.db.get_value(
+        "Purchase Loan Attachment Reference",
+        frappe.form_dict.get("fid"),
+        ["name", "file", "owner", "attached_to_doctype", "attached_to_name"],
+        as_dict=True,
+    )
+    if not reference:
+        return remove_file()
+
+    frappe.get_doc(reference.attached_to_doctype, reference.attached_to_name).check_permission("write")
+    check_attachment_delete_permission(reference.owner, reference.attached_to_doctype, reference.attached_to_name)
+    frappe.db.delete("Purchase Loan Attachment Reference", {"name": reference.name})
+    _update_reference_counts({reference.file: -1})
+
+
+class ReferencedFile(File):
+    """
+    File controller that keeps referenced files alive. A File still referenced by other documents
+    hands its place to the oldest reference before it is deleted: that reference becomes a real
+    File row of its document and the remaining references point at it. The stored file is shared
+    by the new row, so Frappe only removes it from disk once the last File using it is deleted.
+    """
+
+    def on_trash(self):
+        if not self.is_folder:
+            self._promote_oldest_reference()
+        super().on_trash()
+
+    def is_downloadable(self):
+        # A private file can also be downloaded by the readers of the documents referencing it
+        return super().is_downloadable() or any(
+            frappe.has_permission(reference.attached_to_doctype, "read", reference.attached_to_name)
+            for reference in frappe.get_all(
+                "Purchase Loan Attachment Reference",
+                filters={"file": self.name},
+                fields=["attached_to_doctype", "attached_to_name"],
+            )
+        )
+
+    def _promote_oldest_reference(self):
+        references = frappe.get_all(
+            "Purchase Loan Attachment Reference",
+            filters={"file": self.name},
+            fields=["name", "attached_to_doctype", "attached_to_name"],
+            order_by="creation",
+        )
+        if not references:
+            return
+
+        promoted, timestamp = references[0], now()
+        new_file = frappe.generate_hash(length=10)
+        frappe.db.bulk_insert(
+            "File",
+            fields=[
+                "name", "creation", "modified", "owner", "modified_by",
+                "file_name", "file_url", "is_private", "file_size", "content_hash", "folder",
+                "attached_to_doctype", "attached_to_name", "custom_reference_count",
+            ],
+            values=[(
+                new_file, timestamp, timestamp, self.owner, frappe.session.user,
+                self.file_name, self.file_url, self.is_private, self.file_size, self.content_hash, "Home/Attachments",
+                promoted.attached_to_doctype, promoted.attached_to_name, len(references) - 1,
+            )],
+        )
+        frappe.db.delete("Purchase Loan Attachment Reference", {"name": promoted.name})
+        frappe.db.set_value(
+            "Purchase Loan Attachment Reference", {"file": self.name}, "file", new_file, update_modified=False
+        )
+
+
+@frappe.whitelist()
+def get_attachment_propagation_stats():
+    """Counters of this worker process."""
+    frappe.only_for("System Manager")
+    return dict(_stats)
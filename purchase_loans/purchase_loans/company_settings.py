@@ -0,0 +1,124 @@
+from dataclasses import dataclass, field
+
+import frappe
+from frappe import _
+from frappe.utils import cint, flt
+
+CACHE_KEY = "purchase_loans:loan_company_settings"
+
+
+@dataclass(frozen=True)
+class LoanCompanySettings:
+    """The Company fields used by purchase loans and stock automations, read once and cached per site."""
+
+    company: str
+    default_currency: str | None = None
+    exchange_gain_loss_account: str | None = None
+    unrealized_exchange_gain_loss_account: str | None = None
+    purchase_loan_account: str | None = None
+    maximum_loan_amount: float = 0.0
+    maximum_employee_loan_exposure: float = 0.0
+    allow_payment_beyond_loan_amount: bool = True
+    allow_repayment_beyond_loan_amount: bool = True
+    post_loan_repayments_in_background: bool = False
+    consolidate_loan_settlement_journal: bool = False
+    role: str | None = None
+    warehouse: str | None = None
+    enable_automatic_transfer: bool = True
+    mode_of_payment_accounts: dict = field(default_factory=dict)
+    account_currencies: dict = field(default_factory=dict)
+
+    def get_mode_of_payment_account(self, mode_of_payment):
+        """Returns the default account of a Mode of Payment for this company, like ERPNext's get_bank_cash_account."""
+        account = self.mode_of_payment_accounts.get(mode_of_payment)
+        if not account:
+            frappe.throw(
+                _("Please set default Cash or Bank account in Mode of Payment {0}").format(
+                    frappe.utils.get_link_to_form("Mode of Payment", mode_of_payment)
+                ),
+                title=_("Missing Account"),
+            )
+        return account
+
+
+def get_loan_company_settings(company):
+    """Returns the cached LoanCompanySettings of `company`."""
+    if not company:
+        frappe.throw(_("Company is required."))
+
+    return frappe.cache().hget(CACHE_KEY, company, generator=lambda: _load_loan_company_settings(company))
+
+
+def _load_loan_company_settings(company):
+    values = frappe.db.get_value(
+        "Company",
+        company,
+        [
+            "default_currency",
+            "exchange_gain_loss_account",
+            "unrealized_exchange_gain_loss_account",
+            "custom_purchase_loan_account",
+            "custom_maximum_loan_amount",
+            "custom_maximum_employee_loan_exposure",
+            "custom_allow_payment_beyond_loan_amount",
+            "custom_allow_repayment_beyond_loan_amount",
+            "custom_post_loan_repayments_in_background",
+            "custom_consolidate_loan_settlement_journal",
+            "custom_role",
+            "custom_warehouse",
+            "custom_enable_automatic_transfer",
+        ],
+        as_dict=True,
+    )
+    if not values:
+        frappe.throw(_("Company {0} not found").format(company), frappe.DoesNotExistError)
+
+    mode_of_payment_accounts = dict(
+        frappe.get_all(
+            "Mode of Payment Account",
+            filters={"company": company, "parenttype": "Mode of Payment"},
+            fields=["parent", "default_account"],
+            as_list=True,
+        )
+    )
+    accounts = {account for account in mode_of_payment_accounts.values() if account}
+    if values.custom_purchase_loan_account:
+        accounts.add(values.custom_purchase_loan_account)
+    account_currencies = dict(
+        frappe.get_all(
+            "Account",
+            filters={"name": ["in", list(accounts)]},
+            fields=["name", "account_currency"],
+            as_list=True,
+        )
+    ) if accounts else {}
+
+    return LoanCompanySettings(
+        company=company,
+        default_currency=values.default_currency,
+        exchange_gain_loss_account=values.exchange_gain_loss_account,
+        unrealized_exchange_gain_loss_account=values.unrealized_exchange_gain_loss_account,
+        purchase_loan_account=values.custom_purchase_loan_account,
+        maximum_loan_amount=flt(values.custom_maximum_loan_amount),
+        maximum_employee_loan_exposure=flt(values.custom_maximum_employee_loan_exposure),
+        # The Yes/No settings only restrict when explicitly set to "No"
+        allow_payment_beyond_loan_amount=values.custom_allow_payment_beyond_loan_amount != "No",
+        allow_repayment_beyond_loan_amount=values.custom_allow_repayment_beyond_loan_amount != "No",
+        post_loan_repayments_in_background=bool(cint(values.custom_post_loan_repayments_in_background)),
+        consolidate_loan_settlement_journal=bool(cint(values.custom_consolidate_loan_settlement_journal)),
+        role=values.custom_role,
+        warehouse=values.custom_warehouse,
+        enable_automatic_transfer=values.custom_enable_automatic_transfer != "No",
+        mode_of_payment_accounts=mode_of_payment_accounts,
+        account_currencies=account_currencies,
+    )
+
+
+def clear_loan_company_settings(doc, method=None):
+    """Company hook: drops the cached settings of that company."""
+    frappe.cache().hdel(CACHE_KEY, doc.name)
+
+
+def clear_all_loan_company_settings(doc=None, method=None):
+    """Mode of Payment and Account hook: the resolved accounts of any company may have changed."""
+    frappe.cache().delete_value(CACHE_KEY)
@@ -0,0 +1,14 @@
+# Copyright (c) 2024, Ahmed Emam and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class PurchaseLoanAttachmentReference(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Purchase Loan Attachment Reference", ["attached_to_doctype", "attached_to_name"])
+	frappe.db.add_index("Purchase Loan Attachment Reference", ["file"])
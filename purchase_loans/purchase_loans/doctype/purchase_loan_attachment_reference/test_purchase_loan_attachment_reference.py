@@ -0,0 +1,92 @@
+# Copyright (c) 2024, Ahmed Emam and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from purchase_loans.purchase_loans.attachments import copy_attachments, remove_attach
+
+
+class TestPurchaseLoanAttachmentReference(FrappeTestCase):
+	def test_same_content_is_referenced_once(self):
+		source, target = make_todo("_Test Attachment Source"), make_todo("_Test Attachment Target")
+		first = make_file(source, "loan-contract.txt", b"_test contract")
+		make_file(source, "loan-contract-copy.txt", b"_test contract")
+
+		result = copy_attachments("ToDo", source, "ToDo", target)
+		rerun = copy_attachments("ToDo", source, "ToDo", target)
+
+		self.assertEqual(result, {"rows_examined": 2, "rows_inserted": 1})
+		self.assertEqual(rerun["rows_inserted"], 0)
+		self.assertEqual(get_references(target), [first.content_hash])
+
+	def test_attached_copy_is_not_referenced(self):
+		source, target = make_todo("_Test Attachment Source"), make_todo("_Test Attachment Target")
+		make_file(source, "invoice.txt", b"_test invoice")
+		make_file(target, "invoice-scan.txt", b"_test invoice")
+
+		result = copy_attachments("ToDo", source, "ToDo", target)
+
+		self.assertEqual(result["rows_inserted"], 0)
+		self.assertEqual(get_references(target), [])
+
+	def test_deleting_the_file_promotes_the_reference(self):
+		source, target = make_todo("_Test Attachment Source"), make_todo("_Test Attachment Target")
+		file = make_file(source, "receipt.txt", b"_test receipt")
+		copy_attachments("ToDo", source, "ToDo", target)
+		self.assertEqual(frappe.db.get_value("File", file.name, "custom_reference_count"), 1)
+
+		file.delete()
+
+		self.assertEqual(get_references(target), [])
+		self.assertEqual(
+			frappe.db.get_value(
+				"File", {"attached_to_doctype": "ToDo", "attached_to_name": target}, "content_hash"
+			),
+			file.content_hash,
+		)
+
+	def test_remove_attach_drops_only_the_reference(self):
+		source, target = make_todo("_Test Attachment Source"), make_todo("_Test Attachment Target")
+		file = make_file(source, "quote.txt", b"_test quote")
+		copy_attachments("ToDo", source, "ToDo", target)
+		reference = frappe.db.get_value("Purchase Loan Attachment Reference", {"attached_to_name": target})
+
+		frappe.form_dict.fid = reference
+		self.addCleanup(frappe.form_dict.pop, "fid", None)
+		remove_attach()
+
+		self.assertEqual(get_references(target), [])
+		self.assertTrue(frappe.db.exists("File", file.name))
+		self.assertEqual(frappe.db.get_value("File", file.name, "custom_reference_count"), 0)
+
+
+def make_todo(description):
+	return frappe.get_doc({"doctype": "ToDo", "description": description}).insert().name
+
+
+def make_file(todo, file_name, content):
+	return frappe.get_doc(
+		{
+			"doctype": "File",
+			"file_name": file_name,
+			"content": content,
+			"attached_to_doctype": "ToDo",
+			"attached_to_name": todo,
+			"is_private": 1,
+		}
+	).insert()
+
+
+def get_references(todo):
+	"""Content hashes of the files referenced by a ToDo."""
+	return frappe.db.sql(
+		"""
+		SELECT ref_file.content_hash
+		FROM `tabPurchase Loan Attachment Reference` ref
+		JOIN `tabFile` ref_file ON ref_file.name = ref.file
+		WHERE ref.attached_to_doctype = 'ToDo' AND ref.attached_to_name = %s
+		""",
+		todo,
+		pluck=True,
+	)
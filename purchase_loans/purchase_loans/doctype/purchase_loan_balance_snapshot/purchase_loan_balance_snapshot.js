@@ -0,0 +1,8 @@
+// Copyright (c) 2024, Ahmed Emam and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("Purchase Loan Balance Snapshot", {
+// 	refresh(frm) {
+
+// 	},
+// });
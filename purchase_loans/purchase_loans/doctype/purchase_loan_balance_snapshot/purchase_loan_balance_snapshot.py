@@ -0,0 +1,228 @@
+# Copyright (c) 2024, Ahmed Emam and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import add_days, flt, getdate, now, today
+
+from purchase_loans.purchase_loans.tasks import (
+	LOAN_BALANCE_FIELDS,
+	calculate_loan_balances,
+	get_loan_exchange_rate,
+)
+
+
+class PurchaseLoanBalanceSnapshot(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_unique(
+		"Purchase Loan Balance Snapshot",
+		["purchase_loan_request", "snapshot_date"],
+		"unique_purchase_loan_request_snapshot_date",
+	)
+	frappe.db.add_index("Purchase Loan Balance Snapshot", ["employee", "snapshot_date"])
+
+
+def create_purchase_loan_balance_snapshots(snapshot_date=None):
+	"""
+	Scheduled daily. Writes one snapshot row per loan whose ledger changed since its previous
+	snapshot, holding the cumulative paid and repaid totals (company currency) up to the snapshot
+	date. Loans without ledger activity keep their previous snapshot, so the table stays compact.
+
+	Defaults to yesterday so postings made later today are picked up by the next run.
+	"""
+	snapshot_date = getdate(snapshot_date or add_days(today(), -1))
+
+	rows = frappe.db.sql(
+		"""
+		SELECT
+			ledger.purchase_loan_request,
+			MAX(ledger.employee) AS employee,
+			MAX(ledger.company) AS company,
+			IFNULL(MAX(snapshot.total_paid), 0)
+				+ SUM(CASE WHEN ledger.cancelled = 0 AND ledger.purchase_loan_payment_type = 'Pay' THEN ledger.amount ELSE 0 END) AS total_paid,
+			IFNULL(MAX(snapshot.total_repaid), 0)
+				+ SUM(CASE WHEN ledger.cancelled = 0 AND ledger.purchase_loan_payment_type = 'RePay' THEN ledger.amount ELSE 0 END) AS total_repaid
+		FROM `tabPurchase Loan Ledger` ledger
+		LEFT JOIN (
+			SELECT snap.purchase_loan_request, snap.snapshot_date, snap.total_paid, snap.total_repaid
+			FROM `tabPurchase Loan Balance Snapshot` snap
+			JOIN (
+				SELECT purchase_loan_request, MAX(snapshot_date) AS snapshot_date
+				FROM `tabPurchase Loan Balance Snapshot`
+				WHERE snapshot_date <= %(snapshot_date)s
+				GROUP BY purchase_loan_request
+			) latest ON latest.purchase_loan_request = snap.purchase_loan_request
+				AND latest.snapshot_date = snap.snapshot_date
+		) snapshot ON snapshot.purchase_loan_request = ledger.purchase_loan_request
+		WHERE ledger.posting_date <= %(snapshot_date)s
+			AND (snapshot.snapshot_date IS NULL OR ledger.posting_date > snapshot.snapshot_date)
+		GROUP BY ledger.purchase_loan_request
+		""",
+		{"snapshot_date": snapshot_date},
+		as_dict=True,
+	)
+
+	if not rows:
+		return 0
+
+	timestamp, user = now(), frappe.session.user
+	frappe.db.bulk_insert(
+		"Purchase Loan Balance Snapshot",
+		fields=[
+			"name", "creation", "modified", "owner", "modified_by",
+			"purchase_loan_request", "employee", "company", "snapshot_date", "total_paid", "total_repaid",
+		],
+		values=[
+			(
+				frappe.generate_hash(length=10), timestamp, timestamp, user, user,
+				row.purchase_loan_request, row.employee, row.company, snapshot_date,
+				flt(row.total_paid), flt(row.total_repaid),
+			)
+			for row in rows
+		],
+		ignore_duplicates=True,
+	)
+
+	return len(rows)
+
+
+def invalidate_purchase_loan_balance_snapshots(purchase_loan_request, posting_date):
+	"""
+	Drops the snapshots of a loan that a ledger row posted (or cancelled) on `posting_date` makes
+	stale. Historical queries fall back to the previous snapshot plus the ledger until the next run.
+	"""
+	if not (purchase_loan_request and posting_date):
+		return
+
+	frappe.db.sql(
+		"""
+		DELETE FROM `tabPurchase Loan Balance Snapshot`
+		WHERE purchase_loan_request = %s AND snapshot_date >= %s
+		""",
+		(purchase_loan_request, getdate(posting_date)),
+	)
+
+
+@frappe.whitelist()
+def get_loan_balance_as_of(purchase_loan_request, date):
+	"""
+	Returns the balance fields of a Purchase Loan Request (loan currency) as of the end of `date`,
+	read from the latest snapshot on or before that date plus the ledger rows posted after it.
+	"""
+	frappe.has_permission("Purchase Loan Request", "read", purchase_loan_request, throw=True)
+
+	loans = _get_loans({"name": purchase_loan_request})
+	if not loans:
+		frappe.throw(_("Purchase Loan Request {0} not found").format(purchase_loan_request))
+
+	return _get_balances_as_of(loans, getdate(date))[0]
+
+
+@frappe.whitelist()
+def get_employee_loan_balance_as_of(employee, date, company=None):
+	"""
+	Returns the balances of every submitted Purchase Loan Request of an employee as of `date`,
+	together with the totals per currency. Only the loans the user can read are included.
+	"""
+	frappe.has_permission("Purchase Loan Request", "read", throw=True)
+
+	date = getdate(date)
+	filters = {"employee": employee, "posting_date": ["<=", date]}
+	if company:
+		filters["company"] = company
+
+	balances = _get_balances_as_of(_get_loans(filters), date)
+
+	totals = {}
+	for row in balances:
+		currency_totals = totals.setdefault(row["currency"], dict.fromkeys(LOAN_BALANCE_FIELDS, 0.0))
+		for fieldname in LOAN_BALANCE_FIELDS:
+			currency_totals[fieldname] += row[fieldname]
+
+	return {"employee": employee, "as_of": date, "loans": balances, "totals": totals}
+
+
+def _get_loans(filters):
+	"""Lists the submitted loans matching `filters` that the current user is allowed to read."""
+	return frappe.get_list(
+		"Purchase Loan Request",
+		filters={"docstatus": 1, **filters},
+		fields=["name", "employee", "company", "currency", "exchange_rate", "request_amount"],
+	)
+
+
+def _get_balances_as_of(loans, date):
+	"""Computes as-of balances for a list of loans with one snapshot query and one ledger query."""
+	if not loans:
+		return []
+
+	loan_names = tuple(loan.name for loan in loans)
+
+	snapshots = {
+		row.purchase_loan_request: row
+		for row in frappe.db.sql(
+			"""
+			SELECT snap.purchase_loan_request, snap.snapshot_date, snap.total_paid, snap.total_repaid
+			FROM `tabPurchase Loan Balance Snapshot` snap
+			JOIN (
+				SELECT purchase_loan_request, MAX(snapshot_date) AS snapshot_date
+				FROM `tabPurchase Loan Balance Snapshot`
+				WHERE purchase_loan_request IN %(loans)s AND snapshot_date <= %(date)s
+				GROUP BY purchase_loan_request
+			) latest ON latest.purchase_loan_request = snap.purchase_loan_request
+				AND latest.snapshot_date = snap.snapshot_date
+			""",
+			{"loans": loan_names, "date": date},
+			as_dict=True,
+		)
+	}
+
+	# Ledger rows after each loan's snapshot (or all rows when the loan has none yet)
+	movements = {
+		row.purchase_loan_request: row
+		for row in frappe.db.sql(
+			"""
+			SELECT
+				ledger.purchase_loan_request,
+				SUM(CASE WHEN ledger.purchase_loan_payment_type = 'Pay' THEN ledger.amount ELSE 0 END) AS total_paid,
+				SUM(CASE WHEN ledger.purchase_loan_payment_type = 'RePay' THEN ledger.amount ELSE 0 END) AS total_repaid
+			FROM `tabPurchase Loan Ledger` ledger
+			LEFT JOIN `tabPurchase Loan Balance Snapshot` snap
+				ON snap.purchase_loan_request = ledger.purchase_loan_request AND snap.snapshot_date = (
+					SELECT MAX(latest.snapshot_date)
+					FROM `tabPurchase Loan Balance Snapshot` latest
+					WHERE latest.purchase_loan_request = ledger.purchase_loan_request
+						AND latest.snapshot_date <= %(date)s
+				)
+			WHERE ledger.purchase_loan_request IN %(loans)s
+				AND ledger.cancelled = 0
+				AND ledger.posting_date <= %(date)s
+				AND (snap.snapshot_date IS NULL OR ledger.posting_date > snap.snapshot_date)
+			GROUP BY ledger.purchase_loan_request
+			""",
+			{"loans": loan_names, "date": date},
+			as_dict=True,
+		)
+	}
+
+	balances = []
+	for loan in loans:
+		snapshot = snapshots.get(loan.name) or {}
+		movement = movements.get(loan.name) or {}
+		total_paid = flt(snapshot.get("total_paid")) + flt(movement.get("total_paid"))
+		total_repaid = flt(snapshot.get("total_repaid")) + flt(movement.get("total_repaid"))
+
+		exchange_rate = get_loan_exchange_rate(loan)
+		balances.append({
+			"purchase_loan_request": loan.name,
+			"as_of": date,
+			"currency": loan.currency,
+			"snapshot_date": snapshot.get("snapshot_date"),
+			**calculate_loan_balances(flt(loan.request_amount), total_paid / exchange_rate, total_repaid / exchange_rate),
+		})
+
+	return balances
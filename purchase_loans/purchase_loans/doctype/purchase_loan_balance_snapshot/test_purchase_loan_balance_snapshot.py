@@ -0,0 +1,53 @@
+# Copyright (c) 2024, Ahmed Emam and Contributors
+# See license.txt
+
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, flt, getdate, today
+
+from purchase_loans.purchase_loans.doctype.purchase_loan_balance_snapshot.purchase_loan_balance_snapshot import (
+	create_purchase_loan_balance_snapshots,
+	get_employee_loan_balance_as_of,
+	get_loan_balance_as_of,
+	invalidate_purchase_loan_balance_snapshots,
+)
+from purchase_loans.purchase_loans.doctype.purchase_loan_request.test_purchase_loan_request import (
+	make_employee,
+	make_ledger_row,
+	make_purchase_loan_request,
+)
+
+
+class TestPurchaseLoanBalanceSnapshot(FrappeTestCase):
+	def setUp(self):
+		self.loan = make_purchase_loan_request(request_amount=300, employee=make_employee("_Test Snapshot Employee"))
+		make_ledger_row(self.loan, cancelled=0, amount=100, posting_date=add_days(today(), -5))
+		make_ledger_row(self.loan, cancelled=0, amount=50, posting_date=add_days(today(), -2))
+		make_ledger_row(self.loan, cancelled=1, amount=500, posting_date=add_days(today(), -2))
+		create_purchase_loan_balance_snapshots(add_days(today(), -3))
+
+	def test_balance_as_of_combines_snapshot_and_later_ledger(self):
+		at_snapshot = get_loan_balance_as_of(self.loan.name, add_days(today(), -3))
+		self.assertEqual(getdate(at_snapshot["snapshot_date"]), getdate(add_days(today(), -3)))
+		self.assertEqual(flt(at_snapshot["paid_amount_from_request"]), 100)
+
+		after_snapshot = get_loan_balance_as_of(self.loan.name, today())
+		self.assertEqual(flt(after_snapshot["paid_amount_from_request"]), 150)
+		self.assertEqual(flt(after_snapshot["outstanding_amount_from_request"]), 150)
+
+		before_any_posting = get_loan_balance_as_of(self.loan.name, add_days(today(), -6))
+		self.assertIsNone(before_any_posting["snapshot_date"])
+		self.assertEqual(flt(before_any_posting["paid_amount_from_request"]), 0)
+
+	def test_backdated_posting_invalidates_later_snapshots(self):
+		make_ledger_row(self.loan, cancelled=0, amount=25, posting_date=add_days(today(), -4))
+		invalidate_purchase_loan_balance_snapshots(self.loan.name, add_days(today(), -4))
+
+		balance = get_loan_balance_as_of(self.loan.name, add_days(today(), -3))
+		self.assertIsNone(balance["snapshot_date"])
+		self.assertEqual(flt(balance["paid_amount_from_request"]), 125)
+
+	def test_employee_totals_per_currency(self):
+		result = get_employee_loan_balance_as_of(self.loan.employee, today())
+
+		self.assertEqual([row["purchase_loan_request"] for row in result["loans"]], [self.loan.name])
+		self.assertEqual(flt(result["totals"][self.loan.currency]["paid_amount_from_request"]), 150)
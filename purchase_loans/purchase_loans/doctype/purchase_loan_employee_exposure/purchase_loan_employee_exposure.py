@@ -0,0 +1,227 @@
+# Copyright (c) 2024, Ahmed Emam and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import cint, flt, fmt_money, now
+
+# Amount columns kept per (employee, company, currency), all in the loan currency
+EXPOSURE_FIELDS = (
+	"requested_amount",
+	"paid_amount",
+	"outstanding_amount_from_request",
+	"outstanding_amount_from_repayment",
+	"total_exposure",
+)
+
+
+class PurchaseLoanEmployeeExposure(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_unique(
+		"Purchase Loan Employee Exposure",
+		["employee", "company", "currency"],
+		"unique_employee_company_currency",
+	)
+
+
+def get_exposure_name(employee, company, currency):
+	"""Matches the doctype autoname so the row can be addressed without a lookup."""
+	return f"{employee}-{company}-{currency}"
+
+
+def get_loan_exposure(balances):
+	"""Returns the contribution of one open loan to its exposure row, from its balance fields."""
+	return {
+		"requested_amount": flt(balances.get("request_amount")),
+		"paid_amount": flt(balances.get("paid_amount_from_request")),
+		"outstanding_amount_from_request": flt(balances.get("outstanding_amount_from_request")),
+		"outstanding_amount_from_repayment": flt(balances.get("outstanding_amount_from_repayment")),
+		"total_exposure": flt(balances.get("outstanding_amount_from_request"))
+		+ flt(balances.get("outstanding_amount_from_repayment")),
+	}
+
+
+def is_open_loan(loan):
+	return cint(loan.get("docstatus")) == 1 and not cint(loan.get("closed"))
+
+
+def apply_employee_exposure_delta(loan, delta, loan_count_delta=0):
+	"""
+	Adds `delta` (loan currency amounts keyed by EXPOSURE_FIELDS) to the exposure row of the loan's
+	employee, company and currency with a single upsert. `loan` needs employee, company, currency and
+	exchange_rate.
+	"""
+	from purchase_loans.purchase_loans.tasks import get_loan_exchange_rate
+
+	if not loan.get("employee") or not (loan_count_delta or any(flt(delta.get(f)) for f in EXPOSURE_FIELDS)):
+		return
+
+	base_delta = flt(delta.get("total_exposure")) * get_loan_exchange_rate(loan)
+	timestamp, user = now(), frappe.session.user
+	frappe.db.sql(
+		f"""
+		INSERT INTO `tabPurchase Loan Employee Exposure`
+			(name, creation, modified, owner, modified_by, docstatus,
+			employee, employee_name, company, currency, open_loan_count,
+			{", ".join(EXPOSURE_FIELDS)}, base_total_exposure)
+		VALUES (%s, %s, %s, %s, %s, 0, %s, %s, %s, %s, %s, {", ".join(["%s"] * len(EXPOSURE_FIELDS))}, %s)
+		ON DUPLICATE KEY UPDATE
+			modified = VALUES(modified),
+			open_loan_count = open_loan_count + VALUES(open_loan_count),
+			{", ".join(f"{f} = {f} + VALUES({f})" for f in EXPOSURE_FIELDS)},
+			base_total_exposure = base_total_exposure + VALUES(base_total_exposure)
+		""",
+		(
+			get_exposure_name(loan.employee, loan.company, loan.currency),
+			timestamp, timestamp, user, user,
+			loan.employee,
+			frappe.db.get_value("Employee", loan.employee, "employee_name"),
+			loan.company,
+			loan.currency,
+			cint(loan_count_delta),
+			*(flt(delta.get(f)) for f in EXPOSURE_FIELDS),
+			base_delta,
+		),
+	)
+
+
+def add_loan_to_employee_exposure(loan, sign=1):
+	"""Counts (sign=1) or releases (sign=-1) a whole loan, on submit, cancel, close and reopen."""
+	contribution = get_loan_exposure(loan)
+	apply_employee_exposure_delta(loan, {f: sign * contribution[f] for f in EXPOSURE_FIELDS}, sign)
+
+
+def update_employee_exposure(loan, balances):
+	"""
+	Moves an open loan's contribution from its stored balance fields (`loan`) to the new ones
+	(`balances`). Called wherever the balance fields of a submitted loan are rewritten.
+	"""
+	if not is_open_loan(loan):
+		return
+
+	old = get_loan_exposure(loan)
+	new = get_loan_exposure({"request_amount": loan.request_amount, **balances})
+	apply_employee_exposure_delta(loan, {f: new[f] - old[f] for f in EXPOSURE_FIELDS})
+
+
+def validate_employee_exposure(loan):
+	"""
+	Throws if counting `loan` would push the employee's open exposure in this company over the
+	company's Maximum Open Loan Exposure per Employee. The employee's exposure rows are locked so
+	concurrent submissions for the same employee are checked one after the other.
+	"""
+	from purchase_loans.purchase_loans.company_settings import get_loan_company_settings
+	from purchase_loans.purchase_loans.tasks import get_loan_exchange_rate
+
+	company_settings = get_loan_company_settings(loan.company)
+	maximum_exposure = company_settings.maximum_employee_loan_exposure
+	if maximum_exposure <= 0:
+		return
+
+	current_exposure = flt(
+		frappe.db.sql(
+			"""
+			SELECT SUM(base_total_exposure)
+			FROM `tabPurchase Loan Employee Exposure`
+			WHERE employee = %s AND company = %s
+			FOR UPDATE
+			""",
+			(loan.employee, loan.company),
+		)[0][0]
+	)
+	loan_exposure = get_loan_exposure(loan)["total_exposure"] * get_loan_exchange_rate(loan)
+
+	if current_exposure + loan_exposure > maximum_exposure + 0.001:
+		company_currency = company_settings.default_currency
+		frappe.throw(
+			_("Employee {0} already has {1} of open purchase loans. This request adds {2} and exceeds the maximum open exposure of {3} for {4}.").format(
+				loan.employee,
+				fmt_money(current_exposure, currency=company_currency),
+				fmt_money(loan_exposure, currency=company_currency),
+				fmt_money(maximum_exposure, currency=company_currency),
+				loan.company,
+			),
+			title=_("Loan Exposure Limit Exceeded"),
+		)
+
+
+def rebuild_employee_exposure(purchase_loan_requests=None, company=None, employee=None):
+	"""
+	Recomputes the exposure rows from the open Purchase Loan Requests in one statement. Without
+	filters the whole table is rebuilt; otherwise only the (employee, company) rows of the given
+	loans, company or employee are.
+
+	The loans of those rows and then the rows themselves are locked first, in the same order as
+	apply_employee_exposure_delta, so a concurrent upsert waits for the rebuild instead of being
+	wiped out or counted twice.
+	"""
+	conditions, values = [], {}
+	if purchase_loan_requests:
+		pairs = frappe.db.sql(
+			"""
+			SELECT DISTINCT employee, company
+			FROM `tabPurchase Loan Request`
+			WHERE name IN %(purchase_loan_requests)s AND IFNULL(employee, '') != ''
+			""",
+			{"purchase_loan_requests": tuple(purchase_loan_requests)},
+		)
+		if not pairs:
+			return
+		conditions.append("({alias}.employee, {alias}.company) IN %(pairs)s")
+		values["pairs"] = tuple(tuple(pair) for pair in pairs)
+	if company:
+		conditions.append("{alias}.company = %(company)s")
+		values["company"] = company
+	if employee:
+		conditions.append("{alias}.employee = %(employee)s")
+		values["employee"] = employee
+
+	def get_conditions(alias):
+		return "".join(f" AND {condition.format(alias=alias)}" for condition in conditions)
+
+	frappe.db.sql(
+		f"SELECT name FROM `tabPurchase Loan Request` plr WHERE 1=1 {get_conditions('plr')} FOR UPDATE", values
+	)
+	frappe.db.sql(
+		f"SELECT name FROM `tabPurchase Loan Employee Exposure` exposure WHERE 1=1 {get_conditions('exposure')} FOR UPDATE",
+		values,
+	)
+	frappe.db.sql(
+		f"DELETE exposure FROM `tabPurchase Loan Employee Exposure` exposure WHERE 1=1 {get_conditions('exposure')}",
+		values,
+	)
+
+	timestamp, user = now(), frappe.session.user
+	frappe.db.sql(
+		f"""
+		INSERT INTO `tabPurchase Loan Employee Exposure`
+			(name, creation, modified, owner, modified_by, docstatus,
+			employee, employee_name, company, currency, open_loan_count,
+			requested_amount, paid_amount, outstanding_amount_from_request,
+			outstanding_amount_from_repayment, total_exposure, base_total_exposure)
+		SELECT
+			CONCAT(plr.employee, '-', plr.company, '-', plr.currency),
+			%(timestamp)s, %(timestamp)s, %(user)s, %(user)s, 0,
+			plr.employee, MAX(emp.employee_name), plr.company, plr.currency, COUNT(*),
+			SUM(plr.request_amount),
+			SUM(plr.paid_amount_from_request),
+			SUM(plr.outstanding_amount_from_request),
+			SUM(plr.outstanding_amount_from_repayment),
+			SUM(plr.outstanding_amount_from_request + plr.outstanding_amount_from_repayment),
+			SUM(
+				(plr.outstanding_amount_from_request + plr.outstanding_amount_from_repayment)
+				* CASE WHEN company.default_currency = plr.currency THEN 1 ELSE IFNULL(NULLIF(plr.exchange_rate, 0), 1) END
+			)
+		FROM `tabPurchase Loan Request` plr
+		JOIN `tabCompany` company ON company.name = plr.company
+		LEFT JOIN `tabEmployee` emp ON emp.name = plr.employee
+		WHERE plr.docstatus = 1 AND IFNULL(plr.closed, 0) = 0 AND IFNULL(plr.employee, '') != ''
+			{get_conditions('plr')}
+		GROUP BY plr.employee, plr.company, plr.currency
+		""",
+		{**values, "timestamp": timestamp, "user": user},
+	)
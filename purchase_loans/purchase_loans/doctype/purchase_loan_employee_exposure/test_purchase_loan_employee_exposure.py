@@ -0,0 +1,33 @@
+# Copyright (c) 2024, Ahmed Emam and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import flt
+
+from purchase_loans.purchase_loans.doctype.purchase_loan_employee_exposure.purchase_loan_employee_exposure import (
+	get_exposure_name,
+)
+from purchase_loans.purchase_loans.doctype.purchase_loan_request.test_purchase_loan_request import (
+	make_employee,
+	make_purchase_loan_request,
+)
+
+
+class TestPurchaseLoanEmployeeExposure(FrappeTestCase):
+	def test_submitted_loan_is_counted_once(self):
+		loan = make_purchase_loan_request(request_amount=250, employee=make_employee("_Test Exposure Employee"))
+
+		exposure = frappe.get_doc("Purchase Loan Employee Exposure", get_exposure_name(loan.employee, loan.company, loan.currency))
+		self.assertEqual(exposure.open_loan_count, 1)
+		self.assertEqual(flt(exposure.requested_amount), 250)
+		self.assertEqual(flt(exposure.total_exposure), 250)
+		self.assertEqual(flt(exposure.base_total_exposure), 250 * flt(loan.exchange_rate or 1))
+
+	def test_cancelled_loan_is_released(self):
+		loan = make_purchase_loan_request(request_amount=250, employee=make_employee("_Test Exposure Employee"))
+		loan.cancel()
+
+		exposure = frappe.get_doc("Purchase Loan Employee Exposure", get_exposure_name(loan.employee, loan.company, loan.currency))
+		self.assertEqual(exposure.open_loan_count, 0)
+		self.assertEqual(flt(exposure.total_exposure), 0)
@@ -0,0 +1,87 @@
+# Copyright (c) 2024, Ahmed Emam and contributors
+# For license information, please see license.txt
+
+import hashlib
+import json
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import add_days, now, nowdate
+
+# Keys are kept long enough to cover any client retry, then purged by the daily job
+IDEMPOTENCY_KEY_RETENTION_DAYS = 7
+
+
+class PurchaseLoanIdempotencyKey(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Purchase Loan Idempotency Key", ["creation"])
+
+
+def run_idempotent(idempotency_key, endpoint, args, fn):
+	"""
+	Runs `fn()` once per `idempotency_key`. The key is claimed with an INSERT on its primary key in
+	the same transaction as the posting, so a retry of a committed call returns the stored result
+	and a concurrent retry waits on the key until the first call commits or rolls back. Reusing a
+	key for another endpoint, user or different arguments is rejected.
+	"""
+	if not idempotency_key:
+		return fn()
+
+	idempotency_key = str(idempotency_key).strip()
+	if not idempotency_key or len(idempotency_key) > 140:
+		frappe.throw(_("Idempotency key must be between 1 and 140 characters."))
+
+	request_hash = hashlib.sha256(
+		json.dumps([endpoint, args], sort_keys=True, default=str).encode()
+	).hexdigest()
+
+	timestamp, user = now(), frappe.session.user
+	try:
+		frappe.db.sql(
+			"""
+			INSERT INTO `tabPurchase Loan Idempotency Key`
+				(name, creation, modified, owner, modified_by, docstatus, endpoint, user, status, request_hash)
+			VALUES (%s, %s, %s, %s, %s, 0, %s, %s, 'Pending', %s)
+			""",
+			(idempotency_key, timestamp, timestamp, user, user, endpoint, user, request_hash),
+		)
+	except Exception as e:
+		if not frappe.db.is_duplicate_entry(e):
+			raise
+		return _get_stored_response(idempotency_key, endpoint, user, request_hash)
+
+	response = fn()
+	frappe.db.set_value(
+		"Purchase Loan Idempotency Key",
+		idempotency_key,
+		{"status": "Completed", "response": json.dumps(response, default=str)},
+		update_modified=False,
+	)
+	return response
+
+
+def _get_stored_response(idempotency_key, endpoint, user, request_hash):
+	stored = frappe.db.get_value(
+		"Purchase Loan Idempotency Key",
+		idempotency_key,
+		["endpoint", "user", "status", "request_hash", "response"],
+		as_dict=True,
+	)
+	if stored.endpoint != endpoint or stored.user != user or stored.request_hash != request_hash:
+		frappe.throw(_("Idempotency key {0} was already used for a different request.").format(idempotency_key))
+	if stored.status != "Completed":
+		frappe.throw(_("A request with idempotency key {0} is still being processed.").format(idempotency_key))
+
+	return json.loads(stored.response) if stored.response else None
+
+
+def purge_expired_idempotency_keys():
+	"""Scheduled daily."""
+	frappe.db.delete(
+		"Purchase Loan Idempotency Key",
+		{"creation": ["<", add_days(nowdate(), -IDEMPOTENCY_KEY_RETENTION_DAYS)]},
+	)
@@ -0,0 +1,81 @@
+# Copyright (c) 2024, Ahmed Emam and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, nowdate, today
+
+from purchase_loans.purchase_loans.doctype.purchase_loan_idempotency_key.purchase_loan_idempotency_key import (
+	IDEMPOTENCY_KEY_RETENTION_DAYS,
+	purge_expired_idempotency_keys,
+	run_idempotent,
+)
+from purchase_loans.purchase_loans.doctype.purchase_loan_request.purchase_loan_request import pay_to_employee
+from purchase_loans.purchase_loans.doctype.purchase_loan_request.test_purchase_loan_request import (
+	MODE_OF_PAYMENT,
+	make_purchase_loan_request,
+	skip_without_loan_accounts,
+)
+
+
+class TestPurchaseLoanIdempotencyKey(FrappeTestCase):
+	def test_retry_returns_the_stored_response(self):
+		calls = []
+
+		def fn():
+			calls.append(1)
+			return {"journal_entry": "JV-0001"}
+
+		first = run_idempotent("_test-retry", "pay_to_employee", {"amount": 100}, fn)
+		second = run_idempotent("_test-retry", "pay_to_employee", {"amount": 100}, fn)
+
+		self.assertEqual(len(calls), 1)
+		self.assertEqual(first, second)
+
+	def test_retried_payout_posts_one_journal(self):
+		skip_without_loan_accounts(self)
+		loan = make_purchase_loan_request(request_amount=300)
+
+		args = (loan.name, loan.company, loan.employee, MODE_OF_PAYMENT, 100, today())
+		first = pay_to_employee(*args, idempotency_key="_test-payout")
+		second = pay_to_employee(*args, idempotency_key="_test-payout")
+
+		self.assertEqual(first, second)
+		self.assertEqual(
+			frappe.db.count("Journal Entry", {"custom_purchase_loan_request": loan.name, "docstatus": 1}), 1
+		)
+
+	def test_key_reused_for_another_payload_is_rejected(self):
+		run_idempotent("_test-payload", "pay_to_employee", {"amount": 100}, lambda: None)
+
+		self.assertRaises(
+			frappe.ValidationError, run_idempotent, "_test-payload", "pay_to_employee", {"amount": 200}, lambda: None
+		)
+		self.assertRaises(
+			frappe.ValidationError, run_idempotent, "_test-payload", "create_repay_cash", {"amount": 100}, lambda: None
+		)
+
+	def test_key_reused_by_another_user_is_rejected(self):
+		run_idempotent("_test-user", "pay_to_employee", {"amount": 100}, lambda: None)
+
+		frappe.set_user("test@example.com")
+		self.addCleanup(frappe.set_user, "Administrator")
+		self.assertRaises(
+			frappe.ValidationError, run_idempotent, "_test-user", "pay_to_employee", {"amount": 100}, lambda: None
+		)
+
+	def test_purge_removes_only_expired_keys(self):
+		run_idempotent("_test-expired", "pay_to_employee", {}, lambda: None)
+		run_idempotent("_test-recent", "pay_to_employee", {}, lambda: None)
+		frappe.db.set_value(
+			"Purchase Loan Idempotency Key",
+			"_test-expired",
+			"creation",
+			add_days(nowdate(), -IDEMPOTENCY_KEY_RETENTION_DAYS - 1),
+			update_modified=False,
+		)
+
+		purge_expired_idempotency_keys()
+
+		self.assertFalse(frappe.db.exists("Purchase Loan Idempotency Key", "_test-expired"))
+		self.assertTrue(frappe.db.exists("Purchase Loan Idempotency Key", "_test-recent"))
@@ -1,9 +1,86 @@
 # Copyright (c) 2024, Ahmed Emam and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
+from frappe import _
 from frappe.model.document import Document
+from frappe.utils import flt
+
+# Link field of the ledger that points at each document it can hold rows for
+LEDGER_LINK_FIELDS = {
+	"Journal Entry": "reference_name",
+	"Purchase Loan Request": "purchase_loan_request",
+	"Employee": "employee",
+	"Company": "company",
+}
 
 
 class PurchaseLoanLedger(Document):
-	pass
+	def validate(self):
+		validate_purchase_loan_ledger_entry(self)
+
+
+def validate_purchase_loan_ledger_entry(entry, loan=None):
+	"""
+	Checks a ledger row against its Purchase Loan Request. Also called for the rows that multi-loan
+	journals bulk insert without the controller; they pass the `loan` they have already locked.
+	The amount is in company currency, so the row must be posted in the loan's company.
+	"""
+	if entry.purchase_loan_payment_type not in ("Pay", "RePay"):
+		frappe.throw(_("Invalid Purchase Loan Payment Type: {0}").format(entry.purchase_loan_payment_type))
+
+	if flt(entry.amount) <= 0:
+		frappe.throw(
+			_("Purchase Loan Ledger amount must be greater than zero for {0}.").format(entry.purchase_loan_request)
+		)
+
+	loan = loan or frappe.db.get_value(
+		"Purchase Loan Request", entry.purchase_loan_request, ["name", "employee", "company", "docstatus"], as_dict=True
+	)
+	if not loan or loan.docstatus != 1:
+		frappe.throw(_("Purchase Loan Request {0} is not submitted.").format(entry.purchase_loan_request))
+
+	if entry.company != loan.company:
+		frappe.throw(
+			_("Purchase Loan Ledger entry of {0} is posted in {1}, but the loan belongs to {2}.").format(
+				loan.name, entry.company, loan.company
+			)
+		)
+
+	if entry.employee != loan.employee:
+		frappe.throw(
+			_("Purchase Loan Ledger entry of {0} is for {1}, but the loan belongs to {2}.").format(
+				loan.name, entry.employee, loan.employee
+			)
+		)
+
+
+def on_doctype_update():
+	# Balance recomputes filter by request, cancelled flag and payment type
+	frappe.db.add_index(
+		"Purchase Loan Ledger",
+		["purchase_loan_request", "cancelled", "purchase_loan_payment_type"],
+		"purchase_loan_request_cancelled_type_index",
+	)
+	# The ledger stamp (row count and last modified) of a request is read from this index alone
+	frappe.db.add_index(
+		"Purchase Loan Ledger",
+		["purchase_loan_request", "modified"],
+		"purchase_loan_request_modified_index",
+	)
+
+
+def delete_purchase_loan_ledger(doc, method=None):
+	"""
+	on_trash of the documents the ledger links to. hooks.py lists the ledger in ignore_links_on_delete,
+	so a cancelled journal or loan can be deleted: its cancelled rows go with it, while a document that
+	still has active rows cannot be deleted.
+	"""
+	filters = {LEDGER_LINK_FIELDS[doc.doctype]: doc.name}
+	if frappe.db.exists("Purchase Loan Ledger", {**filters, "cancelled": 0}):
+		frappe.throw(
+			_("Cannot delete {0} {1} because it has active Purchase Loan Ledger entries.").format(_(doc.doctype), doc.name),
+			frappe.LinkExistsError,
+		)
+
+	frappe.db.delete("Purchase Loan Ledger", {**filters, "cancelled": 1})
@@ -1,9 +1,94 @@
 # Copyright (c) 2024, Ahmed Emam and Contributors
 # See license.txt
 
-# import frappe
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import flt
+
+from purchase_loans.purchase_loans.doctype.purchase_loan_ledger.purchase_loan_ledger import (
+	validate_purchase_loan_ledger_entry,
+)
+from purchase_loans.purchase_loans.doctype.purchase_loan_request.test_purchase_loan_request import (
+	make_ledger_row,
+	make_purchase_loan_request,
+)
+from purchase_loans.purchase_loans.tasks import (
+	apply_purchase_loan_balance_delta,
+	flush_purchase_loan_balances,
+	verify_purchase_loan_balance,
+)
 
 
 class TestPurchaseLoanLedger(FrappeTestCase):
-	pass
+	def test_invalid_rows_are_rejected(self):
+		loan = make_purchase_loan_request(request_amount=300)
+		valid = frappe._dict(
+			purchase_loan_request=loan.name,
+			purchase_loan_payment_type="Pay",
+			employee=loan.employee,
+			company=loan.company,
+			amount=100,
+		)
+		validate_purchase_loan_ledger_entry(valid)
+
+		for change in ({"amount": 0}, {"purchase_loan_payment_type": "Refund"}, {"company": "_Test Company 1"}):
+			with self.subTest(change=change):
+				self.assertRaises(frappe.ValidationError, validate_purchase_loan_ledger_entry, frappe._dict(valid, **change))
+		self.assertRaises(frappe.ValidationError, make_ledger_row, loan, cancelled=0, amount=-100)
+
+	def test_posting_delta_matches_the_ledger(self):
+		loan = make_purchase_loan_request(request_amount=300)
+		make_ledger_row(loan, cancelled=0, amount=100)
+		apply_purchase_loan_balance_delta(loan.name, paid_delta=100)
+
+		loan.reload()
+		self.assertEqual(flt(loan.paid_amount_from_request), 100)
+		self.assertEqual(flt(loan.outstanding_amount_from_request), 200)
+		self.assertEqual(verify_purchase_loan_balance(loan.name), {})
+
+	def test_savepoint_rollback_takes_the_delta_back(self):
+		loan = make_purchase_loan_request(request_amount=300)
+		frappe.db.savepoint("purchase_loan_delta")
+		make_ledger_row(loan, cancelled=0, amount=100)
+		apply_purchase_loan_balance_delta(loan.name, paid_delta=100)
+		frappe.db.rollback(save_point="purchase_loan_delta")
+
+		loan.reload()
+		self.assertEqual(flt(loan.paid_amount_from_request), 0)
+		self.assertEqual(verify_purchase_loan_balance(loan.name), {})
+
+	def test_verify_mode_checks_posted_loans_at_flush(self):
+		frappe.conf.purchase_loans_verify_balances = 1
+		self.addCleanup(frappe.conf.pop, "purchase_loans_verify_balances", None)
+
+		loan = make_purchase_loan_request(request_amount=300)
+		# A delta without its ledger row is drift
+		apply_purchase_loan_balance_delta(loan.name, paid_delta=100)
+
+		with patch(
+			"purchase_loans.purchase_loans.tasks.verify_purchase_loan_balance", wraps=verify_purchase_loan_balance
+		) as verify:
+			flush_purchase_loan_balances()
+
+		verify.assert_called_once_with(loan.name)
+		self.assertIn("paid_amount_from_request", verify_purchase_loan_balance(loan.name))
+
+	def test_deleting_a_cancelled_loan_deletes_its_cancelled_rows(self):
+		loan = make_purchase_loan_request(request_amount=100)
+		ledger = make_ledger_row(loan, cancelled=1)
+		loan.cancel()
+
+		frappe.delete_doc("Purchase Loan Request", loan.name)
+
+		self.assertFalse(frappe.db.exists("Purchase Loan Ledger", ledger.name))
+
+	def test_active_rows_block_deleting_the_loan(self):
+		loan = make_purchase_loan_request(request_amount=100)
+		ledger = make_ledger_row(loan, cancelled=0)
+		loan.cancel()
+
+		self.assertRaises(frappe.LinkExistsError, frappe.delete_doc, "Purchase Loan Request", loan.name)
+		self.assertTrue(frappe.db.exists("Purchase Loan Ledger", ledger.name))
+
@@ -61,3 +61,102 @@ frappe.ui.form.on('Purchase Loan Repayment', {
         };
     },
 });
+
+frappe.ui.form.on('Purchase Loan Repayment', {
+    onload: function(frm) {
+        // Background posting progress pushed by post_purchase_loan_repayment. The form object is
+        // reused for every repayment opened, so the handler is registered once and follows frm.doc.
+        if (frm.posting_progress_handler) {
+            return;
+        }
+        frm.posting_progress_handler = function(data) {
+            if (data.doctype !== frm.doctype || data.name !== frm.doc.name) {
+                return;
+            }
+            if (data.status === 'In Progress' && data.total) {
+                frm.dashboard.show_progress(__('Posting Journal Entries'), (data.progress / data.total) * 100,
+                    __('{0} of {1} posted', [data.progress, data.total]));
+            } else {
+                frm.dashboard.hide_progress();
+                frm.reload_doc();
+            }
+        };
+        frappe.realtime.on('purchase_loan_repayment_posting', frm.posting_progress_handler);
+    },
+
+    refresh: function(frm) {
+        if (frm.doc.docstatus === 1 && frm.doc.posting_status === 'Failed') {
+            frm.dashboard.set_headline_alert(__('Posting of the Journal Entries failed. See Posting Error for details.'), 'red');
+            frm.add_custom_button(__('Retry Posting'), function() {
+                frappe.call({
+                    method: 'purchase_loans.purchase_loans.doctype.purchase_loan_repayment.purchase_loan_repayment.retry_repayment_posting',
+                    args: { purchase_loan_repayment: frm.doc.name },
+                    callback: function() {
+                        frm.reload_doc();
+                    }
+                });
+            });
+        } else if (['Queued', 'In Progress'].includes(frm.doc.posting_status)) {
+            frm.dashboard.set_headline_alert(__('Journal Entries are being posted in the background.'), 'blue');
+        }
+    }
+});
+
+frappe.ui.form.on('Purchase Loan Repayment', {
+    refresh: function(frm) {
+        if (frm.doc.docstatus === 0 && frm.doc.employee && frm.doc.purchase_loan_request) {
+            frm.add_custom_button(__('Fill Repayment'), function() {
+                fill_repayment_invoices(frm);
+            });
+        }
+    }
+});
+
+// Replaces the invoice rows with the allocator's proposal for this repayment's loan
+function fill_repayment_invoices(frm) {
+    frappe.prompt([
+        {
+            label: __('Allocation Strategy'),
+            fieldname: 'strategy',
+            fieldtype: 'Select',
+            options: ['FIFO', 'Best Fit'],
+            default: 'FIFO',
+            reqd: 1
+        }
+    ], function(values) {
+        frappe.call({
+            method: 'purchase_loans.purchase_loans.doctype.purchase_loan_repayment.purchase_loan_repayment.get_invoice_allocation',
+            args: {
+                employee: frm.doc.employee,
+                company: frm.doc.company,
+                strategy: values.strategy,
+                purchase_loan_request: frm.doc.purchase_loan_request,
+                exclude_repayment: frm.is_new() ? null : frm.doc.name
+            },
+            freeze: true,
+            callback: function(response) {
+                const allocation = (response.message.allocations || [])[0];
+                if (!allocation || !allocation.invoices.length) {
+                    frappe.msgprint(__('No outstanding invoices fit the remaining amount of this loan.'));
+                    return;
+                }
+
+                frm.clear_table('purchase_loan_repayment_invoices');
+                allocation.invoices.forEach(function(invoice) {
+                    frm.add_child('purchase_loan_repayment_invoices', invoice);
+                });
+                frm.refresh_field('purchase_loan_repayment_invoices');
+                frm.dirty();
+
+                frappe.show_alert({
+                    message: __('{0} invoices added ({1} of {2})', [
+                        allocation.invoices.length,
+                        format_currency(allocation.allocated, allocation.currency),
+                        format_currency(allocation.capacity, allocation.currency)
+                    ]),
+                    indicator: 'green'
+                });
+            }
+        });
+    }, __('Fill Repayment'), __('Fill'));
+}
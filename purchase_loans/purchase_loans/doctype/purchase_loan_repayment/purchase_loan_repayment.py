@@ -1,48 +1,116 @@
 import frappe
 from frappe import _
 from frappe.model.document import Document
-from purchase_loans.purchase_loans.tasks import create_purchase_loan_ledger
+from frappe.utils import flt
+from purchase_loans.purchase_loans.attachments import copy_attachments
+from purchase_loans.purchase_loans.tasks import cancel_journal_entries_in_bulk, create_purchase_loan_ledger
+from purchase_loans.purchase_loans.company_settings import get_loan_company_settings
 import logging
 
 
 class PurchaseLoanRepayment(Document):
 
 
+    def before_cancel(self):
+        if self.posting_status in ("Queued", "In Progress"):
+            frappe.throw(_("Journal Entries of this repayment are still being posted. Please try again once posting has finished."))
+
     def on_cancel(self):
         # Fetch all Journal Entries linked to this Purchase Loan Repayment
         """
         Cancels all journal entries linked to this Purchase Loan Repayment and updates the linked Purchase Loan Request.
 
-        Fetches all Journal Entries linked to this Purchase Loan Repayment and triggers cancel for each one.
-        This ensures that the Purchase Loan Request is properly updated and that the repayment amount is subtracted from the outstanding amount.
+        The journals are cancelled in bulk: their ledger rows are flagged with one UPDATE, the settled
+        invoices are restored with one UPDATE and the loan balance is updated once at commit.
         """
         journal_entries = frappe.get_all(
             "Journal Entry",
-            filters={"custom_purchase_loan_repayment": self.name},
-            pluck="name"
+            filters={"custom_purchase_loan_repayment": self.name, "docstatus": 1},
+            fields=["name", "voucher_type", "custom_row_name"]
         )
-        
-        # Trigger cancel for each Journal Entry
-        for je in journal_entries:
-            journal_entry_doc = frappe.get_doc("Journal Entry", je)
-            if journal_entry_doc.docstatus == 1:  # Ensure the document is submitted
-                journal_entry_doc.cancel()
-                    
+
+        settled_invoices = set()
+        for journal_entry in journal_entries:
+            if journal_entry.voucher_type != "Purchase Loan Settlement Invoice":
+                continue
+            if journal_entry.custom_row_name:
+                settled_invoices.add(journal_entry.custom_row_name)
+            else:
+                # A consolidated settlement covers every invoice of the repayment
+                settled_invoices.update(row.purchase_invoice for row in self.purchase_loan_repayment_invoices)
+
+        cancel_journal_entries_in_bulk([journal_entry.name for journal_entry in journal_entries])
+
+        update_purchase_invoice_outstanding(
+            {
+                row.purchase_invoice: row.outstanding_amount
+                for row in self.purchase_loan_repayment_invoices
+                if row.purchase_invoice in settled_invoices
+            },
+            "Overdue"
+        )
+
+
     def on_submit(self):
-        """Creates journal entries upon submission for expenses and invoices."""
+        """
+        Creates journal entries upon submission for expenses and invoices. Companies that post loan
+        repayments in background only validate here and queue the posting on the long queue.
+        """
         self._validate_repayment_amount()
         if not self.is_new():
 
             self._set_direct_approver()
 
+        if get_loan_company_settings(self.company).post_loan_repayments_in_background:
+            self.db_set({"posting_status": "Queued", "posting_error": None})
+            enqueue_repayment_posting(self.name)
+            frappe.msgprint(_("Journal Entries for this repayment are being posted in the background."), alert=True)
+            return
+
+        self.post_journal_entries()
+
+    def post_journal_entries(self):
+        """Posts the expense and invoice Journal Entries of the repayment."""
+        self.flags.consolidate_settlement = bool(
+            self.purchase_loan_repayment_invoices
+            and get_loan_company_settings(self.company).consolidate_loan_settlement_journal
+        )
+        self._posting_steps = (1 if self.total_other_expenses > 0 else 0) + (
+            1 if self.flags.consolidate_settlement else len(self.purchase_loan_repayment_invoices)
+        )
+        self._posted_steps = 0
+
         # Create journal entry for other expenses if applicable
         if self.total_other_expenses > 0:
             self._create_journal_entry_for_expenses()
+            self._report_posting_progress()
 
         # Create journal entry for invoices if there are rows in purchase_loan_repayment_invoices
-        if self.purchase_loan_repayment_invoices:
+        if self.flags.consolidate_settlement:
+            self._create_consolidated_journal_entry_for_invoices()
+            self._report_posting_progress()
+        elif self.purchase_loan_repayment_invoices:
             self._create_journal_entry_for_invoices()
 
+    def _report_posting_progress(self):
+        """Pushes posting progress to open forms of this repayment when it is posted in background."""
+        self._posted_steps += 1
+        if not self.flags.posting_in_background:
+            return
+
+        frappe.publish_realtime(
+            "purchase_loan_repayment_posting",
+            {
+                "doctype": self.doctype,
+                "name": self.name,
+                "status": "In Progress",
+                "progress": self._posted_steps,
+                "total": self._posting_steps,
+            },
+            doctype=self.doctype,
+            docname=self.name,
+        )
+
     @frappe.whitelist()
     def _set_direct_approver(self):
         """Fetch and set the direct approver for the Purchase Order and share the document if not already shared."""
@@ -55,78 +123,20 @@ class PurchaseLoanRepayment(Document):
     @frappe.whitelist()
     def _copy_attachments_to_target(self, target_doctype, target_docname, source_doctype, source_name):
         """
-        Copies all attachments from a source doctype to a target doctype based on a shared Transaction Unique ID.
-        Before inserting, it checks if the file is already attached to the target document.
+        Copies all attachments of a source document to a target document, skipping the files the
+        target already has. Errors are logged and do not stop the posting.
 
         Args:
-            target_doctype (str): The target doctype to attach files to (e.g., "Purchase Invoice").
+            target_doctype (str): The target doctype to attach files to (e.g., "Journal Entry").
             target_docname (str): The target document name to attach files to.
-            source_doctype (str): The source doctype to fetch attachments from (e.g., "Purchase Order").
+            source_doctype (str): The source doctype to fetch attachments from (e.g., "Purchase Loan Repayment").
             source_name (str): The source document name.
-
-        Raises:
-            frappe.ValidationError: If the source document or attachments are not found.
         """
         try:
-            # Fetch the target document
-            target_doc = frappe.get_doc(target_doctype, target_docname)
-
-            # Find the source documents with the same Transaction Unique ID
-            source_docs = frappe.get_all(
-                source_doctype,
-                filters={"name": source_name},
-                fields=["name"]
-            )
-
-            if not source_docs:
-                frappe.throw(
-                    _(f"No {source_doctype} found with the name: {source_name}")
-                )
-
-            # Fetch the first matching source document (adjust if multiple matches are expected)
-            source_docname = source_docs[0].get("name")
-
-            # Get all attachments linked to the source document
-            attachments = frappe.get_all(
-                "File",
-                filters={"attached_to_doctype": source_doctype, "attached_to_name": source_docname},
-                fields=["file_url", "file_name"]
-            )
-
-            if not attachments:
-                return
-
-            # Attach files to the target document
-            for attachment in attachments:
-                # Check if the file is already attached to the target document
-                existing_attachment = frappe.get_all(
-                    "File",
-                    filters={
-                        "attached_to_doctype": target_doctype,
-                        "attached_to_name": target_docname,
-                        "file_url": attachment["file_url"],
-                        "file_name": attachment["file_name"]
-                    },
-                    fields=["name"]
-                )
-
-                if existing_attachment:
-                    
-                    continue  # Skip if file is already attached
-
-                # If file is not attached, add it
-                frappe.get_doc({
-                    "doctype": "File",
-                    "file_url": attachment["file_url"],
-                    "file_name": attachment["file_name"],
-                    "attached_to_doctype": target_doctype,
-                    "attached_to_name": target_docname
-                }).insert(ignore_permissions=True)
-
+            copy_attachments(source_doctype, source_name, target_doctype, target_docname)
         except Exception as e:
             frappe.log_error(f"Error in copying attachments: {str(e)}")
-            
-            
+
     def _create_journal_entry_for_expenses(self):
         """Creates a journal entry for other expenses in the loan repayment."""
 
@@ -187,9 +197,7 @@ class PurchaseLoanRepayment(Document):
         currency, exchange_rate = purchase_loan_request.currency, purchase_loan_request.exchange_rate
 
         # Fetch company default currency and exchange gain/loss account
-        company_details = frappe.db.get_value(
-            "Company", company, ["default_currency", "exchange_gain_loss_account"], as_dict=True
-        )
+        company_details = get_loan_company_settings(company)
 
         if not company_details.default_currency:
             frappe.throw(_("Default currency is not set for the company {0}. Please configure it in Company settings.")
@@ -199,8 +207,9 @@ class PurchaseLoanRepayment(Document):
             frappe.throw(_("Exchange Gain or Loss Account is not set for the company {0}. Please configure it in Company settings.")
                         .format(company))
 
+        invoices = self._get_purchase_invoice_details()
         for row in self.purchase_loan_repayment_invoices:
-            purchase_invoice = frappe.get_doc("Purchase Invoice", row.purchase_invoice)
+            purchase_invoice = invoices[row.purchase_invoice]
             purchase_invoice_currency = purchase_invoice.currency
             purchase_invoice_exchange_rate = purchase_invoice.conversion_rate
 
@@ -245,7 +254,7 @@ class PurchaseLoanRepayment(Document):
                     }
                 ]
             })
-            journal_entries.append(journal_entry)
+            journal_entries.append((journal_entry, amount_from_loan))
 
             # Handle exchange difference if applicable
             if exchange_difference:
@@ -279,15 +288,19 @@ class PurchaseLoanRepayment(Document):
                 })
                 exchange_difference_entries.append(exchange_difference_entry)
 
-            # Mark invoice as paid in bulk update
-            purchase_invoice.db_set({"status": "Paid", "outstanding_amount": 0})
+
+        # Mark invoices as paid in bulk update
+        update_purchase_invoice_outstanding(
+            {row.purchase_invoice: 0 for row in self.purchase_loan_repayment_invoices}, "Paid"
+        )
 
         # Insert and submit all journal entries in bulk
-        for journal_entry in journal_entries:
+        for journal_entry, amount_from_loan in journal_entries:
             journal_entry.insert(ignore_permissions=True)
             journal_entry.submit()
             create_purchase_loan_ledger(journal_entry, amount_from_loan)
             self._copy_attachments_to_target("Journal Entry", journal_entry.name, self.doctype, self.name)
+            self._report_posting_progress()
 
         for exchange_difference_entry in exchange_difference_entries:
             exchange_difference_entry.insert(ignore_permissions=True)
@@ -300,16 +313,98 @@ class PurchaseLoanRepayment(Document):
 
 
 
+    def _create_consolidated_journal_entry_for_invoices(self):
+        """
+        Posts all invoices of the repayment in one "Purchase Loan Settlement Invoice" Journal Entry:
+        a supplier debit row per invoice (against that invoice), a single employee credit for the
+        whole amount taken from the loan and a single row for the netted exchange difference.
+        """
+        purchase_loan_request = frappe.get_doc("Purchase Loan Request", self.purchase_loan_request)
+        company = purchase_loan_request.company
+        exchange_rate = purchase_loan_request.exchange_rate
+
+        exchange_gain_loss_account = get_loan_company_settings(company).exchange_gain_loss_account
+        if not exchange_gain_loss_account:
+            frappe.throw(_("Exchange Gain or Loss Account is not set for the company {0}. Please configure it in Company settings.")
+                        .format(company))
+
+        invoices = self._get_purchase_invoice_details()
+
+        accounts, total_from_loan, total_exchange_difference = [], 0.0, 0.0
+        for row in self.purchase_loan_repayment_invoices:
+            purchase_invoice = invoices[row.purchase_invoice]
+            amount_to_supplier = row.outstanding_amount * purchase_invoice.conversion_rate
+            amount_from_loan = row.outstanding_amount * exchange_rate
+            total_from_loan += amount_from_loan
+            total_exchange_difference += amount_from_loan - amount_to_supplier
+
+            accounts.append({
+                "account": purchase_invoice.credit_to,
+                "party_type": "Supplier",
+                "party": purchase_invoice.supplier,
+                "account_currency": purchase_invoice.currency,
+                "exchange_rate": purchase_invoice.conversion_rate,
+                "debit_in_account_currency": amount_to_supplier,
+                "debit": amount_to_supplier / purchase_invoice.conversion_rate,
+                "against_voucher_type": "Purchase Invoice",
+                "against_voucher": row.purchase_invoice,
+                "reference_type": "Purchase Loan Request",
+                "reference_name": self.purchase_loan_request
+            })
+
+        accounts.append({
+            "account": self.default_account,
+            "party_type": "Employee",
+            "party": self.employee,
+            "credit_in_account_currency": total_from_loan,
+            "credit": total_from_loan,
+            "reference_type": "Purchase Loan Request",
+            "reference_name": self.purchase_loan_request
+        })
+
+        if total_exchange_difference:
+            accounts.append({
+                "account": exchange_gain_loss_account,
+                "debit_in_account_currency" if total_exchange_difference > 0 else "credit_in_account_currency": abs(total_exchange_difference),
+                "debit" if total_exchange_difference > 0 else "credit": abs(total_exchange_difference),
+                "reference_type": "Purchase Loan Request",
+                "reference_name": self.purchase_loan_request
+            })
+
+        journal_entry = frappe.get_doc({
+            "doctype": "Journal Entry",
+            "voucher_type": "Purchase Loan Settlement Invoice",
+            "posting_date": frappe.utils.nowdate(),
+            "custom_purchase_loan_request": self.purchase_loan_request,
+            "custom_purchase_loan_repayment": self.name,
+            "company": company,
+            "multi_currency": 1,
+            "user_remark": _("Repayment for Purchase Loan Request: {0}").format(self.purchase_loan_request),
+            "accounts": accounts
+        })
+        journal_entry.insert(ignore_permissions=True)
+        journal_entry.submit()
+        create_purchase_loan_ledger(journal_entry, total_from_loan)
+        self._copy_attachments_to_target("Journal Entry", journal_entry.name, self.doctype, self.name)
+
+        update_purchase_invoice_outstanding(
+            {row.purchase_invoice: 0 for row in self.purchase_loan_repayment_invoices}, "Paid"
+        )
+
+        self.db_update()
+        purchase_loan_request.reload()
+
     def validate(self):
         
         """Validates duplicate entries and repayment constraints."""
 
         self._validate_duplicate_entries()
+        invoices = self._get_purchase_invoice_details()
         for row in self.purchase_loan_repayment_invoices:
             # Fetch party and invoice details
             party_account = row.party_account
             party_currency = row.party_currency
-            purchase_invoice = frappe.get_doc("Purchase Invoice", row.purchase_invoice)
+            purchase_invoice = invoices[row.purchase_invoice]
             purchase_invoice_currency = purchase_invoice.currency
             purchase_invoice_exchange_rate = purchase_invoice.conversion_rate
             if party_currency != purchase_invoice_currency :
@@ -330,6 +425,28 @@ class PurchaseLoanRepayment(Document):
         self.overpayment = abs(outstanding_diff) if outstanding_diff < 0 else 0
 
 
+    def _get_purchase_invoice_details(self):
+        """
+        Reads the fields used from every invoice of the repayment in one query. The result is kept on
+        the document, so validate and the posting on submit share it.
+        """
+        invoice_names = {row.purchase_invoice for row in self.purchase_loan_repayment_invoices if row.purchase_invoice}
+        cached = getattr(self, "_purchase_invoice_details", None)
+        if cached is None or not invoice_names.issubset(cached):
+            cached = self._purchase_invoice_details = {
+                invoice.name: invoice
+                for invoice in frappe.get_all(
+                    "Purchase Invoice",
+                    filters={"name": ["in", list(invoice_names)]},
+                    fields=["name", "supplier", "credit_to", "currency", "conversion_rate", "outstanding_amount"],
+                )
+            } if invoice_names else {}
+
+        missing = invoice_names.difference(cached)
+        if missing:
+            frappe.throw(_("Purchase Invoice {0} not found").format(", ".join(sorted(missing))))
+        return cached
+
     def _validate_duplicate_entries(self):
         """Check for duplicate entries in invoices and expenses tables."""
         # Validate duplicates in 'purchase_loan_repayment_invoices'
@@ -359,11 +476,10 @@ class PurchaseLoanRepayment(Document):
             frappe.throw(_("Repayment amount must be greater than zero."))
 
         # Fetch company record and check the custom setting
-        company_record = frappe.get_doc("Company", self.company)
-        custom_allow_repayment_beyond_loan_amount = company_record.custom_allow_repayment_beyond_loan_amount
+        allow_repayment_beyond_loan_amount = get_loan_company_settings(self.company).allow_repayment_beyond_loan_amount
 
         # Check if repayment exceeds outstanding amount and handle based on company setting
-        if self.total_repayment_amount > self.outstanding_amount and custom_allow_repayment_beyond_loan_amount == "No":
+        if self.total_repayment_amount > self.outstanding_amount and not allow_repayment_beyond_loan_amount:
             frappe.throw(_("Repayment amount cannot exceed the outstanding loan amount."))
 
     def _validate_currency(self):
@@ -379,3 +495,219 @@ class PurchaseLoanRepayment(Document):
                     frappe.throw(_("Currency ({}) does not match the loan request currency ({})").format(row.currency, currency))
             
 
+
+def update_purchase_invoice_outstanding(outstanding_amounts, status):
+    """Sets the status and outstanding amount ({invoice: amount}) of many Purchase Invoices in one UPDATE."""
+    if not outstanding_amounts:
+        return
+
+    invoices = list(outstanding_amounts)
+    frappe.db.sql(
+        f"""
+        UPDATE `tabPurchase Invoice`
+        SET outstanding_amount = CASE name {" ".join(["WHEN %s THEN %s"] * len(invoices))} END,
+            status = %s, modified = %s, modified_by = %s
+        WHERE name IN %s
+        """,
+        (
+            *(value for invoice in invoices for value in (invoice, outstanding_amounts[invoice])),
+            status,
+            frappe.utils.now(),
+            frappe.session.user,
+            tuple(invoices),
+        ),
+    )
+
+
+def enqueue_repayment_posting(purchase_loan_repayment):
+    frappe.enqueue(
+        post_purchase_loan_repayment,
+        queue="long",
+        timeout=3600,
+        job_id=f"purchase_loan_repayment_posting::{purchase_loan_repayment}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        purchase_loan_repayment=purchase_loan_repayment,
+    )
+
+
+def post_purchase_loan_repayment(purchase_loan_repayment):
+    """
+    Background job that posts the Journal Entries of a submitted repayment. Everything it posts is
+    rolled back if any entry fails, and the repayment is marked Failed with the error so it can be
+    retried.
+    """
+    repayment = frappe.get_doc("Purchase Loan Repayment", purchase_loan_repayment)
+    if repayment.docstatus != 1 or repayment.posting_status != "Queued":
+        return
+
+    repayment.db_set("posting_status", "In Progress")
+    frappe.db.commit()
+
+    try:
+        repayment.flags.posting_in_background = True
+        repayment.post_journal_entries()
+        repayment.db_set({"posting_status": "Completed", "posting_error": None})
+        frappe.db.commit()
+    except Exception:
+        frappe.db.rollback()
+        error = frappe.get_traceback()
+        frappe.db.set_value(
+            "Purchase Loan Repayment",
+            purchase_loan_repayment,
+            {"posting_status": "Failed", "posting_error": error},
+            update_modified=False,
+        )
+        frappe.db.commit()
+        frappe.log_error(title=_("Purchase Loan Repayment Posting Failed"), message=error, reference_doctype="Purchase Loan Repayment", reference_name=purchase_loan_repayment)
+
+    frappe.publish_realtime(
+        "purchase_loan_repayment_posting",
+        {
+            "doctype": "Purchase Loan Repayment",
+            "name": purchase_loan_repayment,
+            "status": frappe.db.get_value("Purchase Loan Repayment", purchase_loan_repayment, "posting_status"),
+        },
+        doctype="Purchase Loan Repayment",
+        docname=purchase_loan_repayment,
+    )
+
+
+@frappe.whitelist()
+def retry_repayment_posting(purchase_loan_repayment):
+    """Queues the posting of a repayment whose background posting failed."""
+    repayment = frappe.get_doc("Purchase Loan Repayment", purchase_loan_repayment)
+    repayment.check_permission("submit")
+    if repayment.posting_status != "Failed":
+        frappe.throw(_("Only repayments whose posting failed can be retried."))
+
+    repayment.db_set("posting_status", "Queued")
+    enqueue_repayment_posting(repayment.name)
+
+
+@frappe.whitelist()
+def get_invoice_allocation(employee, company=None, strategy="FIFO", purchase_loan_request=None, exclude_repayment=None):
+    """
+    Proposes how the employee's outstanding Purchase Invoices can be settled from their open
+    Purchase Loan Requests. An invoice is only placed on a loan of its own currency and is never
+    split. Capacity is the loan's outstanding repayment amount less what other draft repayments
+    of the loan already claim.
+
+    strategy:
+        "FIFO"      oldest invoice first, onto the oldest loan that can take it.
+        "Best Fit"  largest invoice first, onto the loan it leaves with the least capacity.
+
+    Returns {"allocations": [{purchase_loan_request, currency, capacity, allocated, invoices}], "unallocated": [...]}
+    where invoices are ready-made Purchase Loan Repayment Invoices rows.
+    """
+    frappe.has_permission("Purchase Loan Repayment", "create", throw=True)
+    if strategy not in ("FIFO", "Best Fit"):
+        frappe.throw(_("Allocation strategy must be FIFO or Best Fit."))
+
+    loans = _get_open_loans_for_allocation(employee, company, purchase_loan_request, exclude_repayment)
+    invoices = _get_outstanding_invoices_for_allocation(employee, company, exclude_repayment)
+
+    allocations = {
+        loan.name: {
+            "purchase_loan_request": loan.name,
+            "currency": loan.currency,
+            "capacity": loan.capacity,
+            "allocated": 0.0,
+            "invoices": [],
+        }
+        for loan in loans
+    }
+
+    if strategy == "Best Fit":
+        invoices.sort(key=lambda invoice: invoice.outstanding_amount, reverse=True)
+
+    unallocated = []
+    for invoice in invoices:
+        candidates = [
+            allocation for allocation in allocations.values()
+            if allocation["currency"] == invoice.currency
+            and allocation["capacity"] - allocation["allocated"] >= invoice.outstanding_amount - 0.005
+        ]
+        if not candidates:
+            unallocated.append(invoice)
+            continue
+
+        if strategy == "Best Fit":
+            target = min(candidates, key=lambda allocation: allocation["capacity"] - allocation["allocated"] - invoice.outstanding_amount)
+        else:
+            # Loans are already ordered oldest first
+            target = candidates[0]
+
+        target["allocated"] += invoice.outstanding_amount
+        target["invoices"].append(invoice)
+
+    return {"allocations": list(allocations.values()), "unallocated": unallocated}
+
+
+def _get_open_loans_for_allocation(employee, company=None, purchase_loan_request=None, exclude_repayment=None):
+    conditions = ["plr.employee = %(employee)s", "plr.docstatus = 1", "IFNULL(plr.closed, 0) = 0"]
+    values = {"employee": employee, "exclude_repayment": exclude_repayment or ""}
+    if company:
+        conditions.append("plr.company = %(company)s")
+        values["company"] = company
+    if purchase_loan_request:
+        conditions.append("plr.name = %(purchase_loan_request)s")
+        values["purchase_loan_request"] = purchase_loan_request
+
+    return frappe.db.sql(
+        f"""
+        SELECT plr.name, plr.currency,
+            plr.outstanding_amount_from_repayment - IFNULL(SUM(draft.total_repayment_amount), 0) AS capacity
+        FROM `tabPurchase Loan Request` plr
+        LEFT JOIN `tabPurchase Loan Repayment` draft
+            ON draft.purchase_loan_request = plr.name AND draft.docstatus = 0 AND draft.name != %(exclude_repayment)s
+        WHERE {" AND ".join(conditions)}
+        GROUP BY plr.name
+        HAVING capacity > 0
+        ORDER BY plr.posting_date, plr.creation
+        """,
+        values,
+        as_dict=True,
+    )
+
+
+def _get_outstanding_invoices_for_allocation(employee, company=None, exclude_repayment=None):
+    """Submitted unpaid invoices of the employee that no other draft repayment has picked yet, oldest first."""
+    conditions = ["pi.custom_employee = %(employee)s", "pi.docstatus = 1", "pi.outstanding_amount > 0"]
+    values = {"employee": employee, "exclude_repayment": exclude_repayment or ""}
+    if company:
+        conditions.append("pi.company = %(company)s")
+        values["company"] = company
+
+    invoices = frappe.db.sql(
+        f"""
+        SELECT pi.name AS purchase_invoice, pi.supplier, pi.currency, pi.conversion_rate,
+            pi.outstanding_amount AS invoice_outstanding_amount, pi.credit_to AS party_account,
+            account.account_currency AS party_currency
+        FROM `tabPurchase Invoice` pi
+        LEFT JOIN `tabAccount` account ON account.name = pi.credit_to
+        WHERE {" AND ".join(conditions)}
+            AND NOT EXISTS (
+                SELECT 1
+                FROM `tabPurchase Loan Repayment Invoices` picked
+                JOIN `tabPurchase Loan Repayment` repayment ON repayment.name = picked.parent
+                WHERE picked.purchase_invoice = pi.name
+                    AND picked.parenttype = 'Purchase Loan Repayment'
+                    AND repayment.docstatus = 0
+                    AND repayment.name != %(exclude_repayment)s
+            )
+        ORDER BY pi.posting_date, pi.creation
+        """,
+        values,
+        as_dict=True,
+    )
+
+    for invoice in invoices:
+        # Same conversion as PurchaseLoanRepayment.validate
+        if invoice.party_currency != invoice.currency:
+            invoice.outstanding_amount = flt(invoice.invoice_outstanding_amount) / (flt(invoice.conversion_rate) or 1)
+        else:
+            invoice.outstanding_amount = flt(invoice.invoice_outstanding_amount)
+        del invoice["invoice_outstanding_amount"], invoice["conversion_rate"]
+
+    return invoices
@@ -1,9 +1,119 @@
 # Copyright (c) 2024, Ahmed Emam and Contributors
 # See license.txt
 
-# import frappe
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import flt, today
+
+from purchase_loans.purchase_loans.company_settings import get_loan_company_settings
+from purchase_loans.purchase_loans.doctype.purchase_loan_repayment.purchase_loan_repayment import get_invoice_allocation
+from purchase_loans.purchase_loans.doctype.purchase_loan_request.purchase_loan_request import pay_to_employee
+from purchase_loans.purchase_loans.doctype.purchase_loan_request.test_purchase_loan_request import (
+	MODE_OF_PAYMENT,
+	TEST_COMPANY,
+	make_employee,
+	make_purchase_loan_request,
+	post_ledger_amount,
+	skip_without_loan_accounts,
+)
 
 
 class TestPurchaseLoanRepayment(FrappeTestCase):
-	pass
+	def test_allocation_strategies(self):
+		employee = make_employee("_Test Allocation Employee")
+		older_loan = make_purchase_loan_request(request_amount=300, employee=employee)
+		newer_loan = make_purchase_loan_request(request_amount=300, employee=employee)
+		post_ledger_amount(older_loan, "Pay", 100)
+		post_ledger_amount(newer_loan, "Pay", 60)
+		invoices = [
+			make_allocation_invoice("_Test PI 1", older_loan.currency, 40),
+			make_allocation_invoice("_Test PI 2", older_loan.currency, 60),
+			make_allocation_invoice("_Test PI 3", "_Test Other Currency", 10),
+		]
+
+		def allocate(strategy):
+			with patch(
+				"purchase_loans.purchase_loans.doctype.purchase_loan_repayment.purchase_loan_repayment._get_outstanding_invoices_for_allocation",
+				return_value=[frappe._dict(invoice) for invoice in invoices],
+			):
+				result = get_invoice_allocation(employee, TEST_COMPANY, strategy)
+			allocated = {
+				allocation["purchase_loan_request"]: [invoice.purchase_invoice for invoice in allocation["invoices"]]
+				for allocation in result["allocations"]
+			}
+			return allocated, [invoice.purchase_invoice for invoice in result["unallocated"]]
+
+		# FIFO fills the oldest loan first
+		allocated, unallocated = allocate("FIFO")
+		self.assertEqual(allocated, {older_loan.name: ["_Test PI 1", "_Test PI 2"], newer_loan.name: []})
+		self.assertEqual(unallocated, ["_Test PI 3"])
+
+		# Best Fit places the largest invoice on the loan it fits most tightly
+		allocated, unallocated = allocate("Best Fit")
+		self.assertEqual(allocated, {older_loan.name: ["_Test PI 1"], newer_loan.name: ["_Test PI 2"]})
+		self.assertEqual(unallocated, ["_Test PI 3"])
+
+	def test_consolidated_settlement_posts_one_journal(self):
+		skip_without_loan_accounts(self)
+		company_settings = get_loan_company_settings(TEST_COMPANY)
+		if not company_settings.exchange_gain_loss_account:
+			self.skipTest("Exchange Gain/Loss Account is not set on the test company")
+		from erpnext.accounts.doctype.purchase_invoice.test_purchase_invoice import make_purchase_invoice
+
+		employee = make_employee("_Test Settlement Employee")
+		loan = make_purchase_loan_request(request_amount=300, employee=employee)
+		pay_to_employee(loan.name, loan.company, employee, MODE_OF_PAYMENT, 200, today())
+
+		invoices = []
+		for rate in (30, 70):
+			invoice = make_purchase_invoice(company=TEST_COMPANY, currency=loan.currency, qty=1, rate=rate, do_not_submit=True)
+			invoice.custom_employee = employee
+			invoice.submit()
+			invoices.append(invoice)
+
+		repayment = frappe.get_doc({
+			"doctype": "Purchase Loan Repayment",
+			"posting_date": today(),
+			"employee": employee,
+			"company": TEST_COMPANY,
+			"purchase_loan_request": loan.name,
+			"default_account": company_settings.purchase_loan_account,
+			"purchase_loan_repayment_invoices": [
+				{
+					"purchase_invoice": invoice.name,
+					"supplier": invoice.supplier,
+					"currency": invoice.currency,
+					"party_account": invoice.credit_to,
+					"party_currency": frappe.get_cached_value("Account", invoice.credit_to, "account_currency"),
+				}
+				for invoice in invoices
+			],
+		}).insert()
+		repayment._create_consolidated_journal_entry_for_invoices()
+
+		journal_entries = frappe.get_all(
+			"Journal Entry",
+			filters={"custom_purchase_loan_repayment": repayment.name, "docstatus": 1},
+			fields=["name", "voucher_type", "custom_row_name"],
+		)
+		self.assertEqual(len(journal_entries), 1)
+		self.assertEqual(journal_entries[0].voucher_type, "Purchase Loan Settlement Invoice")
+		self.assertFalse(journal_entries[0].custom_row_name)
+		for invoice in invoices:
+			self.assertEqual(flt(frappe.db.get_value("Purchase Invoice", invoice.name, "outstanding_amount")), 0)
+		loan.reload()
+		self.assertEqual(flt(loan.repaid_amount), 100)
+		self.assertEqual(flt(loan.outstanding_amount_from_repayment), 100)
+
+
+def make_allocation_invoice(name, currency, outstanding_amount):
+	return {
+		"purchase_invoice": name,
+		"supplier": "_Test Supplier",
+		"currency": currency,
+		"party_account": None,
+		"party_currency": currency,
+		"outstanding_amount": outstanding_amount,
+	}
@@ -2,16 +2,19 @@
 
 frappe.ui.form.on("Purchase Loan Request", {
     onload: function(frm) {
-        // Check if the document is not new (not local)
-        if (!frm.is_new()) {
-            // Call the server-side function to update the request
+        // Check if the document is submitted (drafts have no ledger rows)
+        if (frm.doc.docstatus === 1) {
+            // Read the balances; the server only recomputes them when the ledger changed
             frappe.call({
-                method: "purchase_loans.purchase_loans.tasks.update_purchase_loan_request",
+                method: "purchase_loans.purchase_loans.tasks.get_purchase_loan_balance",
+                type: "GET",
                 args: {
                     purchase_loan_request_name: frm.doc.name
                 },
                 callback: function(response) {
-                    
+                    if (response.message && response.message.recomputed) {
+                        frm.reload_doc();
+                    }
                 }
             });
         }
@@ -46,6 +49,13 @@ frappe.ui.form.on("Purchase Loan Request", {
                     });
                 }
 
+                // Nets this employee's owing and overpaid loans against each other without moving cash
+                if (frm.doc.repaid_amount !== frm.doc.paid_amount_from_request) {
+                    frm.add_custom_button(__('Net Employee Loans'), function() {
+                        net_employee_loans(frm);
+                    });
+                }
+
                 // Display "Close" button if the repaid_amount equals paid_amount_from_request
                 if (frm.doc.repaid_amount === frm.doc.paid_amount_from_request) {
                     frm.add_custom_button(__('Close'), function() {
@@ -151,13 +161,20 @@ function pay_to_employee(frm, mode_of_payment, payment_amount, payment_date) {
             employee: frm.doc.employee,
             mode_of_payment: mode_of_payment,
             payment_amount: payment_amount,
-            payment_date: payment_date
+            payment_date: payment_date,
+            idempotency_key: get_idempotency_key(frm, 'pay_to_employee', [mode_of_payment, payment_amount, payment_date])
         },
         callback: function(response) {
             if (response.message) {
+                clear_idempotency_key(frm, 'pay_to_employee');
                 frappe.msgprint(__('Payment to employee successfully recorded.'));
                 frm.reload_doc();
             }
+        },
+        error: function(response) {
+            if (response && (response.exc || response._server_messages)) {
+                clear_idempotency_key(frm, 'pay_to_employee');
+            }
         }
     });
 }
@@ -263,13 +280,84 @@ function create_repay_cash(frm, mode_of_payment, repay_amount, payment_date) {
             employee: frm.doc.employee,
             mode_of_payment: mode_of_payment,
             payment_amount: repay_amount,
-            payment_date: payment_date
+            payment_date: payment_date,
+            idempotency_key: get_idempotency_key(frm, 'create_repay_cash', [mode_of_payment, repay_amount, payment_date])
         },
         callback: function(response) {
             if (response.message) {
+                clear_idempotency_key(frm, 'create_repay_cash');
                 frappe.msgprint(__('Repayment successfully recorded.'));
                 frm.reload_doc();  
             }
+        },
+        error: function(response) {
+            // A server-side error settled the attempt; a timeout keeps the key so a retry is not posted twice
+            if (response && (response.exc || response._server_messages)) {
+                clear_idempotency_key(frm, 'create_repay_cash');
+            }
         }
     });
 }
+
+// Shows the netting settlements of the employee's open loans and posts them once confirmed
+function net_employee_loans(frm) {
+    const method = "purchase_loans.purchase_loans.doctype.purchase_loan_request.purchase_loan_request.net_employee_loans";
+    const args = { employee: frm.doc.employee, company: frm.doc.company };
+    frappe.call({
+        method: method,
+        args: Object.assign({ dry_run: 1 }, args),
+        callback: function(response) {
+            const settlements = (response.message && response.message.settlements) || [];
+            if (!settlements.length) {
+                frappe.msgprint(__('No open loans of this employee can be netted against each other.'));
+                return;
+            }
+            const lines = settlements.map(row => __('{0} repaid from {1}: {2}', [
+                row.from_loan, row.to_loan, format_currency(row.amount, row.currency)
+            ]));
+            frappe.confirm(
+                __('Post these netting settlements?') + '<br><br>' + lines.join('<br>'),
+                function() {
+                    frappe.call({
+                        method: method,
+                        args: Object.assign({
+                            idempotency_key: get_idempotency_key(frm, 'net_employee_loans', [args.employee, args.company])
+                        }, args),
+                        freeze: true,
+                        callback: function(response) {
+                            if (response.message) {
+                                clear_idempotency_key(frm, 'net_employee_loans');
+                                frappe.msgprint(response.message.message);
+                                frm.reload_doc();
+                            }
+                        },
+                        error: function(response) {
+                            if (response && (response.exc || response._server_messages)) {
+                                clear_idempotency_key(frm, 'net_employee_loans');
+                            }
+                        }
+                    });
+                }
+            );
+        }
+    });
+}
+
+// A retry of the same payment (same values, no server answer yet) reuses its key so it is not posted twice
+function get_idempotency_key(frm, action, values) {
+    frm.__idempotency_keys = frm.__idempotency_keys || {};
+    const signature = JSON.stringify(values);
+    const pending = frm.__idempotency_keys[action];
+    if (pending && pending.signature === signature) {
+        return pending.key;
+    }
+    const key = `${frm.doc.name}-${action}-${frappe.utils.get_random(16)}`;
+    frm.__idempotency_keys[action] = { key: key, signature: signature };
+    return key;
+}
+
+function clear_idempotency_key(frm, action) {
+    if (frm.__idempotency_keys) {
+        delete frm.__idempotency_keys[action];
+    }
+}
@@ -3,10 +3,25 @@ import frappe
 from frappe.utils import strip_html_tags
 from frappe import throw, _
 from frappe.model.document import Document
-from frappe.utils import now, today, getdate, flt
-from erpnext.accounts.doctype.sales_invoice.sales_invoice import get_bank_cash_account
-from purchase_loans.purchase_loans.tasks import update_purchase_loan_request, create_purchase_loan_ledger
-from erpnext.setup.utils import get_exchange_rate
+from frappe.utils import now, today, getdate, flt, cint
+from purchase_loans.purchase_loans.tasks import (
+    LOAN_BALANCE_FIELDS,
+    _get_balance_delta,
+    _get_loan_for_balance,
+    apply_purchase_loan_balance_delta,
+    calculate_loan_balances,
+    cancel_journal_entries_in_bulk,
+    create_purchase_loan_ledger,
+    recompute_purchase_loan_balances,
+)
+from purchase_loans.purchase_loans.doctype.purchase_loan_employee_exposure.purchase_loan_employee_exposure import (
+    add_loan_to_employee_exposure,
+    validate_employee_exposure,
+)
+from purchase_loans.purchase_loans.attachments import copy_attachments
+from purchase_loans.purchase_loans.exchange_rate import get_cached_exchange_rate
+from purchase_loans.purchase_loans.company_settings import get_loan_company_settings
+from purchase_loans.purchase_loans.doctype.purchase_loan_idempotency_key.purchase_loan_idempotency_key import run_idempotent
 import logging
 
 
@@ -16,15 +31,90 @@ class PurchaseLoanRequest(Document):
     validate the loan request, check outstanding amounts, and update the loan request 
     after payments and repayments.
     """
+    def before_submit(self):
+        """Checks the employee's total open loan exposure against the company limit."""
+        self._validate_employee_exposure()
+
     def on_submit(self):
         """
         Called when the Purchase Loan Request document is submitted. This method updates
-        the Purchase Loan Request with the latest aggregate values from the ledger by 
-        invoking the `update_purchase_loan_request` function.
+        the Purchase Loan Request with the latest aggregate values from the ledger, then
+        counts the whole loan in the employee's exposure once.
         """
         frappe.db.set_value(self.doctype, self.name, "submission_date", getdate(today()))
-        update_purchase_loan_request(self.name)
-        
+        recompute_purchase_loan_balances(self.name, update_exposure=False)
+        if not self.closed:
+            add_loan_to_employee_exposure(_get_loan_for_balance(self.name))
+
+    def on_cancel(self):
+        """
+        Cascades the cancel to the submitted repayments and journals of the loan, then releases the
+        loan from the employee's exposure.
+        """
+        self._cancel_linked_documents()
+        if not self.closed:
+            add_loan_to_employee_exposure(_get_loan_for_balance(self.name), sign=-1)
+
+    def on_update_after_submit(self):
+        """Closing a loan releases it from the employee's exposure, reopening counts it again."""
+        if not self.has_value_changed("closed"):
+            return
+
+        loan = _get_loan_for_balance(self.name)
+        if self.closed:
+            add_loan_to_employee_exposure(loan, sign=-1)
+        else:
+            self._validate_employee_exposure()
+            add_loan_to_employee_exposure(loan)
+
+    def _cancel_linked_documents(self):
+        """
+        Cancels the submitted Purchase Loan Repayments of this loan (each cancels its own journals in
+        bulk), then its remaining payment and repayment journals in one bulk pass. Journals of a bulk
+        payout or netting also post to other loans and have to be cancelled by hand first.
+        """
+        shared_journals = frappe.db.sql(
+            """
+            SELECT DISTINCT ledger.reference_name
+            FROM `tabPurchase Loan Ledger` ledger
+            JOIN `tabJournal Entry` je ON je.name = ledger.reference_name
+            WHERE ledger.purchase_loan_request = %s AND ledger.cancelled = 0
+                AND je.docstatus = 1 AND IFNULL(je.custom_purchase_loan_request, '') = ''
+            """,
+            self.name,
+            pluck=True,
+        )
+        if shared_journals:
+            frappe.throw(_("Purchase Loan Request {0} is part of bulk payout or netting Journal Entries that also post to other loans. Cancel them first: {1}").format(
+                self.name, ", ".join(shared_journals)
+            ))
+
+        for repayment_name in frappe.get_all(
+            "Purchase Loan Repayment", filters={"purchase_loan_request": self.name, "docstatus": 1}, pluck="name"
+        ):
+            repayment = frappe.get_doc("Purchase Loan Repayment", repayment_name)
+            repayment.flags.ignore_permissions = True
+            repayment.cancel()
+
+        cancel_journal_entries_in_bulk(frappe.get_all(
+            "Journal Entry",
+            filters={"custom_purchase_loan_request": self.name, "docstatus": 1},
+            pluck="name",
+        ))
+
+    def _validate_employee_exposure(self):
+        """Validates against the balances the loan will have once it is counted."""
+        loan = frappe._dict(
+            employee=self.employee,
+            company=self.company,
+            currency=self.currency,
+            exchange_rate=self.exchange_rate,
+            **calculate_loan_balances(
+                flt(self.request_amount), flt(self.paid_amount_from_request), flt(self.repaid_amount)
+            ),
+        )
+        validate_employee_exposure(loan)
+
     def after_insert(self):
         if not self.exchange_rate or self.exchange_rate in {0, 1}:
             self.exchange_rate = get_conversion_rate(self)
@@ -60,9 +150,9 @@ class PurchaseLoanRequest(Document):
         """
         Fetches purchase loan account and validates the request amount against company limits.
         """
-        company_record = frappe.get_doc("Company", self.company)
-        purchase_loan_account = company_record.custom_purchase_loan_account
-        maximum_loan_amount = company_record.custom_maximum_loan_amount
+        company_settings = get_loan_company_settings(self.company)
+        purchase_loan_account = company_settings.purchase_loan_account
+        maximum_loan_amount = company_settings.maximum_loan_amount
 
         if maximum_loan_amount > 0 and self.request_amount > maximum_loan_amount:
             frappe.throw(_("Requested loan amount ({}) exceeds the maximum allowed amount ({})").format(self.request_amount, maximum_loan_amount))
@@ -83,75 +173,17 @@ class PurchaseLoanRequest(Document):
 @frappe.whitelist()
 def copy_attachments_to_target(target_doctype, target_docname, source_doctype, source_name):
     """
-    Copies all attachments from a source doctype to a target doctype based on a shared Transaction Unique ID.
-    Before inserting, it checks if the file is already attached to the target document.
+    Copies all attachments of a source document to a target document, skipping the files the
+    target already has. Errors are logged and do not stop the caller.
 
     Args:
-        target_doctype (str): The target doctype to attach files to (e.g., "Purchase Invoice").
+        target_doctype (str): The target doctype to attach files to (e.g., "Journal Entry").
         target_docname (str): The target document name to attach files to.
-        source_doctype (str): The source doctype to fetch attachments from (e.g., "Purchase Order").
+        source_doctype (str): The source doctype to fetch attachments from (e.g., "Purchase Loan Request").
         source_name (str): The source document name.
-
-    Raises:
-        frappe.ValidationError: If the source document or attachments are not found.
     """
     try:
-        # Fetch the target document
-        target_doc = frappe.get_doc(target_doctype, target_docname)
-
-        # Find the source documents with the same Transaction Unique ID
-        source_docs = frappe.get_all(
-            source_doctype,
-            filters={"name": source_name},
-            fields=["name"]
-        )
-
-        if not source_docs:
-            frappe.throw(
-                _(f"No {source_doctype} found with the name: {source_name}")
-            )
-
-        # Fetch the first matching source document (adjust if multiple matches are expected)
-        source_docname = source_docs[0].get("name")
-
-        # Get all attachments linked to the source document
-        attachments = frappe.get_all(
-            "File",
-            filters={"attached_to_doctype": source_doctype, "attached_to_name": source_docname},
-            fields=["file_url", "file_name"]
-        )
-
-        if not attachments:
-            frappe.msgprint(_(f"No attachments found in the related {source_doctype}: {source_docname}"))
-            return
-
-        # Attach files to the target document
-        for attachment in attachments:
-            # Check if the file is already attached to the target document
-            existing_attachment = frappe.get_all(
-                "File",
-                filters={
-                    "attached_to_doctype": target_doctype,
-                    "attached_to_name": target_docname,
-                    "file_url": attachment["file_url"],
-                    "file_name": attachment["file_name"]
-                },
-                fields=["name"]
-            )
-
-            if existing_attachment:
-                
-                continue  # Skip if file is already attached
-
-            # If file is not attached, add it
-            frappe.get_doc({
-                "doctype": "File",
-                "file_url": attachment["file_url"],
-                "file_name": attachment["file_name"],
-                "attached_to_doctype": target_doctype,
-                "attached_to_name": target_docname
-            }).insert(ignore_permissions=True)
-
+        copy_attachments(source_doctype, source_name, target_doctype, target_docname)
     except Exception as e:
         frappe.log_error(f"Error in copying attachments: {str(e)}")
 
@@ -162,18 +194,26 @@ def get_conversion_rate(self):
     currency = self.currency
     posting_date = self.posting_date
     # Fetch the company currency
-    company_currency = frappe.db.get_value(
-        "Company", filters={"name": company}, fieldname="default_currency"
-    )
+    company_currency = frappe.get_cached_value("Company", company, "default_currency")
     
     # Fetch the exchange rate
-    conversion_rate = get_exchange_rate(currency, company_currency, transaction_date=posting_date)
+    conversion_rate = get_cached_exchange_rate(currency, company_currency, transaction_date=posting_date)
     
     return conversion_rate or 1
 
 
 @frappe.whitelist()
-def pay_to_employee(loan_request, company, employee, mode_of_payment, payment_amount, payment_date=None):
+def pay_to_employee(loan_request, company, employee, mode_of_payment, payment_amount, payment_date=None, idempotency_key=None):
+    """
+    Pays a Purchase Loan Request. A call repeated with the same `idempotency_key` returns the
+    result of the first call instead of posting again.
+    """
+    args = dict(loan_request=loan_request, company=company, employee=employee, mode_of_payment=mode_of_payment,
+                payment_amount=payment_amount, payment_date=payment_date)
+    return run_idempotent(idempotency_key, "pay_to_employee", args, lambda: _pay_to_employee(**args))
+
+
+def _pay_to_employee(loan_request, company, employee, mode_of_payment, payment_amount, payment_date=None):
     """
     Process a payment to an employee for a purchase loan. This function ensures that 
     the payment amount is valid and within the outstanding balance, creates a journal 
@@ -187,9 +227,8 @@ def pay_to_employee(loan_request, company, employee, mode_of_payment, payment_am
     # Validate the payment amount
     payment_amount = _validate_payment_amount(payment_amount)
 
-    purchase_loan_request_doc = frappe.get_doc("Purchase Loan Request", loan_request)
-    company_record = frappe.get_doc("Company", purchase_loan_request_doc.company)
-    custom_allow_payment_beyond_loan_amount = company_record.custom_allow_payment_beyond_loan_amount
+    purchase_loan_request_doc = _get_locked_purchase_loan_request(loan_request)
+    company_settings = get_loan_company_settings(purchase_loan_request_doc.company)
 
     submission_date = getdate(purchase_loan_request_doc.submission_date) if purchase_loan_request_doc.submission_date else getdate(purchase_loan_request_doc.posting_date)
 
@@ -203,7 +242,7 @@ def pay_to_employee(loan_request, company, employee, mode_of_payment, payment_am
     currency = purchase_loan_request_doc.currency 
 
     # Ensure the payment amount is within the outstanding balance
-    if custom_allow_payment_beyond_loan_amount == "No" :
+    if not company_settings.allow_payment_beyond_loan_amount:
         if payment_amount > (purchase_loan_request_doc.outstanding_amount_from_request + purchase_loan_request_doc.overpaid_repayment_amount):
             frappe.throw(_("Payment amount cannot exceed the outstanding loan amount."))
 
@@ -222,15 +261,25 @@ def pay_to_employee(loan_request, company, employee, mode_of_payment, payment_am
     }
 
 @frappe.whitelist()
-def create_repay_cash(loan_request, company, employee, mode_of_payment, payment_amount, payment_date=None):
+def create_repay_cash(loan_request, company, employee, mode_of_payment, payment_amount, payment_date=None, idempotency_key=None):
+    """
+    Repays a Purchase Loan Request in cash. A call repeated with the same `idempotency_key` returns
+    the result of the first call instead of posting again.
+    """
+    args = dict(loan_request=loan_request, company=company, employee=employee, mode_of_payment=mode_of_payment,
+                payment_amount=payment_amount, payment_date=payment_date)
+    return run_idempotent(idempotency_key, "create_repay_cash", args, lambda: _create_repay_cash(**args))
+
+
+def _create_repay_cash(loan_request, company, employee, mode_of_payment, payment_amount, payment_date=None):
     """
     Create a journal entry for repaying cash, update the Purchase Loan Request, and 
     return the repaid cash amount.
     """
     payment_date = payment_date or now()
     payment_amount = _validate_payment_amount(payment_amount)
-    purchase_loan_request = frappe.get_doc("Purchase Loan Request", loan_request)
-    company_record = frappe.get_doc("Company", purchase_loan_request.company)
+    purchase_loan_request = _get_locked_purchase_loan_request(loan_request)
+    company_settings = get_loan_company_settings(purchase_loan_request.company)
 
     paid_amount_from_request = flt(purchase_loan_request.paid_amount_from_request)
     if payment_amount > (paid_amount_from_request):
@@ -245,7 +294,7 @@ def create_repay_cash(loan_request, company, employee, mode_of_payment, payment_
             _("submission date") if purchase_loan_request.submission_date else _("posting date")
         ))
 
-    if company_record.custom_allow_repayment_beyond_loan_amount == "No" :
+    if not company_settings.allow_repayment_beyond_loan_amount:
         if payment_amount > purchase_loan_request.outstanding_amount_from_repayment:
             frappe.throw(_("Repayment amount cannot exceed the outstanding loan amount."))
 
@@ -262,6 +311,24 @@ def create_repay_cash(loan_request, company, employee, mode_of_payment, payment_
         "message": _("Repayment of {} successfully processed.").format(payment_amount)
     }
 
+def _get_locked_purchase_loan_request(loan_request):
+    """
+    Locks the Purchase Loan Request row (SELECT ... FOR UPDATE) until the transaction ends and
+    returns the document with its balance fields taken from that locking read. Concurrent payments
+    and repayments on the same loan therefore check their limits one after the other, each seeing
+    the balances committed by the previous one, instead of all passing against the same snapshot.
+    """
+    locked_balances = _get_loan_for_balance(loan_request, for_update=True)
+    if not locked_balances:
+        frappe.throw(_("Purchase Loan Request {0} not found").format(loan_request), frappe.DoesNotExistError)
+
+    purchase_loan_request_doc = frappe.get_doc("Purchase Loan Request", loan_request)
+    if purchase_loan_request_doc.docstatus != 1:
+        frappe.throw(_("Purchase Loan Request {0} must be submitted.").format(loan_request))
+
+    purchase_loan_request_doc.update({fieldname: locked_balances[fieldname] for fieldname in LOAN_BALANCE_FIELDS})
+    return purchase_loan_request_doc
+
 def _check_user_permissions():
     """
     Validates that the user has the necessary roles to perform the action.
@@ -292,10 +359,10 @@ def _get_account_ids(mode_of_payment, company):
     """
     Fetches account IDs based on the mode of payment and company.
     """
-    from_account = frappe.get_doc("Company", company).custom_purchase_loan_account
-    to_account = get_bank_cash_account(mode_of_payment=mode_of_payment, company=company)
-    to_account_name = to_account.get('account', '')
-    if not from_account or not to_account:
+    company_settings = get_loan_company_settings(company)
+    from_account = company_settings.purchase_loan_account
+    to_account_name = company_settings.get_mode_of_payment_account(mode_of_payment)
+    if not from_account or not to_account_name:
         frappe.throw(_("Invalid accounts provided."))
 
     return from_account, to_account_name
@@ -308,9 +375,7 @@ def _create_journal_entry(purchase_loan_request_doc, payment_amount, company, em
     currency = purchase_loan_request_doc.currency
     exchange_rate = purchase_loan_request_doc.exchange_rate
 
-    account_currency = frappe.db.get_value(
-        "Account", filters={"name": to_account}, fieldname="account_currency"
-    )
+    account_currency = get_loan_company_settings(company).account_currencies.get(to_account)
     if account_currency and account_currency != currency:
         frappe.throw(_("Account currency ({}) does not match the loan request currency ({})").format(account_currency, currency))
 
@@ -366,3 +431,406 @@ def _create_journal_entry(purchase_loan_request_doc, payment_amount, company, em
     return journal_entry
 
 
+
+
+@frappe.whitelist()
+def pay_to_employees_bulk(payments, mode_of_payment=None, payment_date=None, idempotency_key=None):
+    """
+    Bulk variant of `pay_to_employee`, see `_pay_to_employees_bulk`. A call repeated with the same
+    `idempotency_key` returns the result of the first call instead of posting again.
+    """
+    payments = frappe.parse_json(payments) if isinstance(payments, str) else payments
+    args = dict(payments=payments, mode_of_payment=mode_of_payment, payment_date=payment_date)
+    return run_idempotent(idempotency_key, "pay_to_employees_bulk", args, lambda: _pay_to_employees_bulk(**args))
+
+
+def _pay_to_employees_bulk(payments, mode_of_payment=None, payment_date=None):
+    """
+    Pays many Purchase Loan Requests at once. `payments` is a list (or JSON list) of
+    {"loan_request": ..., "payment_amount": ..., "mode_of_payment": ...}; `mode_of_payment` is used
+    for rows without their own.
+
+    All rows are validated up front against the locked loans, and nothing is posted if any row
+    fails. Each (company, mode of payment, currency) group is then posted as one Journal Entry with
+    a debit and a credit row per loan, the ledger rows are bulk inserted and every loan's balance
+    is updated once when the transaction commits.
+    """
+    _check_user_permissions()
+
+    payments = frappe.parse_json(payments) if isinstance(payments, str) else payments
+    if not payments:
+        frappe.throw(_("No payments to process."))
+
+    payment_date = getdate(payment_date or today())
+    rows, errors = [], []
+    for idx, payment in enumerate(payments, start=1):
+        payment = frappe._dict(payment)
+        row_mode_of_payment = payment.mode_of_payment or mode_of_payment
+        if not payment.loan_request:
+            errors.append(_("Row {0}: Purchase Loan Request is required.").format(idx))
+        elif not row_mode_of_payment:
+            errors.append(_("Row {0}: Mode of Payment is required.").format(idx))
+        elif flt(payment.payment_amount) <= 0:
+            errors.append(_("Row {0}: Payment amount must be greater than zero.").format(idx))
+        else:
+            rows.append(frappe._dict(
+                idx=idx,
+                loan_request=payment.loan_request,
+                mode_of_payment=row_mode_of_payment,
+                payment_amount=flt(payment.payment_amount),
+            ))
+
+    loan_requests = [row.loan_request for row in rows]
+    duplicates = {name for name in loan_requests if loan_requests.count(name) > 1}
+    if duplicates:
+        errors.append(_("Each Purchase Loan Request can only be paid once per batch: {0}").format(", ".join(sorted(duplicates))))
+
+    loans = _get_locked_purchase_loan_requests(loan_requests)
+    companies = {}
+
+    for row in rows:
+        loan = loans.get(row.loan_request)
+        if not loan:
+            errors.append(_("Row {0}: Purchase Loan Request {1} not found.").format(row.idx, row.loan_request))
+            continue
+        if loan.docstatus != 1 or loan.closed:
+            errors.append(_("Row {0}: Purchase Loan Request {1} is not open for payment.").format(row.idx, loan.name))
+            continue
+
+        company_settings = companies.setdefault(loan.company, get_loan_company_settings(loan.company))
+        if not company_settings.purchase_loan_account:
+            errors.append(_("Row {0}: Purchase Loan Account not set in the Company for {1}").format(row.idx, loan.company))
+            continue
+
+        submission_date = getdate(loan.submission_date or loan.posting_date)
+        if payment_date < submission_date:
+            errors.append(_("Row {0}: Payment date cannot be before {1} of {2}.").format(row.idx, submission_date, loan.name))
+
+        if not company_settings.allow_payment_beyond_loan_amount and row.payment_amount > (
+            flt(loan.outstanding_amount_from_request) + flt(loan.overpaid_repayment_amount)
+        ):
+            errors.append(_("Row {0}: Payment amount cannot exceed the outstanding loan amount of {1}.").format(row.idx, loan.name))
+
+        bank_account = company_settings.mode_of_payment_accounts.get(row.mode_of_payment)
+        account_currency = company_settings.account_currencies.get(bank_account)
+        if not bank_account:
+            errors.append(_("Row {0}: No account set for Mode of Payment {1} in {2}.").format(row.idx, row.mode_of_payment, loan.company))
+        elif account_currency and account_currency != loan.currency:
+            errors.append(_("Row {0}: Account currency ({1}) does not match the loan request currency ({2})").format(
+                row.idx, account_currency, loan.currency
+            ))
+
+    if errors:
+        frappe.throw("<br>".join(errors), title=_("Bulk Payment Not Processed"))
+
+    groups = {}
+    for row in rows:
+        loan = loans[row.loan_request]
+        groups.setdefault((loan.company, row.mode_of_payment, loan.currency), []).append(row)
+
+    journal_entries = []
+    for (company, row_mode_of_payment, currency), group_rows in groups.items():
+        journal_entry = _create_bulk_payment_journal_entry(
+            group_rows,
+            loans,
+            company,
+            currency,
+            companies[company].purchase_loan_account,
+            companies[company].mode_of_payment_accounts[row_mode_of_payment],
+            payment_date,
+        )
+        _create_bulk_purchase_loan_ledger(journal_entry, group_rows, loans)
+        _copy_loan_attachments_to_journal_entry(journal_entry.name, [row.loan_request for row in group_rows])
+        journal_entries.append(journal_entry.name)
+
+    return {
+        "journal_entries": journal_entries,
+        "paid_loans": len(rows),
+        "message": _("{0} payments posted in {1} Journal Entries.").format(len(rows), len(journal_entries)),
+    }
+
+
+def _get_locked_purchase_loan_requests(loan_requests):
+    """Locks the given loans in name order (so concurrent batches cannot deadlock) and returns them by name."""
+    if not loan_requests:
+        return {}
+
+    loans = frappe.db.sql(
+        f"""
+        SELECT name, employee, company, currency, exchange_rate, docstatus, closed,
+            submission_date, posting_date, purchase_items_details, {", ".join(LOAN_BALANCE_FIELDS)}
+        FROM `tabPurchase Loan Request`
+        WHERE name IN %(loan_requests)s
+        ORDER BY name
+        FOR UPDATE
+        """,
+        {"loan_requests": tuple(set(loan_requests))},
+        as_dict=True,
+    )
+    return {loan.name: loan for loan in loans}
+
+
+def _create_bulk_payment_journal_entry(rows, loans, company, currency, loan_account, bank_account, payment_date):
+    accounts, remarks = [], []
+    for row in rows:
+        loan = loans[row.loan_request]
+        exchange_rate = flt(loan.exchange_rate) or 1
+        accounts.extend([
+            {
+                "account": loan_account,
+                "debit_in_account_currency": row.payment_amount * exchange_rate,
+                "reference_type": "Purchase Loan Request",
+                "reference_name": loan.name,
+                "party_type": "Employee",
+                "party": loan.employee,
+            },
+            {
+                "account": bank_account,
+                "account_currency": currency,
+                "exchange_rate": exchange_rate,
+                "credit_in_account_currency": row.payment_amount,
+                "debit": row.payment_amount * exchange_rate,
+                "reference_type": "Purchase Loan Request",
+                "reference_name": loan.name,
+            },
+        ])
+        remarks.append("{}: {}".format(
+            loan.name, re.sub(r"\s+", " ", strip_html_tags(loan.purchase_items_details or "")).strip()
+        ))
+
+    journal_entry = frappe.get_doc({
+        "doctype": "Journal Entry",
+        "voucher_type": "Purchase Loan Payment",
+        "posting_date": payment_date,
+        # Only a single-loan journal can point at its loan; bulk journals are tracked through the ledger
+        "custom_purchase_loan_request": rows[0].loan_request if len(rows) == 1 else None,
+        "company": company,
+        "multi_currency": 1,
+        "user_remark": _("Payment made for Purchase Loan Requests:\n{}").format("\n".join(remarks)),
+        "accounts": accounts,
+    })
+    journal_entry.insert(ignore_permissions=True)
+    journal_entry.submit()
+    return journal_entry
+
+
+def _create_bulk_purchase_loan_ledger(journal_entry, rows, loans):
+    """Inserts one Pay ledger row per loan with a single statement and queues the balance updates."""
+    _insert_purchase_loan_ledger_rows(journal_entry, [
+        (loans[row.loan_request], "Pay", row.payment_amount * (flt(loans[row.loan_request].exchange_rate) or 1))
+        for row in rows
+    ])
+
+
+def _insert_purchase_loan_ledger_rows(journal_entry, entries):
+    """
+    Inserts the ledger rows of a multi-loan journal with a single statement and queues the balance
+    updates. `entries` is a list of (loan, payment type, amount in company currency). The rows are
+    checked like the ledger controller would before anything is written.
+    """
+    from purchase_loans.purchase_loans.doctype.purchase_loan_balance_snapshot.purchase_loan_balance_snapshot import (
+        invalidate_purchase_loan_balance_snapshots,
+    )
+    from purchase_loans.purchase_loans.doctype.purchase_loan_ledger.purchase_loan_ledger import (
+        validate_purchase_loan_ledger_entry,
+    )
+
+    rows = [
+        (loan, frappe._dict(
+            purchase_loan_request=loan.name,
+            reference_name=journal_entry.name,
+            purchase_loan_payment_type=payment_type,
+            employee=loan.employee,
+            company=journal_entry.company,
+            posting_date=journal_entry.posting_date,
+            amount=flt(ledger_amount),
+        ))
+        for loan, payment_type, ledger_amount in entries
+    ]
+    for loan, row in rows:
+        validate_purchase_loan_ledger_entry(row, loan)
+
+    timestamp, user = now(), frappe.session.user
+    values = []
+    for loan, row in rows:
+        values.append((
+            frappe.generate_hash(length=10), timestamp, timestamp, user, user, 0,
+            row.purchase_loan_request, row.reference_name, row.purchase_loan_payment_type, row.employee, row.company,
+            row.posting_date, row.amount, 0,
+        ))
+        apply_purchase_loan_balance_delta(loan.name, *_get_balance_delta(row.purchase_loan_payment_type, row.amount))
+        invalidate_purchase_loan_balance_snapshots(loan.name, row.posting_date)
+
+    frappe.db.bulk_insert(
+        "Purchase Loan Ledger",
+        fields=[
+            "name", "creation", "modified", "owner", "modified_by", "docstatus",
+            "purchase_loan_request", "reference_name", "purchase_loan_payment_type", "employee", "company",
+            "posting_date", "amount", "cancelled",
+        ],
+        values=values,
+    )
+
+
+def _copy_loan_attachments_to_journal_entry(journal_entry_name, loan_requests):
+    """Attaches the files of all the paid loans to the bulk Journal Entry."""
+    copy_attachments("Purchase Loan Request", loan_requests, "Journal Entry", journal_entry_name)
+
+
+@frappe.whitelist()
+def net_employee_loans(employee, company, posting_date=None, dry_run=0, idempotency_key=None):
+    """
+    Nets the open Purchase Loan Requests of an employee against each other, see
+    `_net_employee_loans`. A call repeated with the same `idempotency_key` returns the result of
+    the first call instead of posting again; a dry run posts nothing and is never stored.
+    """
+    args = dict(employee=employee, company=company, posting_date=posting_date)
+    if cint(dry_run):
+        return _net_employee_loans(**args, dry_run=True)
+    return run_idempotent(idempotency_key, "net_employee_loans", args, lambda: _net_employee_loans(**args))
+
+
+def _net_employee_loans(employee, company, posting_date=None, dry_run=False):
+    """
+    Settles the loans the employee still owes on (paid more than repaid) with the loans the
+    employee overpaid (repaid more than paid), oldest first. For each matched amount the owing loan
+    gets a RePay ledger row and the overpaid loan a Pay row, so no cash moves.
+
+    Loans are only netted against loans in the same currency. Each currency is posted as one
+    Purchase Loan Netting Journal Entry with a credit or debit row per loan on the loan account;
+    a difference between the loans' exchange rates goes to the Exchange Gain/Loss account. Loans
+    without a counterpart in their currency are left for their own repayments and payments.
+    """
+    _check_user_permissions()
+
+    posting_date = getdate(posting_date or today())
+    loan_names = frappe.get_all(
+        "Purchase Loan Request",
+        filters={"employee": employee, "company": company, "docstatus": 1, "closed": 0},
+        pluck="name",
+    )
+    loans = _get_locked_purchase_loan_requests(loan_names)
+
+    by_currency = {}
+    for loan in sorted(loans.values(), key=lambda loan: (getdate(loan.posting_date), loan.name)):
+        if loan.docstatus != 1 or loan.closed:
+            continue
+        balance = flt(flt(loan.paid_amount_from_request) - flt(loan.repaid_amount), 2)
+        if balance:
+            loan.net_balance = balance
+            by_currency.setdefault(loan.currency, []).append(loan)
+
+    settlements, unmatched = {}, []
+    for currency, currency_loans in by_currency.items():
+        owing = [loan for loan in currency_loans if loan.net_balance > 0]
+        overpaid = [loan for loan in currency_loans if loan.net_balance < 0]
+        if not (owing and overpaid):
+            unmatched.extend(loan.name for loan in currency_loans)
+            continue
+
+        matches = []
+        while owing and overpaid:
+            owing_loan, overpaid_loan = owing[0], overpaid[0]
+            amount = min(owing_loan.net_balance, -overpaid_loan.net_balance)
+            matches.append(frappe._dict(owing_loan=owing_loan, overpaid_loan=overpaid_loan, amount=amount))
+            owing_loan.net_balance = flt(owing_loan.net_balance - amount, 2)
+            overpaid_loan.net_balance = flt(overpaid_loan.net_balance + amount, 2)
+            if not owing_loan.net_balance:
+                owing.pop(0)
+            if not overpaid_loan.net_balance:
+                overpaid.pop(0)
+        unmatched.extend(loan.name for loan in owing + overpaid)
+        settlements[currency] = matches
+
+    result = {
+        "settlements": [
+            {"currency": currency, "from_loan": match.owing_loan.name, "to_loan": match.overpaid_loan.name, "amount": match.amount}
+            for currency, matches in settlements.items()
+            for match in matches
+        ],
+        "unmatched_loans": unmatched,
+        "journal_entries": [],
+    }
+    if dry_run or not settlements:
+        result["message"] = _("{0} netting settlements found.").format(len(result["settlements"]))
+        return result
+
+    company_settings = get_loan_company_settings(company)
+    if not company_settings.purchase_loan_account:
+        frappe.throw(_("Purchase Loan Account not set in the Company for {0}").format(company))
+
+    for currency, matches in settlements.items():
+        journal_entry, entries = _create_netting_journal_entry(matches, employee, company, currency, company_settings, posting_date)
+        _insert_purchase_loan_ledger_rows(journal_entry, entries)
+        result["journal_entries"].append(journal_entry.name)
+
+    result["message"] = _("{0} netting settlements posted in {1} Journal Entries.").format(
+        len(result["settlements"]), len(result["journal_entries"])
+    )
+    return result
+
+
+def _create_netting_journal_entry(matches, employee, company, currency, company_settings, posting_date):
+    """
+    Posts one Journal Entry for the netting settlements of a currency and returns it with the
+    ledger entries (loan, payment type, amount in company currency) it carries.
+    """
+    repaid, paid = {}, {}
+    loans = {}
+    for match in matches:
+        loans[match.owing_loan.name] = match.owing_loan
+        loans[match.overpaid_loan.name] = match.overpaid_loan
+        repaid[match.owing_loan.name] = repaid.get(match.owing_loan.name, 0) + match.amount
+        paid[match.overpaid_loan.name] = paid.get(match.overpaid_loan.name, 0) + match.amount
+
+    accounts, entries = [], []
+    for loan_name, amount in repaid.items():
+        ledger_amount = amount * (flt(loans[loan_name].exchange_rate) or 1)
+        accounts.append(_get_netting_account_row(company_settings, loans[loan_name], "credit_in_account_currency", ledger_amount))
+        entries.append((loans[loan_name], "RePay", ledger_amount))
+    for loan_name, amount in paid.items():
+        ledger_amount = amount * (flt(loans[loan_name].exchange_rate) or 1)
+        accounts.append(_get_netting_account_row(company_settings, loans[loan_name], "debit_in_account_currency", ledger_amount))
+        entries.append((loans[loan_name], "Pay", ledger_amount))
+
+    # The same loan-currency amount is worth a different company amount on loans taken at different rates
+    difference = flt(
+        sum(row.get("credit_in_account_currency", 0) for row in accounts)
+        - sum(row.get("debit_in_account_currency", 0) for row in accounts),
+        2,
+    )
+    if difference:
+        if not company_settings.exchange_gain_loss_account:
+            frappe.throw(_("Exchange Gain or Loss Account is not set for the company {0}. Please configure it in Company settings.").format(company))
+        accounts.append({
+            "account": company_settings.exchange_gain_loss_account,
+            "debit_in_account_currency" if difference > 0 else "credit_in_account_currency": abs(difference),
+        })
+
+    journal_entry = frappe.get_doc({
+        "doctype": "Journal Entry",
+        "voucher_type": "Purchase Loan Netting",
+        "posting_date": posting_date,
+        "company": company,
+        "multi_currency": 1,
+        "user_remark": _("Netting of Purchase Loan Requests of {0} ({1}):\n{2}").format(
+            employee,
+            currency,
+            "\n".join(_("{0} repaid from {1}: {2}").format(match.owing_loan.name, match.overpaid_loan.name, match.amount) for match in matches),
+        ),
+        "accounts": accounts,
+    })
+    journal_entry.insert(ignore_permissions=True)
+    journal_entry.submit()
+    return journal_entry, entries
+
+
+def _get_netting_account_row(company_settings, loan, amount_field, amount):
+    return {
+        "account": company_settings.purchase_loan_account,
+        amount_field: amount,
+        "reference_type": "Purchase Loan Request",
+        "reference_name": loan.name,
+        "party_type": "Employee",
+        "party": loan.employee,
+    }
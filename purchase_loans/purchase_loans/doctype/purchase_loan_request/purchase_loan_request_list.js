@@ -0,0 +1,79 @@
+frappe.listview_settings["Purchase Loan Request"] = {
+    onload: function(listview) {
+        if (!frappe.user_roles.some(role => ["Accounts User", "Accounts Manager"].includes(role))) {
+            return;
+        }
+
+        listview.page.add_actions_menu_item(__("Pay To Employees"), function() {
+            const names = listview.get_checked_items(true);
+            if (!names.length) {
+                frappe.msgprint(__("Select the Purchase Loan Requests to pay."));
+                return;
+            }
+            show_bulk_payment_dialog(listview, names);
+        });
+    }
+};
+
+function show_bulk_payment_dialog(listview, names) {
+    frappe.db.get_list("Purchase Loan Request", {
+        filters: { name: ["in", names], docstatus: 1, closed: 0 },
+        fields: ["name", "employee_name", "currency", "outstanding_amount_from_request", "overpaid_repayment_amount"],
+        limit: names.length
+    }).then(loans => {
+        const payments = loans
+            .map(loan => ({
+                loan_request: loan.name,
+                payment_amount: flt(loan.outstanding_amount_from_request) + flt(loan.overpaid_repayment_amount)
+            }))
+            .filter(payment => payment.payment_amount > 0);
+
+        if (!payments.length) {
+            frappe.msgprint(__("None of the selected requests has an outstanding amount to pay."));
+            return;
+        }
+
+        // One key per dialog, so re-sending the same batch after a timeout cannot pay it twice
+        const idempotency_key = `bulk-payment-${frappe.utils.get_random(16)}`;
+
+        frappe.prompt([
+            {
+                label: __("Mode of Payment"),
+                fieldname: "mode_of_payment",
+                fieldtype: "Link",
+                options: "Mode of Payment",
+                filters: { enabled: 1 },
+                reqd: 1
+            },
+            {
+                label: __("Payment Date"),
+                fieldname: "payment_date",
+                fieldtype: "Date",
+                reqd: 1,
+                default: frappe.datetime.get_today()
+            }
+        ], function(values) {
+            frappe.confirm(
+                __("Pay the outstanding amount of {0} Purchase Loan Requests on {1}?", [payments.length, values.payment_date]),
+                function() {
+                    frappe.call({
+                        method: "purchase_loans.purchase_loans.doctype.purchase_loan_request.purchase_loan_request.pay_to_employees_bulk",
+                        args: {
+                            payments: payments,
+                            mode_of_payment: values.mode_of_payment,
+                            payment_date: values.payment_date,
+                            idempotency_key: idempotency_key
+                        },
+                        freeze: true,
+                        callback: function(response) {
+                            if (response.message) {
+                                frappe.msgprint(response.message.message);
+                                listview.refresh();
+                            }
+                        }
+                    });
+                }
+            );
+        }, __("Bulk Payment"), __("Pay"));
+    });
+}
@@ -1,9 +1,295 @@
 # Copyright (c) 2024, Ahmed Emam and Contributors
 # See license.txt
 
-# import frappe
+import threading
+import time
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, flt, today
+
+from purchase_loans.purchase_loans.company_settings import clear_loan_company_settings, get_loan_company_settings
+from purchase_loans.purchase_loans.doctype.purchase_loan_employee_exposure.purchase_loan_employee_exposure import (
+	get_exposure_name,
+)
+from purchase_loans.purchase_loans.doctype.purchase_loan_request.purchase_loan_request import (
+	net_employee_loans,
+	pay_to_employee,
+	pay_to_employees_bulk,
+)
+from purchase_loans.purchase_loans.revaluation import revalue_purchase_loans
+from purchase_loans.purchase_loans.tasks import apply_purchase_loan_balance_delta, rebuild_purchase_loan_balances
+
+TEST_COMPANY = "_Test Company"
+PARALLEL_PAYOUTS = 8
+MODE_OF_PAYMENT = "Cash"
 
 
 class TestPurchaseLoanRequest(FrappeTestCase):
-	pass
+	def test_parallel_payouts_do_not_overpay(self):
+		"""
+		Fires payouts from several connections at once against one loan that only has room for
+		some of them. With the row lock in place the paid amount never exceeds the request.
+		"""
+		skip_without_loan_accounts(self)
+
+		# The payout threads run on their own connections, so the setup is committed and undone in cleanups
+		self.set_company_setting("custom_allow_payment_beyond_loan_amount", "No")
+		loan = make_purchase_loan_request(request_amount=300)
+		frappe.db.commit()
+		self.addCleanup(delete_purchase_loan_request, loan.name)
+
+		site = frappe.local.site
+		results = []
+
+		def pay():
+			frappe.init(site=site)
+			frappe.connect()
+			frappe.set_user("Administrator")
+			try:
+				pay_to_employee(loan.name, loan.company, loan.employee, MODE_OF_PAYMENT, 100, today())
+				frappe.db.commit()
+				results.append(True)
+			except frappe.ValidationError:
+				frappe.db.rollback()
+				results.append(False)
+			finally:
+				frappe.destroy()
+
+		threads = [threading.Thread(target=pay) for _i in range(PARALLEL_PAYOUTS)]
+		started = time.monotonic()
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		elapsed = time.monotonic() - started
+
+		loan.reload()
+		ledger_paid = flt(
+			frappe.db.get_value(
+				"Purchase Loan Ledger",
+				{"purchase_loan_request": loan.name, "cancelled": 0, "purchase_loan_payment_type": "Pay"},
+				"sum(amount)",
+			)
+		)
+
+		self.assertEqual(results.count(True), 3)
+		self.assertEqual(flt(loan.paid_amount_from_request), 300)
+		self.assertEqual(flt(loan.outstanding_amount_from_request), 0)
+		self.assertEqual(ledger_paid, 300 * flt(loan.exchange_rate or 1))
+		# Payouts on one loan are serialized, but they should still go through in reasonable time
+		self.assertLess(elapsed, PARALLEL_PAYOUTS * 5)
+
+	def test_rebuild_reports_and_repairs_drift(self):
+		loan = make_purchase_loan_request(request_amount=300, employee=make_employee("_Test Rebuild Employee"))
+		# A ledger row whose amount never reached the loan's balance fields
+		make_ledger_row(loan, cancelled=0, amount=100)
+
+		result = rebuild_purchase_loan_balances(purchase_loan_requests=[loan.name], dry_run=True)
+		self.assertEqual(result["changed"], 1)
+		self.assertEqual(result["diff"][loan.name]["paid_amount_from_request"], (0, 100))
+		self.assertEqual(flt(frappe.db.get_value("Purchase Loan Request", loan.name, "paid_amount_from_request")), 0)
+
+		# The rebuild commits per chunk; keep its writes inside the test transaction
+		with patch.object(frappe.db, "commit"):
+			result = rebuild_purchase_loan_balances(purchase_loan_requests=[loan.name])
+
+		loan.reload()
+		self.assertEqual(result["updated"], 1)
+		self.assertEqual(flt(loan.paid_amount_from_request), 100)
+		self.assertEqual(flt(loan.outstanding_amount_from_request), 200)
+		exposure = frappe.get_doc("Purchase Loan Employee Exposure", get_exposure_name(loan.employee, loan.company, loan.currency))
+		self.assertEqual(exposure.open_loan_count, 1)
+		self.assertEqual(flt(exposure.total_exposure), 300)
+
+	def test_bulk_payout_posts_one_journal_for_many_loans(self):
+		skip_without_loan_accounts(self)
+		loans = [make_purchase_loan_request(request_amount=300) for _i in range(2)]
+
+		result = pay_to_employees_bulk(
+			[{"loan_request": loan.name, "payment_amount": 100} for loan in loans], mode_of_payment=MODE_OF_PAYMENT
+		)
+
+		self.assertEqual(len(result["journal_entries"]), 1)
+		self.assertEqual(result["paid_loans"], 2)
+		for loan in loans:
+			loan.reload()
+			self.assertEqual(flt(loan.paid_amount_from_request), 100)
+			self.assertEqual(flt(loan.outstanding_amount_from_request), 200)
+			self.assertEqual(
+				frappe.db.get_value(
+					"Purchase Loan Ledger", {"purchase_loan_request": loan.name, "cancelled": 0}, "reference_name"
+				),
+				result["journal_entries"][0],
+			)
+
+	def test_bulk_payout_rejects_the_whole_batch(self):
+		loan = make_purchase_loan_request(request_amount=300)
+		payments = [{"loan_request": loan.name, "payment_amount": 100}] * 2
+
+		self.assertRaises(frappe.ValidationError, pay_to_employees_bulk, payments, mode_of_payment=MODE_OF_PAYMENT)
+		self.assertFalse(frappe.db.exists("Purchase Loan Ledger", {"purchase_loan_request": loan.name}))
+
+	def test_netting_matches_owing_and_overpaid_loans(self):
+		employee = make_employee("_Test Netting Employee")
+		owing = make_purchase_loan_request(request_amount=300, employee=employee)
+		overpaid = make_purchase_loan_request(request_amount=300, employee=employee)
+		post_ledger_amount(owing, "Pay", 100)
+		post_ledger_amount(overpaid, "RePay", 40)
+
+		result = net_employee_loans(employee, TEST_COMPANY, dry_run=1)
+
+		self.assertEqual(
+			result["settlements"],
+			[{"currency": owing.currency, "from_loan": owing.name, "to_loan": overpaid.name, "amount": 40}],
+		)
+		self.assertEqual(result["unmatched_loans"], [owing.name])
+		self.assertEqual(result["journal_entries"], [])
+
+	def test_netting_posts_the_settlement(self):
+		skip_without_loan_accounts(self)
+		employee = make_employee("_Test Netting Employee")
+		owing = make_purchase_loan_request(request_amount=300, employee=employee)
+		overpaid = make_purchase_loan_request(request_amount=300, employee=employee)
+		post_ledger_amount(owing, "Pay", 100)
+		post_ledger_amount(overpaid, "RePay", 40)
+
+		result = net_employee_loans(employee, TEST_COMPANY)
+
+		self.assertEqual(len(result["journal_entries"]), 1)
+		self.assertEqual(frappe.db.get_value("Journal Entry", result["journal_entries"][0], "voucher_type"), "Purchase Loan Netting")
+		owing.reload()
+		overpaid.reload()
+		self.assertEqual(flt(owing.repaid_amount), 40)
+		self.assertEqual(flt(owing.outstanding_amount_from_repayment), 60)
+		self.assertEqual(flt(overpaid.paid_amount_from_request), 40)
+		self.assertEqual(flt(overpaid.paid_amount_from_request) - flt(overpaid.repaid_amount), 0)
+
+	def test_revaluation_posts_only_the_change_and_skips_unrated_loans(self):
+		rated = make_foreign_currency_loan(exchange_rate=80, paid_amount=100)
+		unrated = make_foreign_currency_loan(exchange_rate=0, paid_amount=100)
+
+		def revalue():
+			with patch("purchase_loans.purchase_loans.revaluation.get_cached_exchange_rate", return_value=82), patch(
+				"purchase_loans.purchase_loans.revaluation._create_revaluation_journal_entry",
+				return_value=frappe._dict(name="_Test Revaluation"),
+			) as create_journal_entry:
+				result = revalue_purchase_loans(today(), TEST_COMPANY)
+			adjustments = {
+				loan.name: adjustment
+				for call in create_journal_entry.call_args_list
+				for loan, adjustment in call.args[1]
+			}
+			return result, adjustments
+
+		result, adjustments = revalue()
+		self.assertEqual(adjustments.get(rated.name), 200)
+		self.assertNotIn(unrated.name, adjustments)
+		self.assertIn(unrated.name, result["skipped_loans"])
+		self.assertEqual(flt(frappe.db.get_value("Purchase Loan Request", rated.name, "unrealized_exchange_gain_loss")), 200)
+
+		# The same closing date again has nothing left to post for the loan
+		_result, adjustments = revalue()
+		self.assertNotIn(rated.name, adjustments)
+
+	def set_company_setting(self, fieldname, value):
+		"""Sets a Company field for this test and restores the previous value on cleanup."""
+		previous = frappe.db.get_value("Company", TEST_COMPANY, fieldname)
+
+		def restore():
+			frappe.db.set_value("Company", TEST_COMPANY, fieldname, previous)
+			clear_loan_company_settings(frappe.get_doc("Company", TEST_COMPANY))
+			frappe.db.commit()
+
+		self.addCleanup(restore)
+		frappe.db.set_value("Company", TEST_COMPANY, fieldname, value)
+		clear_loan_company_settings(frappe.get_doc("Company", TEST_COMPANY))
+
+
+def skip_without_loan_accounts(test_case):
+	"""Skips tests that post journals when the test company has no loan or Cash account."""
+	company_settings = get_loan_company_settings(TEST_COMPANY)
+	if not company_settings.purchase_loan_account:
+		test_case.skipTest("Purchase Loan Account is not set on the test company")
+	if not company_settings.mode_of_payment_accounts.get(MODE_OF_PAYMENT):
+		test_case.skipTest(f"Mode of Payment {MODE_OF_PAYMENT} has no account for the test company")
+
+
+def make_employee(first_name="_Test Purchase Loan Employee"):
+	return frappe.get_doc({
+		"doctype": "Employee",
+		"first_name": first_name,
+		"gender": "Male",
+		"date_of_birth": "1990-01-01",
+		"date_of_joining": "2020-01-01",
+		"company": TEST_COMPANY,
+		"status": "Active",
+	}).insert().name
+
+
+def make_purchase_loan_request(request_amount, employee=None, submit=True):
+	employee = employee or frappe.db.get_value("Employee", {"company": TEST_COMPANY, "status": "Active"}) or make_employee()
+	frappe.db.set_value("Employee", employee, "custom_purchase_loan_approver", "Administrator")
+
+	loan = frappe.get_doc({
+		"doctype": "Purchase Loan Request",
+		"employee": employee,
+		"company": TEST_COMPANY,
+		"posting_date": add_days(today(), -1),
+		"currency": frappe.get_cached_value("Company", TEST_COMPANY, "default_currency"),
+		"request_amount": request_amount,
+		"purchase_items_details": "Concurrency test",
+	})
+	loan.insert()
+	if submit:
+		loan.submit()
+	return loan
+
+
+def make_ledger_row(loan, cancelled, amount=100, posting_date=None, payment_type="Pay"):
+	return frappe.get_doc({
+		"doctype": "Purchase Loan Ledger",
+		"purchase_loan_request": loan.name,
+		"purchase_loan_payment_type": payment_type,
+		"employee": loan.employee,
+		"company": loan.company,
+		"posting_date": posting_date or loan.posting_date,
+		"amount": amount,
+		"cancelled": cancelled,
+	}).insert()
+
+
+def make_foreign_currency_loan(exchange_rate, paid_amount):
+	"""A submitted loan moved to a currency other than the company's, with `paid_amount` outstanding."""
+	loan = make_purchase_loan_request(request_amount=300)
+	company_currency = frappe.get_cached_value("Company", TEST_COMPANY, "default_currency")
+	frappe.db.set_value("Purchase Loan Request", loan.name, {
+		"currency": "EUR" if company_currency == "USD" else "USD",
+		"exchange_rate": exchange_rate,
+		"paid_amount_from_request": paid_amount,
+	})
+	loan.reload()
+	return loan
+
+
+def post_ledger_amount(loan, payment_type, amount):
+	"""Posts a ledger row without a journal and applies it to the loan, as a journal's ledger hook would."""
+	make_ledger_row(loan, cancelled=0, amount=amount, payment_type=payment_type)
+	apply_purchase_loan_balance_delta(
+		loan.name, paid_delta=amount if payment_type == "Pay" else 0, repaid_delta=amount if payment_type == "RePay" else 0
+	)
+
+
+def delete_purchase_loan_request(name):
+	"""Cancels a committed test loan (which cancels its journals) and deletes it with its journals and ledger rows."""
+	frappe.db.rollback()
+	loan = frappe.get_doc("Purchase Loan Request", name)
+	if loan.docstatus == 1:
+		loan.cancel()
+
+	for journal_entry in frappe.get_all("Journal Entry", filters={"custom_purchase_loan_request": name}, pluck="name"):
+		frappe.delete_doc("Journal Entry", journal_entry, force=True, ignore_permissions=True)
+	frappe.db.delete("Purchase Loan Ledger", {"purchase_loan_request": name})
+	frappe.delete_doc("Purchase Loan Request", name, force=True, ignore_permissions=True)
+	frappe.db.commit()
@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+
+import frappe
+from frappe.utils import flt, getdate, nowdate
+
+# Redis entries live for a few hours; the per-process copies are kept short so that a Currency
+# Exchange change made on another worker is picked up within a minute at most.
+REDIS_TTL = 6 * 60 * 60
+LOCAL_TTL = 60
+LOCAL_MAX_SIZE = 512
+
+CACHE_KEY_PREFIX = "purchase_loans:exchange_rate"
+
+_local_cache = OrderedDict()
+_local_lock = threading.Lock()
+_stats = {"local_hits": 0, "redis_hits": 0, "misses": 0, "invalidations": 0}
+
+
+def get_cached_exchange_rate(from_currency, to_currency, transaction_date=None):
+    """
+    Returns ERPNext's exchange rate from `from_currency` to `to_currency` on `transaction_date`
+    (default today), cached per (from_currency, to_currency, date). Lookups go through an
+    in-process LRU first, then Redis, and only call `get_exchange_rate` on a miss.
+    """
+    if not from_currency or not to_currency or from_currency == to_currency:
+        return 1.0
+
+    transaction_date = str(getdate(transaction_date or nowdate()))
+    local_key = (frappe.local.site, from_currency, to_currency, transaction_date)
+
+    rate = _get_local(local_key)
+    if rate is not None:
+        _stats["local_hits"] += 1
+        return rate
+
+    redis_key = _get_redis_key(from_currency, to_currency, transaction_date)
+    rate = frappe.cache().get_value(redis_key)
+    if rate is not None:
+        _stats["redis_hits"] += 1
+    else:
+        from erpnext.setup.utils import get_exchange_rate
+
+        _stats["misses"] += 1
+        rate = flt(get_exchange_rate(from_currency, to_currency, transaction_date=transaction_date))
+        # A missing rate (0) is not cached, so it is retried once the Currency Exchange is created
+        if rate:
+            frappe.cache().set_value(redis_key, rate, expires_in_sec=REDIS_TTL)
+
+    if rate:
+        _set_local(local_key, rate)
+    return rate
+
+
+def invalidate_exchange_rate_cache(doc, method=None):
+    """
+    Currency Exchange hook. A rate is valid from its date until the next record, and ERPNext also
+    derives the inverse pair from it, so every cached date of both directions is dropped.
+    """
+    if not (doc.from_currency and doc.to_currency):
+        return
+
+    pairs = {(doc.from_currency, doc.to_currency), (doc.to_currency, doc.from_currency)}
+    for from_currency, to_currency in pairs:
+        frappe.cache().delete_keys(f"{CACHE_KEY_PREFIX}:{from_currency}:{to_currency}:")
+
+    with _local_lock:
+        for key in [key for key in _local_cache if key[0] == frappe.local.site and (key[1], key[2]) in pairs]:
+            del _local_cache[key]
+
+    _stats["invalidations"] += 1
+
+
+@frappe.whitelist()
+def get_exchange_rate_cache_stats():
+    """Hit/miss counters of this worker process."""
+    frappe.only_for("System Manager")
+
+    lookups = _stats["local_hits"] + _stats["redis_hits"] + _stats["misses"]
+    return {
+        **_stats,
+        "lookups": lookups,
+        "hit_ratio": flt((lookups - _stats["misses"]) / lookups, 4) if lookups else 0,
+        "local_size": len(_local_cache),
+    }
+
+
+def _get_redis_key(from_currency, to_currency, transaction_date):
+    return f"{CACHE_KEY_PREFIX}:{from_currency}:{to_currency}:{transaction_date}"
+
+
+def _get_local(key):
+    with _local_lock:
+        entry = _local_cache.get(key)
+        if entry is None:
+            return None
+
+        rate, expires_at = entry
+        if expires_at < time.monotonic():
+            del _local_cache[key]
+            return None
+
+        _local_cache.move_to_end(key)
+        return rate
+
+
+def _set_local(key, rate):
+    with _local_lock:
+        _local_cache[key] = (rate, time.monotonic() + LOCAL_TTL)
+        _local_cache.move_to_end(key)
+        while len(_local_cache) > LOCAL_MAX_SIZE:
+            _local_cache.popitem(last=False)
@@ -0,0 +1,40 @@
+frappe.query_reports["Purchase Loan Aging"] = {
+    "filters": [
+        {
+            "fieldname": "company",
+            "label": __("Company"),
+            "fieldtype": "Link",
+            "options": "Company",
+            "default": frappe.defaults.get_user_default("Company"),
+            "reqd": 1
+        },
+        {
+            "fieldname": "as_of_date",
+            "label": __("As Of Date"),
+            "fieldtype": "Date",
+            "default": frappe.datetime.get_today(),
+            "reqd": 1
+        },
+        {
+            "fieldname": "ranges",
+            "label": __("Aging Ranges (Days)"),
+            "fieldtype": "Data",
+            "default": "30, 60, 90",
+            "reqd": 1
+        },
+        {
+            "fieldname": "employee",
+            "label": __("Employee"),
+            "fieldtype": "Link",
+            "options": "Employee",
+            "reqd": 0
+        },
+        {
+            "fieldname": "purchase_loan_request",
+            "label": __("Purchase Loan Request"),
+            "fieldtype": "Link",
+            "options": "Purchase Loan Request",
+            "reqd": 0
+        }
+    ]
+};
@@ -0,0 +1,146 @@
+from collections import deque
+
+import frappe
+from frappe import _
+from frappe.utils import cint, date_diff, flt, getdate
+
+
+def execute(filters=None):
+    filters = frappe._dict(filters or {})
+    ranges = get_ranges(filters.get("ranges"))
+    return get_columns(filters, ranges), get_data(filters, ranges)
+
+
+def get_ranges(ranges):
+    """Parses "30, 60, 90" into the sorted upper bounds of the aging buckets."""
+    bounds = sorted({cint(value) for value in (ranges or "30, 60, 90").split(",") if cint(value) > 0})
+    if not bounds:
+        frappe.throw(_("Aging Ranges must be a comma separated list of days, e.g. 30, 60, 90"))
+    return bounds
+
+
+def get_range_labels(ranges):
+    labels, lower = [], 0
+    for upper in ranges:
+        labels.append(f"{lower}-{upper}")
+        lower = upper + 1
+    labels.append(f"{lower}-" + _("Above"))
+    return labels
+
+
+def get_columns(filters, ranges):
+    columns = [
+        {"label": _("Purchase Loan Request"), "fieldname": "purchase_loan_request", "fieldtype": "Link", "options": "Purchase Loan Request", "width": 200},
+        {"label": _("Employee ID"), "fieldname": "employee", "fieldtype": "Link", "options": "Employee", "width": 130},
+        {"label": _("Employee Name"), "fieldname": "employee_name", "fieldtype": "Data", "width": 180},
+        {"label": _("Loan Currency"), "fieldname": "loan_currency", "fieldtype": "Link", "options": "Currency", "width": 100},
+        {"label": _("Oldest Payment Date"), "fieldname": "oldest_payment_date", "fieldtype": "Date", "width": 140},
+        {"label": _("Outstanding Amount From Repayment"), "fieldname": "outstanding_amount", "fieldtype": "Currency", "options": "currency", "width": 220},
+    ]
+    for index, label in enumerate(get_range_labels(ranges)):
+        columns.append({"label": label, "fieldname": f"range{index + 1}", "fieldtype": "Currency", "options": "currency", "width": 130})
+    columns.append({"label": _("Currency"), "fieldname": "currency", "fieldtype": "Link", "options": "Currency", "hidden": 1})
+    return columns
+
+
+def get_data(filters, ranges):
+    as_of_date = getdate(filters.get("as_of_date"))
+    company_currency = frappe.get_cached_value("Company", filters.get("company"), "default_currency")
+
+    outstanding_loans = {}
+    for purchase_loan_request, open_payments in iter_open_payments(filters, as_of_date):
+        buckets = [0.0] * (len(ranges) + 1)
+        for payment_date, amount in open_payments:
+            buckets[get_bucket(date_diff(as_of_date, payment_date), ranges)] += amount
+        outstanding_loans[purchase_loan_request] = (open_payments[0][0], buckets)
+
+    if not outstanding_loans:
+        return []
+
+    loans = {
+        loan.name: loan
+        for loan in frappe.get_all(
+            "Purchase Loan Request",
+            filters={"name": ["in", list(outstanding_loans)]},
+            fields=["name", "employee", "employee_name", "currency"],
+        )
+    }
+
+    data = []
+    for purchase_loan_request, (oldest_payment_date, buckets) in outstanding_loans.items():
+        loan = loans.get(purchase_loan_request) or frappe._dict()
+        row = {
+            "purchase_loan_request": purchase_loan_request,
+            "employee": loan.employee,
+            "employee_name": loan.employee_name,
+            "loan_currency": loan.currency,
+            "oldest_payment_date": oldest_payment_date,
+            "outstanding_amount": sum(buckets),
+            "currency": company_currency,
+        }
+        row.update({f"range{index + 1}": amount for index, amount in enumerate(buckets)})
+        data.append(row)
+
+    return data
+
+
+def get_bucket(age, ranges):
+    for index, upper in enumerate(ranges):
+        if age <= upper:
+            return index
+    return len(ranges)
+
+
+def iter_open_payments(filters, as_of_date):
+    """
+    Streams the ledger ordered by loan and date and yields (purchase_loan_request, open_payments)
+    for every loan with an unrepaid balance, where open_payments is a list of
+    [payment_date, remaining_amount] left after matching RePay rows against Pay rows first in,
+    first out. Rows are read as tuples through an unbuffered cursor, so only one loan's
+    payments are held in memory at a time. Amounts are in company currency.
+    """
+    conditions, values = ["cancelled = 0", "company = %(company)s", "posting_date <= %(as_of_date)s"], {
+        "company": filters.get("company"),
+        "as_of_date": as_of_date,
+    }
+    if filters.get("employee"):
+        conditions.append("employee = %(employee)s")
+        values["employee"] = filters.get("employee")
+    if filters.get("purchase_loan_request"):
+        conditions.append("purchase_loan_request = %(purchase_loan_request)s")
+        values["purchase_loan_request"] = filters.get("purchase_loan_request")
+
+    query = f"""
+        SELECT purchase_loan_request, posting_date, purchase_loan_payment_type, amount
+        FROM `tabPurchase Loan Ledger`
+        WHERE {" AND ".join(conditions)}
+        ORDER BY purchase_loan_request, posting_date, creation
+    """
+
+    current_loan, open_payments, credit = None, deque(), 0.0
+    with frappe.db.unbuffered_cursor():
+        for purchase_loan_request, posting_date, payment_type, amount in frappe.db.sql(query, values, as_iterator=True):
+            if purchase_loan_request != current_loan:
+                if open_payments:
+                    yield current_loan, list(open_payments)
+                current_loan, open_payments, credit = purchase_loan_request, deque(), 0.0
+
+            amount = flt(amount)
+            if payment_type == "Pay":
+                # Repayments received ahead of the payment settle it straight away
+                settled = min(credit, amount)
+                credit -= settled
+                if amount - settled > 0.005:
+                    open_payments.append([getdate(posting_date), amount - settled])
+                continue
+
+            while amount > 0.005 and open_payments:
+                settled = min(open_payments[0][1], amount)
+                open_payments[0][1] -= settled
+                amount -= settled
+                if open_payments[0][1] <= 0.005:
+                    open_payments.popleft()
+            credit += max(amount, 0)
+
+    if open_payments:
+        yield current_loan, list(open_payments)
@@ -0,0 +1,175 @@
+import frappe
+from frappe import _
+from frappe.utils import add_months, flt, get_last_day, getdate, today
+
+from purchase_loans.purchase_loans.company_settings import get_loan_company_settings
+from purchase_loans.purchase_loans.exchange_rate import get_cached_exchange_rate
+
+REVALUATION_VOUCHER_TYPE = "Exchange Rate Revaluation"
+
+
+def revalue_purchase_loans_monthly():
+    """Monthly job: revalues the open foreign-currency loans at the last day of the previous month."""
+    revalue_purchase_loans(get_last_day(add_months(today(), -1)))
+
+
+@frappe.whitelist()
+def revalue_purchase_loans(closing_date=None, company=None):
+    """
+    Revalues the outstanding balance (paid - repaid, in loan currency) of every submitted
+    foreign-currency Purchase Loan Request at the exchange rate of `closing_date`.
+
+    The balances of all loans are read in one query and the unrealized gain or loss of each loan is
+    worked out in a single pass with one cached rate per currency pair. Only the change against the
+    amount booked by the previous revaluation is posted, as one Journal Entry per company, so a run
+    repeated for the same date posts nothing. Loans that were settled, closed or cancelled since get
+    their earlier revaluation reversed. Open loans without a booked exchange rate are skipped and logged.
+    """
+    if frappe.session.user != "Administrator":
+        frappe.only_for(["System Manager", "Accounts Manager"])
+
+    closing_date = getdate(closing_date or today())
+    conditions, values = "", {"closing_date": closing_date}
+    if company:
+        conditions = "AND loan.company = %(company)s"
+        values["company"] = company
+
+    loans = frappe.db.sql(
+        f"""
+        SELECT loan.name, loan.employee, loan.company, loan.currency, company.default_currency,
+            loan.exchange_rate, loan.paid_amount_from_request - loan.repaid_amount AS balance,
+            loan.docstatus, loan.closed, loan.unrealized_exchange_gain_loss
+        FROM `tabPurchase Loan Request` loan
+        JOIN `tabCompany` company ON company.name = loan.company
+        WHERE loan.docstatus != 0 AND loan.currency != company.default_currency
+            AND ((loan.docstatus = 1 AND loan.closed = 0) OR loan.unrealized_exchange_gain_loss != 0)
+            AND (loan.last_revaluation_date IS NULL OR loan.last_revaluation_date <= %(closing_date)s)
+            {conditions}
+        """,
+        values,
+        as_dict=True,
+    )
+
+    rates, adjustments, skipped_loans = {}, {}, []
+    for loan in loans:
+        pair = (loan.currency, loan.default_currency)
+        if pair not in rates:
+            rates[pair] = get_cached_exchange_rate(*pair, closing_date)
+            if not rates[pair]:
+                frappe.throw(_("No exchange rate found from {0} to {1} on {2}.").format(*pair, closing_date))
+
+        balance = flt(loan.balance) if loan.docstatus == 1 and not loan.closed else 0
+        if balance and not flt(loan.exchange_rate):
+            # Without the rate it was booked at there is nothing to measure the change against
+            skipped_loans.append(loan.name)
+            continue
+
+        unrealized = flt(balance * (rates[pair] - flt(loan.exchange_rate)), 2)
+        adjustment = flt(unrealized - flt(loan.unrealized_exchange_gain_loss), 2)
+        if adjustment:
+            loan.unrealized_exchange_gain_loss = unrealized
+            adjustments.setdefault(loan.company, []).append((loan, adjustment))
+
+    if skipped_loans:
+        frappe.log_error(f"Purchase Loan revaluation skipped loans without a booked exchange rate: {', '.join(skipped_loans)}")
+
+    journal_entries = []
+    for loan_company, company_adjustments in adjustments.items():
+        journal_entry = _create_revaluation_journal_entry(loan_company, company_adjustments, closing_date)
+        _update_unrealized_exchange_gain_loss(
+            {loan.name: loan.unrealized_exchange_gain_loss for loan, _adjustment in company_adjustments}, closing_date
+        )
+        journal_entries.append(journal_entry.name)
+
+    return {
+        "journal_entries": journal_entries,
+        "revalued_loans": sum(len(company_adjustments) for company_adjustments in adjustments.values()),
+        "examined_loans": len(loans),
+        "skipped_loans": skipped_loans,
+    }
+
+
+def _create_revaluation_journal_entry(company, adjustments, closing_date):
+    """One row per loan on the loan account and the total on the Unrealized Exchange Gain/Loss account."""
+    company_settings = get_loan_company_settings(company)
+    gain_loss_account = company_settings.unrealized_exchange_gain_loss_account or company_settings.exchange_gain_loss_account
+    if not company_settings.purchase_loan_account:
+        frappe.throw(_("Purchase Loan Account not set in the Company for {0}").format(company))
+    if not gain_loss_account:
+        frappe.throw(_("Unrealized Exchange Gain/Loss Account is not set for the company {0}. Please configure it in Company settings.").format(company))
+
+    accounts = [
+        {
+            "account": company_settings.purchase_loan_account,
+            "debit_in_account_currency" if adjustment > 0 else "credit_in_account_currency": abs(adjustment),
+            "reference_type": "Purchase Loan Request",
+            "reference_name": loan.name,
+            "party_type": "Employee",
+            "party": loan.employee,
+        }
+        for loan, adjustment in adjustments
+    ]
+    total = flt(sum(adjustment for _loan, adjustment in adjustments), 2)
+    if total:
+        accounts.append({
+            "account": gain_loss_account,
+            "credit_in_account_currency" if total > 0 else "debit_in_account_currency": abs(total),
+        })
+
+    journal_entry = frappe.get_doc({
+        "doctype": "Journal Entry",
+        "voucher_type": REVALUATION_VOUCHER_TYPE,
+        "posting_date": closing_date,
+        "company": company,
+        "multi_currency": 1,
+        "user_remark": _("Revaluation of {0} open Purchase Loan Requests as of {1}").format(len(adjustments), closing_date),
+        "accounts": accounts,
+    })
+    journal_entry.insert(ignore_permissions=True)
+    journal_entry.submit()
+    return journal_entry
+
+
+def _update_unrealized_exchange_gain_loss(amounts, closing_date):
+    """Sets the unrealized gain or loss ({loan: amount}) of many loans in one UPDATE."""
+    loans = list(amounts)
+    frappe.db.sql(
+        f"""
+        UPDATE `tabPurchase Loan Request`
+        SET unrealized_exchange_gain_loss = CASE name {" ".join(["WHEN %s THEN %s"] * len(loans))} END,
+            last_revaluation_date = %s
+        WHERE name IN %s
+        """,
+        (*(value for loan in loans for value in (loan, amounts[loan])), closing_date, tuple(loans)),
+    )
+
+
+def revert_purchase_loan_revaluation(doc):
+    """
+    Journal Entry on_cancel: takes the amounts of a cancelled revaluation back off its loans and
+    moves their revaluation date back to the latest revaluation still submitted.
+    """
+    amounts = {}
+    for row in doc.accounts:
+        if row.reference_type == "Purchase Loan Request" and row.reference_name:
+            amounts[row.reference_name] = amounts.get(row.reference_name, 0) + flt(row.debit_in_account_currency) - flt(row.credit_in_account_currency)
+    if not amounts:
+        return
+
+    loans = list(amounts)
+    frappe.db.sql(
+        f"""
+        UPDATE `tabPurchase Loan Request` loan
+        SET loan.unrealized_exchange_gain_loss = loan.unrealized_exchange_gain_loss
+                - CASE loan.name {" ".join(["WHEN %s THEN %s"] * len(loans))} END,
+            loan.last_revaluation_date = (
+                SELECT MAX(je.posting_date)
+                FROM `tabJournal Entry Account` jea
+                JOIN `tabJournal Entry` je ON je.name = jea.parent
+                WHERE jea.reference_type = 'Purchase Loan Request' AND jea.reference_name = loan.name
+                    AND je.voucher_type = %s AND je.docstatus = 1
+            )
+        WHERE loan.name IN %s
+        """,
+        (*(value for loan in loans for value in (loan, amounts[loan])), REVALUATION_VOUCHER_TYPE, tuple(loans)),
+    )
@@ -5,6 +5,12 @@ from frappe import _
 import random
 import string
 import re
+from purchase_loans.purchase_loans.attachments import copy_attachments
+from purchase_loans.purchase_loans.company_settings import get_loan_company_settings
+from purchase_loans.purchase_loans.doctype.purchase_loan_employee_exposure.purchase_loan_employee_exposure import (
+    rebuild_employee_exposure,
+    update_employee_exposure,
+)
 
 
 
@@ -39,7 +45,7 @@ def validate_posting_date(doc, method):
 def copy_attachments_to_target(target_doctype, target_docname, source_doctype, transaction_unique_id_field="custom_transaction_unique_id"):
     """
     Copies all attachments from a source doctype to a target doctype based on a shared Transaction Unique ID.
-    Before inserting, it checks if the file is already attached to the target document.
+    Files already attached to the target document are skipped.
 
     Args:
         target_doctype (str): The target doctype to attach files to (e.g., "Purchase Invoice").
@@ -51,78 +57,76 @@ def copy_attachments_to_target(target_doctype, target_docname, source_doctype, t
         frappe.ValidationError: If the source document or attachments are not found.
     """
     try:
-        # Fetch the target document
-        target_doc = frappe.get_doc(target_doctype, target_docname)
-
         # Ensure the target document has a Transaction Unique ID
-        transaction_unique_id = getattr(target_doc, transaction_unique_id_field, None)
+        transaction_unique_id = frappe.db.get_value(target_doctype, target_docname, transaction_unique_id_field)
         if not transaction_unique_id:
             frappe.throw(
                 _(f"Transaction Unique ID ({transaction_unique_id_field}) is missing in the {target_doctype}: {target_docname}")
             )
 
-        # Find the source documents with the same Transaction Unique ID
-        source_docs = frappe.get_all(
-            source_doctype,
-            filters={transaction_unique_id_field: transaction_unique_id},
-            fields=["name"]
+        source_docname, counters = pull_attachments_from_source(
+            target_doctype, target_docname, source_doctype, transaction_unique_id_field
         )
-
-        if not source_docs:
+        if not source_docname:
             frappe.throw(
                 _(f"No {source_doctype} found with the same Transaction Unique ID: {transaction_unique_id}")
             )
 
-        # Fetch the first matching source document (adjust this if multiple matches are expected)
-        source_docname = source_docs[0].get("name")
-
-        # Get all attachments linked to the source document
-        attachments = frappe.get_all(
-            "File",
-            filters={"attached_to_doctype": source_doctype, "attached_to_name": source_docname},
-            fields=["file_url", "file_name"]
-        )
-
-        if not attachments:
+        if not counters["rows_examined"]:
             frappe.msgprint(_(f"No attachments found in the related {source_doctype}: {source_docname}"))
-            return
-
-        # Attach files to the target document
-        for attachment in attachments:
-            # Check if the file is already attached to the target document
-            existing_attachment = frappe.get_all(
-                "File",
-                filters={
-                    "attached_to_doctype": target_doctype,
-                    "attached_to_name": target_docname,
-                    "file_url": attachment["file_url"],
-                    "file_name": attachment["file_name"]
-                },
-                fields=["name"]
+        elif counters["rows_inserted"]:
+            frappe.msgprint(
+                _(f"Attachments copied successfully from {source_doctype} ({source_docname}) to {target_doctype} ({target_docname})")
             )
 
-            if existing_attachment:
-                frappe.msgprint(_(f"File {attachment['file_name']} already attached to {target_doctype}: {target_docname}"))
-                continue  # Skip if file is already attached
-
-            # If file is not attached, add it
-            frappe.get_doc({
-                "doctype": "File",
-                "file_url": attachment["file_url"],
-                "file_name": attachment["file_name"],
-                "attached_to_doctype": target_doctype,
-                "attached_to_name": target_docname
-            }).insert(ignore_permissions=True)
-
-        frappe.msgprint(
-            _(f"Attachments copied successfully from {source_doctype} ({source_docname}) to {target_doctype} ({target_docname})")
-        )
-
     except Exception as e:
         frappe.log_error(f"Error in copying attachments: {str(e)}")
         frappe.throw(_("An error occurred while copying attachments."))
 
 
+def pull_attachments_from_source(target_doctype, target_docname, source_doctype, transaction_unique_id_field="custom_transaction_unique_id"):
+    """
+    Background job behind `enqueue_copy_attachments_to_target`: references the attachments of the
+    first source document sharing the target's Transaction Unique ID. Returns (source name, counters),
+    with no source name when the target has no ID or no source matches it; nothing is shown or raised,
+    as the document may have changed since the job was queued.
+    """
+    transaction_unique_id = frappe.db.get_value(target_doctype, target_docname, transaction_unique_id_field)
+    if not transaction_unique_id:
+        return None, {"rows_examined": 0, "rows_inserted": 0}
+
+    source_docname = frappe.db.get_value(source_doctype, {transaction_unique_id_field: transaction_unique_id}, "name")
+    if not source_docname:
+        return None, {"rows_examined": 0, "rows_inserted": 0}
+
+    return source_docname, copy_attachments(source_doctype, source_docname, target_doctype, target_docname)
+
+
+def enqueue_copy_attachments_to_target(target_doctype, target_docname, source_doctype):
+    """
+    Runs `pull_attachments_from_source` in the background once the current transaction commits.
+    The job is keyed by the target document, so repeated saves while one is queued collapse into it.
+    Callers only pull when the Transaction Unique ID is set or changed; files attached to the source
+    afterwards are pushed by the File hook (`propagate_file_attachment`).
+    """
+    job_id = f"purchase_loans_copy_attachments::{target_doctype}::{target_docname}"
+    # A document saved twice in one request only needs one job
+    enqueued = frappe.flags.setdefault("purchase_loans_attachment_jobs", set())
+    if job_id in enqueued:
+        return
+    enqueued.add(job_id)
+
+    frappe.enqueue(
+        pull_attachments_from_source,
+        queue="short",
+        job_id=job_id,
+        deduplicate=True,
+        enqueue_after_commit=True,
+        target_doctype=target_doctype,
+        target_docname=target_docname,
+        source_doctype=source_doctype,
+    )
+
 
 def notify_purchase_order_and_invoice_issues():
 
@@ -641,10 +645,9 @@ def transfer_expired_batch_on_validate(doc, method):
     # Process the transfer
     for batch in expired_batch:
         company = batch["company"]
-        company_record = frappe.get_doc("Company", company)
-        custom_warehouse = company_record.custom_warehouse
-        custom_enable_automatic_transfer = company_record.custom_enable_automatic_transfer
-        if custom_enable_automatic_transfer == "No":
+        company_settings = get_loan_company_settings(company)
+        custom_warehouse = company_settings.warehouse
+        if not company_settings.enable_automatic_transfer:
             return
 
         if not custom_warehouse:
@@ -739,10 +742,9 @@ def transfer_expired_batches():
 
     for batch in expired_batches:
         company = batch["company"]
-        company_record = frappe.get_doc("Company", company)
-        custom_warehouse = company_record.custom_warehouse
-        custom_enable_automatic_transfer = company_record.custom_enable_automatic_transfer
-        if custom_enable_automatic_transfer == "No":
+        company_settings = get_loan_company_settings(company)
+        custom_warehouse = company_settings.warehouse
+        if not company_settings.enable_automatic_transfer:
             return
         if not custom_warehouse:
             frappe.log_error("Custom Warehouse is not set in the Company configuration.")
@@ -782,32 +784,55 @@ def transfer_expired_batches():
         )
 
             
-@frappe.whitelist()
-def update_purchase_loan_request(purchase_loan_request_name):
+LOAN_BALANCE_FIELDS = (
+    "paid_amount_from_request",
+    "repaid_amount",
+    "outstanding_amount_from_request",
+    "outstanding_amount_from_repayment",
+    "overpaid_payment_amount",
+    "overpaid_repayment_amount",
+)
+
+
+def get_loan_exchange_rate(loan):
     """
-    Updates a Purchase Loan Request document with aggregate values from the ledger.
+    Returns the rate used to convert ledger amounts (company currency) into the loan currency.
+    Loans in the company currency always use 1.0.
+    """
+    company_currency = get_loan_company_settings(loan.company).default_currency
+    if company_currency != loan.currency:
+        return flt(loan.exchange_rate) or 1.0
+    return 1.0
 
-    Given a Purchase Loan Request document name, this function aggregates the total paid and
-    total repaid amounts from the ledger and calculates the outstanding and overpaid amounts.
-    The Purchase Loan Request document is then updated with the calculated values.
 
-    :param purchase_loan_request_name: The name of the Purchase Loan Request document to update.
+def calculate_loan_balances(request_amount, total_paid, total_repaid):
     """
-    if not purchase_loan_request_name:
-        return
+    Derives the balance fields of a Purchase Loan Request from the requested amount and the
+    paid and repaid totals. All three amounts must be in the same currency.
+    """
+    # Calculate overpaid amount
+    overpaid_repayment_amount = 0.0
+    if total_repaid > request_amount:
+        overpaid_repayment_amount = max(total_repaid - total_paid, 0)
 
-    loan_request_doc = frappe.get_doc("Purchase Loan Request", purchase_loan_request_name)
+    return {
+        "paid_amount_from_request": total_paid,
+        "repaid_amount": total_repaid,
+        "outstanding_amount_from_request": max(request_amount - total_paid, 0),
+        "outstanding_amount_from_repayment": max(total_paid - total_repaid, 0),
+        "overpaid_payment_amount": max(total_paid - request_amount, 0),
+        "overpaid_repayment_amount": overpaid_repayment_amount,
+    }
 
-    company_currency = frappe.db.get_value(
-        "Company", filters={"name": loan_request_doc.company}, fieldname="default_currency"
-    )
-    
-    if company_currency != loan_request_doc.currency:
-        exchange_rate = loan_request_doc.exchange_rate
-    else:
-        exchange_rate = 1.0
 
-    request_amount = loan_request_doc.request_amount * exchange_rate
+def get_ledger_balances(loan):
+    """
+    Aggregates the non-cancelled Purchase Loan Ledger rows of a loan and returns the balance
+    fields in the loan currency.
+
+    :param loan: dict with name, company, currency, exchange_rate and request_amount.
+    """
+    exchange_rate = get_loan_exchange_rate(loan)
 
     # Aggregate paid and repayment amounts from the ledger
     ledger_totals = frappe.db.sql("""
@@ -816,45 +841,259 @@ def update_purchase_loan_request(purchase_loan_request_name):
             SUM(CASE WHEN purchase_loan_payment_type = 'RePay' AND cancelled = 0 THEN amount ELSE 0 END) AS total_repaid
         FROM `tabPurchase Loan Ledger`
         WHERE purchase_loan_request = %s
-    """, (purchase_loan_request_name), as_dict=True)[0]
+    """, (loan.name,), as_dict=True)[0]
 
     # Ensure totals default to 0 if None
-    total_paid = ledger_totals.get('total_paid') or 0
-    total_repaid = ledger_totals.get('total_repaid') or 0
+    total_paid = flt(ledger_totals.get('total_paid'))
+    total_repaid = flt(ledger_totals.get('total_repaid'))
 
-    # Calculate overpaid amount
-    overpaid_amount = 0.0
-    if total_repaid > request_amount:
-        overpaid_amount = max(total_repaid - total_paid, 0)
+    return calculate_loan_balances(
+        flt(loan.request_amount), total_paid / exchange_rate, total_repaid / exchange_rate
+    )
+
+
+def _get_loan_for_balance(purchase_loan_request_name, for_update=False):
+    return frappe.db.get_value(
+        "Purchase Loan Request",
+        purchase_loan_request_name,
+        ["name", "employee", "company", "currency", "exchange_rate", "request_amount", "docstatus", "closed", *LOAN_BALANCE_FIELDS],
+        as_dict=True,
+        for_update=for_update,
+    )
+
+
+def get_ledger_stamp(purchase_loan_request_name):
+    """
+    Returns a version stamp of the ledger rows of a Purchase Loan Request ("<row count>:<last modified>").
+    Any insert or cancellation changes it, and it is read from the (purchase_loan_request, modified) index only.
+    """
+    row_count, last_modified = frappe.db.sql("""
+        SELECT COUNT(*), MAX(modified)
+        FROM `tabPurchase Loan Ledger`
+        WHERE purchase_loan_request = %s
+    """, (purchase_loan_request_name,))[0]
 
-    # Calculate outstanding amounts
-    outstanding_from_repayment = max(total_paid - total_repaid, 0)
-    outstanding_from_request = max(request_amount - total_paid, 0)
-    overpaid_payment_amount = max(total_paid - request_amount, 0)
+    return f"{cint(row_count)}:{cstr(last_modified)}"
+
+
+@frappe.whitelist()
+def get_purchase_loan_balance(purchase_loan_request_name):
+    """
+    Returns the balance fields of a Purchase Loan Request for display.
+
+    The stored values are returned as they are while the ledger stamp saved with them still matches
+    the ledger; the balances are only recomputed (and written back) when the ledger changed since.
+
+    Returns:
+        dict: {"balances": {fieldname: value}, "recomputed": bool}
+    """
+    frappe.has_permission("Purchase Loan Request", "read", purchase_loan_request_name, throw=True)
+
+    loan = frappe.db.get_value(
+        "Purchase Loan Request",
+        purchase_loan_request_name,
+        ["name", "docstatus", "company", "currency", "exchange_rate", "request_amount", "ledger_stamp", *LOAN_BALANCE_FIELDS],
+        as_dict=True,
+    )
+    if not loan:
+        return {"balances": {}, "recomputed": False}
+
+    balances = {fieldname: flt(loan.get(fieldname)) for fieldname in LOAN_BALANCE_FIELDS}
+    if loan.docstatus != 1:
+        return {"balances": balances, "recomputed": False}
+
+    ledger_stamp = get_ledger_stamp(purchase_loan_request_name)
+    if ledger_stamp == cstr(loan.ledger_stamp):
+        return {"balances": balances, "recomputed": False}
+
+    # Lock the loan and move its exposure from the stored balances to the recomputed ones
+    loan = _get_loan_for_balance(purchase_loan_request_name, for_update=True)
+    balances = get_ledger_balances(loan)
+    update_employee_exposure(loan, balances)
+    frappe.db.set_value(
+        "Purchase Loan Request",
+        purchase_loan_request_name,
+        {**balances, "ledger_stamp": ledger_stamp},
+        update_modified=False,
+    )
+    # Called over GET, so ask the request handler to keep the write
+    frappe.local.flags.commit = True
+
+    return {"balances": balances, "recomputed": True}
+
+
+@frappe.whitelist()
+def update_purchase_loan_request(purchase_loan_request_name):
+    """
+    Updates a Purchase Loan Request document with aggregate values from the ledger.
+
+    Given a Purchase Loan Request document name, this function aggregates the total paid and
+    total repaid amounts from the ledger and calculates the outstanding and overpaid amounts.
+    The Purchase Loan Request document is then updated with the calculated values.
+
+    This is the full recompute; ledger postings keep the balances current through
+    `apply_purchase_loan_balance_delta` instead. Nothing is committed here.
+
+    :param purchase_loan_request_name: The name of the Purchase Loan Request document to update.
+    """
+    recompute_purchase_loan_balances(purchase_loan_request_name)
+
+
+def recompute_purchase_loan_balances(purchase_loan_request_name, update_exposure=True):
+    """
+    Writes the ledger balances of a loan. Pass `update_exposure=False` when the caller counts the
+    whole loan in the employee's exposure itself, as on submit, so it is not counted twice.
+    """
+    if not purchase_loan_request_name:
+        return
+
+    loan = _get_loan_for_balance(purchase_loan_request_name, for_update=True)
+    if not loan:
+        return
 
     # Update the Purchase Loan Request document with calculated values
-    frappe.db.sql("""
+    balances = get_ledger_balances(loan)
+    if update_exposure:
+        update_employee_exposure(loan, balances)
+    frappe.db.set_value(
+        "Purchase Loan Request",
+        purchase_loan_request_name,
+        {**balances, "ledger_stamp": get_ledger_stamp(purchase_loan_request_name)},
+        update_modified=False,
+    )
+
+
+def apply_purchase_loan_balance_delta(purchase_loan_request_name, paid_delta=0.0, repaid_delta=0.0):
+    """
+    Applies signed ledger amounts (company currency) to the balance fields of a Purchase Loan
+    Request without re-aggregating the ledger. The request row is locked for the rest of the
+    transaction so concurrent postings on the same loan are serialized, and the paid and repaid
+    totals are moved with `x = x + delta` in the same transaction, so a rollback to a savepoint
+    takes the delta back together with the ledger row that caused it.
+    """
+    if not purchase_loan_request_name or not (flt(paid_delta) or flt(repaid_delta)):
+        return
+
+    loan = _get_loan_for_balance(purchase_loan_request_name, for_update=True)
+    if not loan:
+        return
+
+    exchange_rate = get_loan_exchange_rate(loan)
+    paid_delta, repaid_delta = flt(paid_delta) / exchange_rate, flt(repaid_delta) / exchange_rate
+    balances = calculate_loan_balances(
+        flt(loan.request_amount),
+        flt(loan.paid_amount_from_request) + paid_delta,
+        flt(loan.repaid_amount) + repaid_delta,
+    )
+    update_employee_exposure(loan, balances)
+
+    derived_fields = [fieldname for fieldname in LOAN_BALANCE_FIELDS if fieldname not in ("paid_amount_from_request", "repaid_amount")]
+    frappe.db.sql(
+        f"""
         UPDATE `tabPurchase Loan Request`
-        SET 
-            paid_amount_from_request = %s,
-            repaid_amount = %s,
-            outstanding_amount_from_request = %s,
-            outstanding_amount_from_repayment = %s,
-            overpaid_payment_amount = %s,
-            overpaid_repayment_amount = %s
-        WHERE name = %s
-    """, (
-        total_paid / exchange_rate,
-        total_repaid / exchange_rate,
-        outstanding_from_request / exchange_rate,
-        outstanding_from_repayment / exchange_rate,
-        overpaid_payment_amount / exchange_rate,
-        overpaid_amount / exchange_rate,
-        purchase_loan_request_name
-    ))
-
-    # Commit changes to the database
-    frappe.db.commit()
+        SET {", ".join(f"{fieldname} = %({fieldname})s" for fieldname in derived_fields)},
+            paid_amount_from_request = paid_amount_from_request + %(paid_delta)s,
+            repaid_amount = repaid_amount + %(repaid_delta)s
+        WHERE name = %(name)s
+        """,
+        {
+            **{fieldname: balances[fieldname] for fieldname in derived_fields},
+            "paid_delta": paid_delta,
+            "repaid_delta": repaid_delta,
+            "name": purchase_loan_request_name,
+        },
+    )
+    mark_purchase_loan_dirty(purchase_loan_request_name)
+
+
+def mark_purchase_loan_dirty(purchase_loan_request_name):
+    """
+    Queues a Purchase Loan Request whose ledger rows changed. Its ledger stamp is refreshed once,
+    right before the transaction commits, so a repayment posting many journals reads the stamp of
+    its loan a single time. A rollback discards the queue.
+    """
+    if not purchase_loan_request_name:
+        return
+
+    pending = getattr(frappe.local, "purchase_loan_balance_updates", None)
+    if pending is None:
+        pending = frappe.local.purchase_loan_balance_updates = set()
+        frappe.db.before_commit.add(flush_purchase_loan_balances)
+        frappe.db.after_rollback.add(discard_purchase_loan_balances)
+
+    pending.add(purchase_loan_request_name)
+
+
+def flush_purchase_loan_balances():
+    """
+    Stamps the queued loans of the current transaction with their ledger stamp. Runs
+    automatically before commit; the balance fields themselves are already current.
+
+    Set `purchase_loans_verify_balances` in site config to also re-aggregate the ledger of each
+    queued loan here and log any drift.
+    """
+    pending = getattr(frappe.local, "purchase_loan_balance_updates", None)
+    frappe.local.purchase_loan_balance_updates = None
+    if not pending:
+        return
+
+    # Lock the loans in a fixed order so concurrent flushes cannot deadlock
+    for purchase_loan_request_name in sorted(pending):
+        frappe.db.set_value(
+            "Purchase Loan Request",
+            purchase_loan_request_name,
+            "ledger_stamp",
+            get_ledger_stamp(purchase_loan_request_name),
+            update_modified=False,
+        )
+        if frappe.conf.get("purchase_loans_verify_balances"):
+            verify_purchase_loan_balance(purchase_loan_request_name)
+
+
+def discard_purchase_loan_balances():
+    frappe.local.purchase_loan_balance_updates = None
+
+
+@frappe.whitelist()
+def verify_purchase_loan_balance(purchase_loan_request_name, repair=False):
+    """
+    Re-aggregates the ledger of a Purchase Loan Request and compares it with the stored balance
+    fields. Any drift is logged and returned as {fieldname: {"stored": x, "ledger": y}}.
+    Passing `repair` overwrites the stored fields with the ledger values.
+    """
+    repair = cint(repair)
+    if repair:
+        frappe.only_for(["System Manager", "Accounts Manager"])
+
+    loan = _get_loan_for_balance(purchase_loan_request_name)
+    if not loan:
+        return {}
+
+    expected = get_ledger_balances(loan)
+    drift = {
+        fieldname: {"stored": flt(loan.get(fieldname)), "ledger": flt(expected[fieldname])}
+        for fieldname in LOAN_BALANCE_FIELDS
+        if abs(flt(loan.get(fieldname)) - flt(expected[fieldname])) > 0.001
+    }
+
+    if drift:
+        frappe.log_error(
+            title="Purchase Loan Balance Drift",
+            message=f"Purchase Loan Request {purchase_loan_request_name}: {frappe.as_json(drift)}",
+        )
+        if repair:
+            update_employee_exposure(loan, expected)
+            expected["ledger_stamp"] = get_ledger_stamp(purchase_loan_request_name)
+            frappe.db.set_value("Purchase Loan Request", purchase_loan_request_name, expected, update_modified=False)
+
+    return drift
+
+
+def _get_balance_delta(purchase_loan_payment_type, amount):
+    """Returns the (paid_delta, repaid_delta) pair for a ledger row."""
+    if purchase_loan_payment_type == "Pay":
+        return flt(amount), 0.0
+    return 0.0, flt(amount)
 
 
 @frappe.whitelist()
@@ -864,23 +1103,104 @@ def cancel_purchase_loan_ledger(doc):
     Cancels a Purchase Loan Ledger entry. This is a whitelisted function called
     by a hook on a custom doctype. It takes a doc object as argument, and
     requires the doc.name to be present. It then gets the Purchase Loan Ledger
-    record linked to the doc and updates the cancelled field to 1.
+    records linked to the doc, updates their cancelled field to 1 and reverses their
+    amounts on the Purchase Loan Request balances.
     """
     if not doc.name:
         frappe.throw("Document name is required.")
     
-    # Get the Purchase Loan Ledger record linked to the doc
-    ledger_entry = frappe.get_all("Purchase Loan Ledger", filters={
-        "purchase_loan_request": doc.custom_purchase_loan_request,
-        "reference_name": doc.name
-    })
+    # Get the Purchase Loan Ledger records linked to the doc. A bulk payout journal has no
+    # custom_purchase_loan_request and carries one ledger row per loan it paid.
+    filters = {"reference_name": doc.name, "cancelled": 0}
+    if doc.get("custom_purchase_loan_request"):
+        filters["purchase_loan_request"] = doc.custom_purchase_loan_request
+
+    ledger_entries = frappe.get_all(
+        "Purchase Loan Ledger",
+        filters=filters,
+        fields=["name", "purchase_loan_request", "purchase_loan_payment_type", "amount", "posting_date"],
+    )
+
+    if ledger_entries:
+        from purchase_loans.purchase_loans.doctype.purchase_loan_balance_snapshot.purchase_loan_balance_snapshot import (
+            invalidate_purchase_loan_balance_snapshots,
+        )
 
-    if ledger_entry:
         # Update the cancelled field to 1
-        frappe.db.set_value("Purchase Loan Ledger", ledger_entry[0].name, "cancelled", 1)
-        
-        # Commit the transaction
-        frappe.db.commit()
+        frappe.db.set_value(
+            "Purchase Loan Ledger", {"name": ["in", [entry.name for entry in ledger_entries]]}, "cancelled", 1
+        )
+
+        for entry in ledger_entries:
+            invalidate_purchase_loan_balance_snapshots(entry.purchase_loan_request, entry.posting_date)
+            paid_delta, repaid_delta = _get_balance_delta(entry.purchase_loan_payment_type, entry.amount)
+            apply_purchase_loan_balance_delta(entry.purchase_loan_request, -paid_delta, -repaid_delta)
+
+def cancel_purchase_loan_ledger_bulk(reference_names):
+    """
+    Cancels the Purchase Loan Ledger rows of many journals with one UPDATE and reverses their
+    amounts with one delta per loan. Used when journals are cancelled with `flags.purchase_loan_bulk_cancel`, in which case
+    the Journal Entry hook leaves the ledger to the caller.
+    """
+    if not reference_names:
+        return
+
+    ledger_entries = frappe.get_all(
+        "Purchase Loan Ledger",
+        filters={"reference_name": ["in", list(reference_names)], "cancelled": 0},
+        fields=["name", "purchase_loan_request", "purchase_loan_payment_type", "amount", "posting_date"],
+    )
+    if not ledger_entries:
+        return
+
+    from purchase_loans.purchase_loans.doctype.purchase_loan_balance_snapshot.purchase_loan_balance_snapshot import (
+        invalidate_purchase_loan_balance_snapshots,
+    )
+
+    # modified moves too, so the ledger stamp of every affected loan changes
+    frappe.db.sql(
+        """
+        UPDATE `tabPurchase Loan Ledger`
+        SET cancelled = 1, modified = %s, modified_by = %s
+        WHERE name IN %s
+        """,
+        (frappe.utils.now(), frappe.session.user, tuple(entry.name for entry in ledger_entries)),
+    )
+
+    earliest_posting_date, deltas = {}, {}
+    for entry in ledger_entries:
+        paid_delta, repaid_delta = _get_balance_delta(entry.purchase_loan_payment_type, entry.amount)
+        paid, repaid = deltas.get(entry.purchase_loan_request, (0.0, 0.0))
+        deltas[entry.purchase_loan_request] = (paid - paid_delta, repaid - repaid_delta)
+
+        posting_date = getdate(entry.posting_date) if entry.posting_date else None
+        current = earliest_posting_date.get(entry.purchase_loan_request)
+        if posting_date and (not current or posting_date < current):
+            earliest_posting_date[entry.purchase_loan_request] = posting_date
+
+    # Lock the loans in a fixed order so concurrent bulk cancels cannot deadlock
+    for purchase_loan_request_name in sorted(deltas):
+        apply_purchase_loan_balance_delta(purchase_loan_request_name, *deltas[purchase_loan_request_name])
+        invalidate_purchase_loan_balance_snapshots(
+            purchase_loan_request_name, earliest_posting_date.get(purchase_loan_request_name)
+        )
+
+
+def cancel_journal_entries_in_bulk(journal_entry_names):
+    """
+    Cancels the given submitted Journal Entries and then their ledger rows in bulk. The per-journal
+    hook only reverses the GL entries; each loan's balances are reversed with one delta.
+    """
+    for journal_entry_name in journal_entry_names:
+        journal_entry = frappe.get_doc("Journal Entry", journal_entry_name)
+        if journal_entry.docstatus != 1:
+            continue
+        journal_entry.flags.purchase_loan_bulk_cancel = True
+        journal_entry.flags.ignore_permissions = True
+        journal_entry.cancel()
+
+    cancel_purchase_loan_ledger_bulk(journal_entry_names)
+
 
 @frappe.whitelist()
 def create_purchase_loan_ledger(doc, ledger_amount):
@@ -889,7 +1209,8 @@ def create_purchase_loan_ledger(doc, ledger_amount):
     Creates a new entry in the Purchase Loan Ledger based on the provided document.
     Determines the payment type (Pay or RePay) from the voucher type, calculates the
     paid amount, and records the necessary details such as employee, company, and 
-    posting date into the ledger. The new ledger entry is then inserted into the database.
+    posting date into the ledger. The new ledger entry is then inserted into the database
+    and its amount is applied to the Purchase Loan Request balances.
     
     Args:
         doc (Document): The document containing details needed for creating the 
@@ -897,19 +1218,143 @@ def create_purchase_loan_ledger(doc, ledger_amount):
         employee, company, and posting date.
     """
 
-    loan_request_doc = frappe.get_doc("Purchase Loan Request", doc.custom_purchase_loan_request)
+    employee = frappe.db.get_value("Purchase Loan Request", doc.custom_purchase_loan_request, "employee")
     purchase_loan_payment_type = "Pay" if doc.voucher_type =="Purchase Loan Payment" else "RePay"
     paid_amount = ledger_amount
     ledger_entry = frappe.get_doc({
         "doctype": "Purchase Loan Ledger",
-        "purchase_loan_request": loan_request_doc.name,
+        "purchase_loan_request": doc.custom_purchase_loan_request,
         "reference_name": doc.name,  
         "purchase_loan_payment_type": purchase_loan_payment_type,
-        "employee": loan_request_doc.employee,
+        "employee": employee,
         "company": doc.company,
         "posting_date": doc.posting_date,
         "amount": paid_amount
     })
 
+    from purchase_loans.purchase_loans.doctype.purchase_loan_balance_snapshot.purchase_loan_balance_snapshot import (
+        invalidate_purchase_loan_balance_snapshots,
+    )
+
     # Insert the record into the database
     ledger_entry.insert()
+    invalidate_purchase_loan_balance_snapshots(doc.custom_purchase_loan_request, doc.posting_date)
+
+    paid_delta, repaid_delta = _get_balance_delta(purchase_loan_payment_type, paid_amount)
+    apply_purchase_loan_balance_delta(doc.custom_purchase_loan_request, paid_delta, repaid_delta)
+
+
+def rebuild_purchase_loan_balances(purchase_loan_requests=None, company=None, employee=None, chunk_size=500, dry_run=False):
+    """
+    Recomputes the balance fields of every submitted Purchase Loan Request (or a filtered subset)
+    in one pass over the ledger and writes the changed rows back in chunks.
+
+    Usage:
+        bench --site <site> rebuild-purchase-loan-balances --dry-run
+        bench --site <site> execute purchase_loans.purchase_loans.tasks.rebuild_purchase_loan_balances
+            --kwargs "{'company': 'My Company', 'chunk_size': 1000}"
+
+    Args:
+        purchase_loan_requests (list | str): Limit the rebuild to these requests.
+        company (str): Limit the rebuild to one company.
+        employee (str): Limit the rebuild to one employee.
+        chunk_size (int): Number of requests written (and committed) per UPDATE.
+        dry_run (bool): Only report the differences, nothing is written.
+
+    Returns:
+        dict: counts of examined and changed requests, plus the per-field diff when dry_run is set.
+    """
+    chunk_size = max(cint(chunk_size), 1)
+    dry_run = cint(dry_run)
+
+    conditions, values = ["plr.docstatus = 1"], {}
+    if purchase_loan_requests:
+        if isinstance(purchase_loan_requests, str):
+            purchase_loan_requests = frappe.parse_json(purchase_loan_requests) if purchase_loan_requests.startswith("[") else [purchase_loan_requests]
+        conditions.append("plr.name IN %(purchase_loan_requests)s")
+        values["purchase_loan_requests"] = tuple(purchase_loan_requests)
+    if company:
+        conditions.append("plr.company = %(company)s")
+        values["company"] = company
+    if employee:
+        conditions.append("plr.employee = %(employee)s")
+        values["employee"] = employee
+
+    loans = frappe.db.sql(f"""
+        SELECT
+            plr.name, plr.request_amount, plr.currency, plr.exchange_rate,
+            company.default_currency AS company_currency,
+            {", ".join(f"plr.{fieldname}" for fieldname in LOAN_BALANCE_FIELDS)},
+            plr.ledger_stamp,
+            IFNULL(ledger.total_paid, 0) AS total_paid,
+            IFNULL(ledger.total_repaid, 0) AS total_repaid,
+            IFNULL(ledger.row_count, 0) AS row_count,
+            ledger.last_modified
+        FROM `tabPurchase Loan Request` plr
+        JOIN `tabCompany` company ON company.name = plr.company
+        LEFT JOIN (
+            SELECT
+                purchase_loan_request,
+                SUM(CASE WHEN purchase_loan_payment_type = 'Pay' AND cancelled = 0 THEN amount ELSE 0 END) AS total_paid,
+                SUM(CASE WHEN purchase_loan_payment_type = 'RePay' AND cancelled = 0 THEN amount ELSE 0 END) AS total_repaid,
+                COUNT(*) AS row_count,
+                MAX(modified) AS last_modified
+            FROM `tabPurchase Loan Ledger`
+            GROUP BY purchase_loan_request
+        ) ledger ON ledger.purchase_loan_request = plr.name
+        WHERE {" AND ".join(conditions)}
+        ORDER BY plr.name
+    """, values, as_dict=True)
+
+    changed = []
+    for loan in loans:
+        exchange_rate = (flt(loan.exchange_rate) or 1.0) if loan.company_currency != loan.currency else 1.0
+        balances = calculate_loan_balances(
+            flt(loan.request_amount), flt(loan.total_paid) / exchange_rate, flt(loan.total_repaid) / exchange_rate
+        )
+        diff = {
+            fieldname: (flt(loan.get(fieldname)), flt(balances[fieldname]))
+            for fieldname in LOAN_BALANCE_FIELDS
+            if abs(flt(loan.get(fieldname)) - flt(balances[fieldname])) > 0.001
+        }
+        balances["ledger_stamp"] = f"{cint(loan.row_count)}:{cstr(loan.last_modified)}"
+        if diff or balances["ledger_stamp"] != cstr(loan.ledger_stamp):
+            changed.append((loan.name, balances, diff))
+
+    result = {"examined": len(loans), "changed": sum(1 for _name, _balances, diff in changed if diff), "updated": 0}
+
+    if dry_run:
+        result["diff"] = {name: diff for name, _balances, diff in changed if diff}
+        return result
+
+    for start in range(0, len(changed), chunk_size):
+        chunk = changed[start:start + chunk_size]
+        _write_loan_balances_chunk(chunk)
+        frappe.db.commit()
+
+        result["updated"] += len(chunk)
+        frappe.utils.update_progress_bar(_("Rebuilding Purchase Loan balances"), result["updated"] - 1, len(changed))
+
+    # Exposure is derived from the balance fields, so the rows of the filtered loans are rebuilt from the corrected values
+    rebuild_employee_exposure(purchase_loan_requests, company, employee)
+    frappe.db.commit()
+
+    return result
+
+
+def _write_loan_balances_chunk(chunk):
+    """Writes [(name, balances, diff), ...] with a single UPDATE ... JOIN."""
+    fieldnames = (*LOAN_BALANCE_FIELDS, "ledger_stamp")
+    select_columns = ", ".join(["%s AS name"] + [f"%s AS {fieldname}" for fieldname in fieldnames])
+    rows_sql = " UNION ALL ".join([f"SELECT {select_columns}"] * len(chunk))
+    params = []
+    for name, balances, _diff in chunk:
+        params.append(name)
+        params.extend(flt(balances[fieldname]) for fieldname in LOAN_BALANCE_FIELDS)
+        params.append(balances["ledger_stamp"])
+
+    frappe.db.sql(f"""
+        UPDATE `tabPurchase Loan Request` plr
+        JOIN ({rows_sql}) balances ON balances.name = plr.name
+        SET {", ".join(f"plr.{fieldname} = balances.{fieldname}" for fieldname in fieldnames)}
+    """, tuple(params))
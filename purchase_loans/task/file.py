@@ -1,32 +1,59 @@
 import frappe
+from purchase_loans.purchase_loans.attachments import ATTACHMENT_TARGETS, push_attachment
 
 @frappe.whitelist()
 def before_delete_file(doc, method):
     if doc.attached_to_doctype and doc.attached_to_name:
-        attached_doc = frappe.get_doc(doc.attached_to_doctype, doc.attached_to_name)
+        check_attachment_delete_permission(doc.owner, doc.attached_to_doctype, doc.attached_to_name)
 
-        # Check if the document has workflow restrictions
-        if not has_write_access_on_workflow(frappe.session.user, doc.attached_to_doctype, doc.attached_to_name):
-            frappe.throw(
-                f"You cannot delete this file because you do not have edit access on the workflow state of {doc.attached_to_doctype} {doc.attached_to_name}.",
-                frappe.PermissionError
-            )
 
-        # If the attached document is submitted (docstatus == 1), only System Manager can delete
-        if attached_doc.docstatus == 1:
-            if "System Manager" not in frappe.get_roles():
-                frappe.throw(
-                    f"You cannot delete this file because it is attached to a submitted document: {doc.attached_to_doctype} {doc.attached_to_name}. Only a System Manager can delete it.",
-                    frappe.PermissionError
-                )
-            return  # System Manager is allowed to delete submitted documents
-
-        # If the attached document is in draft (docstatus == 0), only the file owner can delete
-        if doc.owner != frappe.session.user:
+def check_attachment_delete_permission(owner, attached_to_doctype, attached_to_name):
+    """
+    Raises unless the session user may remove an attachment created by `owner` from a document.
+    Also applied to the attachment references removed from the sidebar.
+    """
+    attached_doc = frappe.get_doc(attached_to_doctype, attached_to_name)
+
+    # Check if the document has workflow restrictions
+    if not has_write_access_on_workflow(frappe.session.user, attached_to_doctype, attached_to_name):
+        frappe.throw(
+            f"You cannot delete this file because you do not have edit access on the workflow state of {attached_to_doctype} {attached_to_name}.",
+            frappe.PermissionError
+        )
+
+    # If the attached document is submitted (docstatus == 1), only System Manager can delete
+    if attached_doc.docstatus == 1:
+        if "System Manager" not in frappe.get_roles():
             frappe.throw(
-                "You cannot delete this file because only the owner of the file can delete it in the draft state.",
+                f"You cannot delete this file because it is attached to a submitted document: {attached_to_doctype} {attached_to_name}. Only a System Manager can delete it.",
                 frappe.PermissionError
             )
+        return  # System Manager is allowed to delete submitted documents
+
+    # If the attached document is in draft (docstatus == 0), only the file owner can delete
+    if owner != frappe.session.user:
+        frappe.throw(
+            "You cannot delete this file because only the owner of the file can delete it in the draft state.",
+            frappe.PermissionError
+        )
+
+
+def propagate_file_attachment(doc, method):
+    """
+    File after_insert: pushes a file attached to a Purchase Order, Sales Order or Purchase Loan
+    Request to the documents linked to it. Copies made by the propagation itself are bulk inserted
+    and do not come through here again. A failed push is rolled back to a savepoint and logged, so
+    the upload itself still succeeds without half-written references or counts.
+    """
+    if doc.is_folder or not doc.file_url or doc.attached_to_doctype not in ATTACHMENT_TARGETS:
+        return
+
+    frappe.db.savepoint("purchase_loans_push_attachment")
+    try:
+        push_attachment(doc)
+    except Exception as e:
+        frappe.db.rollback(save_point="purchase_loans_push_attachment")
+        frappe.log_error(f"Error pushing attachment {doc.name} from {doc.attached_to_doctype} {doc.attached_to_name}: {str(e)}")
 
 
 def has_write_access_on_workflow(user, doctype, docname):
@@ -6,7 +6,14 @@ from frappe import _
 import random
 import string
 import re
-
+from purchase_loans.purchase_loans.tasks import (
+    cancel_purchase_loan_ledger,
+    mark_purchase_loan_dirty,
+)
+from purchase_loans.purchase_loans.doctype.purchase_loan_repayment.purchase_loan_repayment import (
+    update_purchase_invoice_outstanding,
+)
+from purchase_loans.purchase_loans.revaluation import REVALUATION_VOUCHER_TYPE, revert_purchase_loan_revaluation
 
 
 @frappe.whitelist()
@@ -24,236 +31,43 @@ def validate_journal_entry(doc, method):
 
 
 
-@frappe.whitelist()
-def update_purchase_loan_request(purchase_loan_request_name):
-    """
-    Updates a Purchase Loan Request document with aggregate values from the ledger.
-
-    Given a Purchase Loan Request document name, this function aggregates the total paid and
-    total repaid amounts from the ledger and calculates the outstanding and overpaid amounts.
-    The Purchase Loan Request document is then updated with the calculated values.
-
-    :param purchase_loan_request_name: The name of the Purchase Loan Request document to update.
-    """
-    if not purchase_loan_request_name:
-        return
-
-    loan_request_doc = frappe.get_doc("Purchase Loan Request", purchase_loan_request_name)
-
-    company_currency = frappe.db.get_value(
-        "Company", filters={"name": loan_request_doc.company}, fieldname="default_currency"
-    )
-    
-    if company_currency != loan_request_doc.currency:
-        exchange_rate = loan_request_doc.exchange_rate
-    else:
-        exchange_rate = 1.0
-
-    request_amount = loan_request_doc.request_amount * exchange_rate
-
-    # Aggregate paid and repayment amounts from the ledger
-    ledger_totals = frappe.db.sql("""
-        SELECT 
-            SUM(CASE WHEN purchase_loan_payment_type = 'Pay' AND cancelled = 0 THEN amount ELSE 0 END) AS total_paid,
-            SUM(CASE WHEN purchase_loan_payment_type = 'RePay' AND cancelled = 0 THEN amount ELSE 0 END) AS total_repaid
-        FROM `tabPurchase Loan Ledger`
-        WHERE purchase_loan_request = %s
-    """, (purchase_loan_request_name), as_dict=True)[0]
-
-    # Ensure totals default to 0 if None
-    total_paid = ledger_totals.get('total_paid') or 0
-    total_repaid = ledger_totals.get('total_repaid') or 0
-
-    # Calculate overpaid amount
-    overpaid_amount = 0.0
-    if total_repaid > request_amount:
-        overpaid_amount = max(total_repaid - total_paid, 0)
-
-    # Calculate outstanding amounts
-    outstanding_from_repayment = max(total_paid - total_repaid, 0)
-    outstanding_from_request = max(request_amount - total_paid, 0)
-    overpaid_payment_amount = max(total_paid - request_amount, 0)
-
-    # Update the Purchase Loan Request document with calculated values
-    frappe.db.sql("""
-        UPDATE `tabPurchase Loan Request`
-        SET 
-            paid_amount_from_request = %s,
-            repaid_amount = %s,
-            outstanding_amount_from_request = %s,
-            outstanding_amount_from_repayment = %s,
-            overpaid_payment_amount = %s,
-            overpaid_repayment_amount = %s
-        WHERE name = %s
-    """, (
-        total_paid / exchange_rate,
-        total_repaid / exchange_rate,
-        outstanding_from_request / exchange_rate,
-        outstanding_from_repayment / exchange_rate,
-        overpaid_payment_amount / exchange_rate,
-        overpaid_amount / exchange_rate,
-        purchase_loan_request_name
-    ))
-
-    # Commit changes to the database
-    frappe.db.commit()
-
-
-@frappe.whitelist()
-def cancel_purchase_loan_ledger(doc):
-    # Ensure the necessary fields are present
-    """
-    Cancels a Purchase Loan Ledger entry. This is a whitelisted function called
-    by a hook on a custom doctype. It takes a doc object as argument, and
-    requires the doc.name to be present. It then gets the Purchase Loan Ledger
-    record linked to the doc and updates the cancelled field to 1.
-    """
-    if not doc.name:
-        frappe.throw("Document name is required.")
-    
-    # Get the Purchase Loan Ledger record linked to the doc
-    ledger_entry = frappe.get_all("Purchase Loan Ledger", filters={
-        "purchase_loan_request": doc.custom_purchase_loan_request,
-        "reference_name": doc.name
-    })
-
-    if ledger_entry:
-        # Update the cancelled field to 1
-        frappe.db.set_value("Purchase Loan Ledger", ledger_entry[0].name, "cancelled", 1)
-        
-        # Commit the transaction
-        frappe.db.commit()
-
-@frappe.whitelist()
-def create_purchase_loan_ledger(doc, ledger_amount):
-    # Create a new Purchase Loan Ledger entry
-    """
-    Creates a new entry in the Purchase Loan Ledger based on the provided document.
-    Determines the payment type (Pay or RePay) from the voucher type, calculates the
-    paid amount, and records the necessary details such as employee, company, and 
-    posting date into the ledger. The new ledger entry is then inserted into the database.
-    
-    Args:
-        doc (Document): The document containing details needed for creating the 
-        Purchase Loan Ledger entry, including voucher type, custom purchase loan request, 
-        employee, company, and posting date.
-    """
-
-    loan_request_doc = frappe.get_doc("Purchase Loan Request", doc.custom_purchase_loan_request)
-    purchase_loan_payment_type = "Pay" if doc.voucher_type =="Purchase Loan Payment" else "RePay"
-    paid_amount = ledger_amount
-    ledger_entry = frappe.get_doc({
-        "doctype": "Purchase Loan Ledger",
-        "purchase_loan_request": loan_request_doc.name,
-        "reference_name": doc.name,  
-        "purchase_loan_payment_type": purchase_loan_payment_type,
-        "employee": loan_request_doc.employee,
-        "company": doc.company,
-        "posting_date": doc.posting_date,
-        "amount": paid_amount
-    })
-
-    # Insert the record into the database
-    ledger_entry.insert()
-
-
 @frappe.whitelist()
 def update_purchase_loan_request_on_submit(doc, method):
     """
     Called on submit of a Purchase Loan Payment, Settlement Invoice, or Settlement Expense.
-    Creates a new Purchase Loan Ledger entry and updates the Purchase Loan Request.
+    The ledger entry created for the journal has already applied its amount to the Purchase Loan
+    Request; this only queues the loan so its ledger stamp is refreshed once at commit.
     """
     if doc.custom_purchase_loan_request:
 
-        update_purchase_loan_request(doc.custom_purchase_loan_request)
+        mark_purchase_loan_dirty(doc.custom_purchase_loan_request)
 
 
 
 
-@frappe.whitelist()
-def update_purchase_loan_request(purchase_loan_request_name):
-    """
-    Updates a Purchase Loan Request document with aggregate values from the ledger.
-
-    Given a Purchase Loan Request document name, this function aggregates the total paid and
-    total repaid amounts from the ledger and calculates the outstanding and overpaid amounts.
-    The Purchase Loan Request document is then updated with the calculated values.
-
-    :param purchase_loan_request_name: The name of the Purchase Loan Request document to update.
-    """
-    if not purchase_loan_request_name:
-        return
-
-    loan_request_doc = frappe.get_doc("Purchase Loan Request", purchase_loan_request_name)
-
-    company_currency = frappe.db.get_value(
-        "Company", filters={"name": loan_request_doc.company}, fieldname="default_currency"
-    )
-    
-    if company_currency != loan_request_doc.currency:
-        exchange_rate = loan_request_doc.exchange_rate
-    else:
-        exchange_rate = 1.0
-
-    request_amount = loan_request_doc.request_amount * exchange_rate
-
-    # Aggregate paid and repayment amounts from the ledger
-    ledger_totals = frappe.db.sql("""
-        SELECT 
-            SUM(CASE WHEN purchase_loan_payment_type = 'Pay' AND cancelled = 0 THEN amount ELSE 0 END) AS total_paid,
-            SUM(CASE WHEN purchase_loan_payment_type = 'RePay' AND cancelled = 0 THEN amount ELSE 0 END) AS total_repaid
-        FROM `tabPurchase Loan Ledger`
-        WHERE purchase_loan_request = %s
-    """, (purchase_loan_request_name), as_dict=True)[0]
-
-    # Ensure totals default to 0 if None
-    total_paid = ledger_totals.get('total_paid') or 0
-    total_repaid = ledger_totals.get('total_repaid') or 0
-
-    # Calculate overpaid amount
-    overpaid_amount = 0.0
-    if total_repaid > request_amount:
-        overpaid_amount = max(total_repaid - total_paid, 0)
-
-    # Calculate outstanding amounts
-    outstanding_from_repayment = max(total_paid - total_repaid, 0)
-    outstanding_from_request = max(request_amount - total_paid, 0)
-    overpaid_payment_amount = max(total_paid - request_amount, 0)
-
-    # Update the Purchase Loan Request document with calculated values
-    frappe.db.sql("""
-        UPDATE `tabPurchase Loan Request`
-        SET 
-            paid_amount_from_request = %s,
-            repaid_amount = %s,
-            outstanding_amount_from_request = %s,
-            outstanding_amount_from_repayment = %s,
-            overpaid_payment_amount = %s,
-            overpaid_repayment_amount = %s
-        WHERE name = %s
-    """, (
-        total_paid / exchange_rate,
-        total_repaid / exchange_rate,
-        outstanding_from_request / exchange_rate,
-        outstanding_from_repayment / exchange_rate,
-        overpaid_payment_amount / exchange_rate,
-        overpaid_amount / exchange_rate,
-        purchase_loan_request_name
-    ))
-
-    # Commit changes to the database
-    frappe.db.commit()
-
-
 @frappe.whitelist()
 def update_purchase_loan_request_on_cancel(doc, method):
     """
     Called on cancel of a Purchase Loan Payment, Settlement Invoice, or Settlement Expense.
-    Cancels the associated Purchase Loan Ledger entry and updates the Purchase Loan Request.
+    Cancels the associated Purchase Loan Ledger entry, which applies the reversed amount to the Purchase Loan Request balances as a delta.
     If the cancelled document is a Purchase Loan Settlement Invoice, it sets the associated Purchase Invoice to "Overdue"
     and resets the outstanding amount. If it is a Purchase Loan Settlement Expense, it clears the Loan Repayment Other Expenses
     table and resets the total. In both cases, it adjusts the total_repayment_amount in the Purchase Loan Repayment document.
+    A bulk payout or netting journal (no custom_purchase_loan_request) only has its ledger rows cancelled,
+    and a loan revaluation journal has its amounts taken back off the loans.
     """
+    if doc.flags.purchase_loan_bulk_cancel:
+        # Cancelled from a bulk path that handles the ledger, invoices and totals itself
+        return
+
+    if doc.voucher_type == REVALUATION_VOUCHER_TYPE:
+        revert_purchase_loan_revaluation(doc)
+        return
+
+    if not doc.custom_purchase_loan_request and doc.voucher_type in ("Purchase Loan Payment", "Purchase Loan Netting"):
+        cancel_purchase_loan_ledger(doc)
+        return
+
     if doc.custom_purchase_loan_request:
         cancel_purchase_loan_ledger(doc)
         # Fetch the linked Purchase Loan Request document
@@ -266,11 +80,30 @@ def update_purchase_loan_request_on_cancel(doc, method):
             purchase_loan_repayment = frappe.get_doc("Purchase Loan Repayment", doc.custom_purchase_loan_repayment)
             total_invoices = purchase_loan_repayment.total_invoices
 
-            if doc.voucher_type == "Purchase Loan Settlement Invoice":
+            if doc.voucher_type == "Purchase Loan Settlement Invoice" and not doc.custom_row_name:
+                # Consolidated settlement: restore every invoice the journal paid
+                settled_invoices = {
+                    row.against_voucher for row in doc.accounts
+                    if row.against_voucher_type == "Purchase Invoice" and row.against_voucher
+                }
+                restored_outstanding = {
+                    repayment_invoice.purchase_invoice: repayment_invoice.outstanding_amount
+                    for repayment_invoice in purchase_loan_repayment.purchase_loan_repayment_invoices
+                    if repayment_invoice.purchase_invoice in settled_invoices
+                }
+                update_purchase_invoice_outstanding(restored_outstanding, "Overdue")
+                total_invoices -= sum(restored_outstanding.values())
+                purchase_loan_repayment.total_invoices = total_invoices
+
+            elif doc.voucher_type == "Purchase Loan Settlement Invoice":
                 # Adjust outstanding and repaid amounts
                 purchase_loan_repayment_invoice_name = frappe.db.get_value(
                         "Purchase Loan Repayment Invoices",
-                        filters={"purchase_invoice": doc.custom_row_name},
+                        filters={
+                            "parent": doc.custom_purchase_loan_repayment,
+                            "parenttype": "Purchase Loan Repayment",
+                            "purchase_invoice": doc.custom_row_name
+                        },
                         fieldname="name"
                     )
                 if purchase_loan_repayment_invoice_name:
@@ -307,7 +140,6 @@ def update_purchase_loan_request_on_cancel(doc, method):
             purchase_loan_repayment.save(ignore_permissions=True)
             purchase_loan_repayment.reload()
 
-
-        update_purchase_loan_request(doc.custom_purchase_loan_request)
+        # The ledger cancellation above has already applied the reversing delta to the balances
         # Final success message
         frappe.msgprint(_("Purchase Loan Request '{0}' updated successfully.").format(purchase_loan_request.name))
@@ -1,7 +1,7 @@
 import frappe
 from frappe.utils import getdate
 from frappe import _
-from purchase_loans.purchase_loans.tasks import copy_attachments_to_target
+from purchase_loans.purchase_loans.tasks import enqueue_copy_attachments_to_target
 
 @frappe.whitelist()
 def validate_payment_entry(doc, method):
@@ -74,5 +74,5 @@ def validate_payment_entry(doc, method):
             _("Paid amount exceeds the total outstanding amount for the referenced invoices.")
         )
     
-    if not doc.is_new() and source_doctype and doc.custom_transaction_unique_id:
-        copy_attachments_to_target(doc.doctype, doc.name, source_doctype)
+    if source_doctype and doc.custom_transaction_unique_id and doc.has_value_changed("custom_transaction_unique_id"):
+        enqueue_copy_attachments_to_target(doc.doctype, doc.name, source_doctype)
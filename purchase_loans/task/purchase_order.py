@@ -6,6 +6,7 @@ import random
 import string
 import re
 import logging
+from purchase_loans.purchase_loans.company_settings import get_loan_company_settings
 
 @frappe.whitelist()
 def set_direct_approver(doc):
@@ -37,8 +38,7 @@ def validate_purchase_order(doc, method):
         set_direct_approver(doc)
 
     # Fetch the company's custom role
-    company_record = frappe.get_doc("Company", doc.company)
-    required_role = company_record.custom_role
+    required_role = get_loan_company_settings(doc.company).role
 
     for item in doc.items:
         is_stock_item = frappe.db.get_value("Item", item.item_code, "is_stock_item")
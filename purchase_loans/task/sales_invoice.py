@@ -1,7 +1,7 @@
 import frappe
 from frappe.utils import getdate
 from frappe import _
-from purchase_loans.purchase_loans.tasks import copy_attachments_to_target
+from purchase_loans.purchase_loans.tasks import enqueue_copy_attachments_to_target
 
 @frappe.whitelist()
 def validate_sales_invoice(doc, method):
@@ -30,5 +30,5 @@ def validate_sales_invoice(doc, method):
                         _("Custom Transaction Unique ID not found on Sales Order: {0}").format(m.sales_order)
                     )
 
-    if not doc.is_new() and doc.custom_transaction_unique_id:
-        copy_attachments_to_target(doc.doctype, doc.name, "Sales Order")
+    if doc.custom_transaction_unique_id and doc.has_value_changed("custom_transaction_unique_id"):
+        enqueue_copy_attachments_to_target(doc.doctype, doc.name, "Sales Order")
@@ -6,6 +6,7 @@ import random
 import string
 import re
 import logging
+from purchase_loans.purchase_loans.company_settings import get_loan_company_settings
 
 
 @frappe.whitelist()
@@ -70,12 +71,11 @@ def validate_sales_order(doc, method):
 
 
 
+    # Fetch the company's custom role
+    required_role = get_loan_company_settings(doc.company).role
+
     # Validate each item in the Sales Order
     for item in doc.items:
-        # Fetch the company's custom role
-        company_record = frappe.get_doc("Company", doc.company)
-        required_role = company_record.custom_role
-
         # Get item details
         is_stock_item = frappe.db.get_value("Item", item.item_code, "is_stock_item")
         is_fixed_asset = frappe.db.get_value("Item", item.item_code, "is_fixed_asset")
@@ -1,7 +1,7 @@
 import frappe
 from frappe.utils import nowdate, getdate
 from frappe import _  
-from purchase_loans.purchase_loans.tasks import copy_attachments_to_target
+from purchase_loans.purchase_loans.tasks import enqueue_copy_attachments_to_target
 
 @frappe.whitelist()
 def validate_purchase_receipt(doc, method):
@@ -32,8 +32,8 @@ def validate_purchase_receipt(doc, method):
                 pass  # Continue processing other items
 
         try:
-            if not doc.is_new() and doc.custom_transaction_unique_id:
-                copy_attachments_to_target(doc.doctype, doc.name, "Purchase Order")
+            if doc.custom_transaction_unique_id and doc.has_value_changed("custom_transaction_unique_id"):
+                enqueue_copy_attachments_to_target(doc.doctype, doc.name, "Purchase Order")
         except Exception as e:
             frappe.log_error(f"Error copying attachments for Purchase Receipt {doc.name}: {str(e)}")
             pass
@@ -71,8 +71,8 @@ def validate_delivery_note(doc, method):
                 pass  # Continue processing other items
 
         try:
-            if not doc.is_new() and doc.custom_transaction_unique_id:
-                copy_attachments_to_target(doc.doctype, doc.name, "Sales Order")
+            if doc.custom_transaction_unique_id and doc.has_value_changed("custom_transaction_unique_id"):
+                enqueue_copy_attachments_to_target(doc.doctype, doc.name, "Sales Order")
         except Exception as e:
             frappe.log_error(f"Error copying attachments for Delivery Note {doc.name}: {str(e)}")
             pass